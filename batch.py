@@ -0,0 +1,333 @@
+""" Runs one Teeny Tiny program over a whole batch of inputs at once, with NumPy.
+
+Each lane of the batch is one run of the program with its own INPUT values, as if the compiled
+`out.c` had been started once per record. Variables are float32 arrays with an element per lane,
+so every statement runs for all the lanes in a handful of NumPy operations. Arithmetic follows the
+C program (see semantics.py): float32 arithmetic is rounded to float after each operation, double
+literals make an expression double, and integer literals stay integers. NumPy is optional; only
+this module needs it.
+
+    batch = compile_program(program)
+    result = run(batch, [scores_column, count_column])
+    result.printed[-1].values  # What each lane printed last.
+
+IF and WHILE are run under a mask of the lanes taking them. A WHILE repeats until no lane is still
+looping, and each lane leaves it as its own condition fails. GOTO can send every lane somewhere
+different, so programs using it aren't supported.
+"""
+import operator
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence
+
+import nodes
+import semantics
+from lex import TokenType
+from optimize import walk
+from pygen import COMPARISONS, integer_divide
+from semantics import DOUBLE, FLOAT, INT, LONG
+
+try:
+    import numpy
+except ImportError:  # Batch execution isn't available.
+    numpy = None
+
+# A value in an expression is an array with an element per lane, or a scalar when it's the same
+# for every lane: a Python int for INT and LONG, a NumPy float32 or float64 for FLOAT and DOUBLE.
+Evaluate = Callable[['State'], object]
+Execute = Callable[['State', object], None]
+
+INTEGER_ARITHMETIC = {"+": operator.add, "-": operator.sub, "*": operator.mul}
+if numpy is not None:
+    FLOAT_ARITHMETIC = {"+": numpy.add, "-": numpy.subtract, "*": numpy.multiply, "/": numpy.divide}
+    COMPARE = {
+        "<": numpy.less,
+        "<=": numpy.less_equal,
+        ">": numpy.greater,
+        ">=": numpy.greater_equal,
+        "==": numpy.equal,
+        "!=": numpy.not_equal,
+    }
+
+
+@dataclass
+class Printed:
+    """ What one PRINT printed, in the lanes that ran it. """
+
+    statement: nodes.Print
+    lanes: object  # The lanes that ran it, as a sorted array of lane numbers.
+    values: object = None  # The float32 number printed in each of those lanes, or None for a string.
+
+
+class Result:
+    """ What running a batch printed, and the variables at the end. """
+
+    def __init__(self, printed: List[Printed], variables: Dict[str, object]):
+        self.printed = printed  # In the order the PRINTs ran.
+        self.variables = variables  # Teeny Tiny name to a float32 array of each lane's final value.
+
+    def lines(self, lane: int) -> List[str]:
+        # The lines one lane printed, as the C program would have written them.
+        lines = []
+        for printed in self.printed:
+            index = numpy.searchsorted(printed.lanes, lane)
+            if index < len(printed.lanes) and printed.lanes[index] == lane:
+                if printed.values is None:
+                    lines.append(printed.statement.value)
+                else:
+                    lines.append(semantics.format_float(float(printed.values[index])))
+        return lines
+
+    def output(self, lane: int) -> str:
+        # Everything one lane wrote to standard output.
+        return "".join(line + "\n" for line in self.lines(lane))
+
+
+class State:
+    """ The lanes of a batch as it runs. """
+
+    def __init__(self, variables: int, columns, lengths):
+        lanes = columns.shape[1]
+        self.variables = [numpy.zeros(lanes, numpy.float32) for _ in range(variables)]
+        self.columns = columns
+        self.lengths = lengths
+        self.cursor = numpy.zeros(lanes, numpy.intp)  # Each lane's next INPUT value.
+        self.printed: List[Printed] = []
+
+
+class Batch:
+    """ A program compiled to run over batches, made by compile_program. """
+
+    def __init__(self, body: Execute, variables: Dict[str, int]):
+        self.body = body
+        self.variables = variables  # Teeny Tiny name to its index in State.variables.
+
+
+class BatchCompiler:
+    """ Turns the tree from parse.TreeParser into nested functions that each run a statement, or
+        evaluate an expression, for every lane at once.
+    """
+
+    def __init__(self):
+        self.variables: Dict[str, int] = {}
+
+    def program(self, program: nodes.Program) -> Batch:
+        if any(isinstance(node, nodes.Goto) for node in walk(program.statements)):
+            raise ValueError("batch execution doesn't support GOTO")
+        return Batch(self.block(program.statements), self.variables)
+
+    def slot(self, name: str) -> int:
+        if name not in self.variables:
+            self.variables[name] = len(self.variables)
+        return self.variables[name]
+
+    # Statements #
+    # Each runs with the mask of the lanes that reach it, which always has at least one set.
+
+    def block(self, statements: List[nodes.Node]) -> Execute:
+        executes = [self.statement(statement) for statement in statements]
+        executes = [execute for execute in executes if execute is not None]
+
+        def block(state, mask):
+            for execute in executes:
+                execute(state, mask)
+
+        return block
+
+    def statement(self, node: nodes.Node) -> Optional[Execute]:
+        if isinstance(node, nodes.Print):
+            return self.print(node)
+        if isinstance(node, nodes.Let):
+            slot = self.slot(node.name)
+            value = self.to_float(*self.expression(node.expression))
+
+            def let(state, mask):
+                numpy.copyto(state.variables[slot], value(state), where=mask)
+
+            return let
+        if isinstance(node, nodes.Input):
+            return self.input(node)
+        if isinstance(node, nodes.If):
+            condition = self.condition(node.comparison)
+            body = self.block(node.body)
+
+            def if_(state, mask):
+                taken = mask & condition(state)
+                if taken.any():
+                    body(state, taken)
+
+            return if_
+        if isinstance(node, nodes.While):
+            condition = self.condition(node.comparison)
+            body = self.block(node.body)
+
+            def while_(state, mask):
+                looping = mask & condition(state)
+                while looping.any():
+                    body(state, looping)
+                    looping &= condition(state)
+
+            return while_
+        return None  # A label.
+
+    def print(self, node: nodes.Print) -> Execute:
+        if isinstance(node.value, str):
+
+            def print_string(state, mask):
+                state.printed.append(Printed(node, numpy.flatnonzero(mask)))
+
+            return print_string
+        value = self.to_float(*self.expression(node.value))
+
+        def print_number(state, mask):
+            lanes = numpy.flatnonzero(mask)
+            values = value(state)
+            if isinstance(values, numpy.ndarray):
+                values = values[lanes]
+            else:
+                values = numpy.full(len(lanes), values, numpy.float32)
+            state.printed.append(Printed(node, lanes, values))
+
+        return print_number
+
+    def input(self, node: nodes.Input) -> Execute:
+        # Each lane reads its next value. A lane that has none left is at end of input, where
+        # scanf leaves the variable alone.
+        slot = self.slot(node.name)
+
+        def input(state, mask):
+            lanes = numpy.flatnonzero(mask & (state.cursor < state.lengths))
+            if len(lanes):
+                state.variables[slot][lanes] = state.columns[state.cursor[lanes], lanes]
+                state.cursor[lanes] += 1
+
+        return input
+
+    # Expressions #
+    # Each returns the C type of the value and a function to evaluate it.
+
+    def condition(self, node: nodes.Comparison) -> Evaluate:
+        # A comparison as a boolean array, or a boolean when it's the same for every lane.
+        kind, comparison = self.comparison(node)
+        if kind != INT:
+            # A comparison needs an operator, so the parser never makes one without.
+            raise ValueError("a condition must compare")
+
+        def condition(state):
+            value = comparison(state)
+            return value != 0 if isinstance(value, numpy.ndarray) else bool(value)
+
+        return condition
+
+    def comparison(self, node: nodes.Comparison):
+        return self.chain(node, self.expression)
+
+    def expression(self, node: nodes.Expression):
+        return self.chain(node, self.term)
+
+    def term(self, node: nodes.Term):
+        return self.chain(node, self.unary)
+
+    def unary(self, node: nodes.Unary):
+        primary = node.primary
+        if primary.kind == TokenType.IDENT:
+            slot = self.slot(primary.text)
+            if node.operator == "-":
+                return FLOAT, lambda state: numpy.negative(state.variables[slot])
+            return FLOAT, lambda state: state.variables[slot]
+        value = semantics.literal(primary.text)
+        if value is None:
+            value = (DOUBLE, float(primary.text))
+        kind, number = value
+        if node.operator == "-":
+            number = -number if kind == DOUBLE else semantics.wrap(-number, semantics.BITS[kind])
+        if kind == DOUBLE:
+            number = numpy.float64(number)
+        return kind, lambda state: number
+
+    def chain(self, node, operand):
+        # A left-associative chain of operators, each applied C style.
+        kind, value = operand(node.operands[0])
+        for operator, right_node in zip(node.operators, node.operands[1:]):
+            right_kind, right = operand(right_node)
+            common = semantics.common(kind, right_kind)
+            left = self.convert(value, kind, common)
+            right = self.convert(right, right_kind, common)
+            if operator in COMPARISONS:
+                value = self.compare(operator, left, right)
+                kind = INT
+            elif common in (INT, LONG):
+                # Only literals are integers, so these are the same in every lane.
+                value = self.integer_arithmetic(operator, left, right, semantics.BITS[common])
+                kind = common
+            else:
+                value = self.float_arithmetic(operator, left, right)
+                kind = common
+        return kind, value
+
+    def compare(self, operator: str, left: Evaluate, right: Evaluate) -> Evaluate:
+        # 1 or 0 (as a boolean array when the lanes can differ).
+        function = COMPARE[operator]
+
+        def compare(state):
+            result = function(left(state), right(state))
+            return result if isinstance(result, numpy.ndarray) else int(result)
+
+        return compare
+
+    def integer_arithmetic(self, operator: str, left: Evaluate, right: Evaluate, bits: int) -> Evaluate:
+        if operator == "/":
+            return lambda state: integer_divide(left(state), right(state), bits)
+        function = INTEGER_ARITHMETIC[operator]
+        return lambda state: semantics.wrap(function(left(state), right(state)), bits)
+
+    def float_arithmetic(self, operator: str, left: Evaluate, right: Evaluate) -> Evaluate:
+        # NumPy rounds float32 arithmetic to float32, and gives infinities and NaN for division by zero.
+        function = FLOAT_ARITHMETIC[operator]
+        return lambda state: function(left(state), right(state))
+
+    def convert(self, value: Evaluate, kind: str, to: str) -> Evaluate:
+        if kind == to or to in (INT, LONG):
+            return value
+        dtype = numpy.float32 if to == FLOAT else numpy.float64
+        rounds = to == FLOAT and kind in (INT, LONG)
+
+        def convert(state):
+            result = value(state)
+            if isinstance(result, numpy.ndarray):
+                return result.astype(dtype)
+            if rounds:
+                # An integer literal, rounded to float the way the other executors do.
+                result = semantics.to_float(result)
+            return dtype(result)
+
+        return convert
+
+    def to_float(self, kind: str, value: Evaluate) -> Evaluate:
+        return self.convert(value, kind, FLOAT)
+
+
+def compile_program(program: nodes.Program) -> Batch:
+    # Compile the program to run over batches. Raises ValueError if it uses GOTO.
+    if numpy is None:
+        raise ImportError("batch execution needs NumPy")
+    return BatchCompiler().program(program)
+
+
+def run(batch: Batch, columns: Sequence, lengths: Optional[Sequence[int]] = None) -> Result:
+    # Run a compiled program once per lane. columns[i][lane] is the i-th number that lane reads with
+    # INPUT, so columns is indexed (value, lane); give numpy.empty((0, lanes)) for no input at all.
+    # A lane past its length (all the columns by default) is at end of input.
+    # Like the compiled program, a lane whose WHILE never ends never finishes, and neither does run.
+    columns = numpy.asarray(columns, numpy.float32)
+    if columns.ndim != 2:
+        raise ValueError("columns must be two dimensional, indexed by value and then lane")
+    if lengths is None:
+        lengths = numpy.full(columns.shape[1], columns.shape[0], numpy.intp)
+    else:
+        lengths = numpy.minimum(numpy.asarray(lengths, numpy.intp), columns.shape[0])
+    state = State(len(batch.variables), columns, lengths)
+    if columns.shape[1]:
+        with numpy.errstate(all="ignore"):
+            batch.body(state, numpy.ones(columns.shape[1], bool))
+    variables = {name: state.variables[slot] for name, slot in batch.variables.items()}
+    return Result(state.printed, variables)
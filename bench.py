@@ -0,0 +1,363 @@
+""" Benchmarks for the compiler, on synthetic programs.
+
+    python3 bench.py                     # Every shape of program, at the default size.
+    python3 bench.py --size 100000 nested expressions
+
+Each benchmark generates a program, then times lexing, parsing and emitting C separately, taking
+the best of a few repeats, and measures the peak memory of a whole compile with tracemalloc. It
+also writes the parsed program as IR (see ir.py), and times loading it against lexing and parsing.
+The results are printed and appended as a JSON line to a results file (bench_output.txt by default)
+together with a hash of the compiler's source, so runs from different versions can be compared:
+each result is compared with the last one recorded for an older version, and anything more
+than --threshold slower is reported as a regression, with exit status 1.
+
+    python3 bench.py --engines           # Time running long loops on each --run engine instead.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cache
+import ir
+import pygen
+import vm
+from codegen import CGenerator
+from emit import Emitter
+from lex import RegexLexer, Token
+from parse import TreeParser
+
+RESULTS = "bench_output.txt"
+
+
+# Programs #
+# Each generator makes a valid program of about `size` statements.
+
+
+def flat(size: int, rng: random.Random) -> str:
+    # Straight-line arithmetic on a few variables.
+    lines = ["LET a = 1", "LET b = 2"]
+    for index in range(size):
+        lines.append(f"LET {'ab'[index % 2]} = a + b * {index % 97} - {rng.randint(0, 9)}")
+    lines.append("PRINT a")
+    return "\n".join(lines)
+
+
+def nested(size: int, rng: random.Random, depth: int = 50) -> str:
+    # IFs and WHILEs nested `depth` deep, again and again.
+    lines = ["LET a = 0"]
+    while len(lines) < size:
+        for level in range(depth):
+            if level % 2:
+                lines.append(f"IF a < {level} THEN")
+            else:
+                lines.append(f"WHILE a > {level} REPEAT")
+            lines.append(f"LET a = a + {rng.randint(1, 9)}")
+        for level in reversed(range(depth)):
+            lines.append("ENDIF" if level % 2 else "ENDWHILE")
+    return "\n".join(lines)
+
+
+def expressions(size: int, rng: random.Random, length: int = 200) -> str:
+    # A few statements with very long expressions. `size` counts operators.
+    lines = ["LET a = 1", "LET b = 2"]
+    for _ in range(max(1, size // length)):
+        parts = ["a"]
+        for _ in range(length):
+            parts.append(rng.choice("+-*/"))
+            parts.append(rng.choice(["a", "b", str(rng.randint(1, 999)), "1.5"]))
+        lines.append("PRINT " + " ".join(parts))
+    return "\n".join(lines)
+
+
+def variables(size: int, rng: random.Random) -> str:
+    # Every statement introduces a new variable.
+    lines = ["LET v0 = 1"]
+    for index in range(1, size):
+        lines.append(f"LET v{index} = v{rng.randrange(index)} + {index}")
+    return "\n".join(lines)
+
+
+def labels(size: int, rng: random.Random) -> str:
+    # Lots of labels, and GOTOs to them.
+    lines = ["LET a = 0"]
+    for index in range(size // 2):
+        lines.append(f"LABEL l{index}")
+        lines.append(f"GOTO l{rng.randrange(index + 1)}")
+    return "\n".join(lines)
+
+
+def strings(size: int, rng: random.Random, length: int = 500) -> str:
+    # PRINTs of long strings.
+    words = ["teeny", "tiny", "compiler", "benchmark", "string", "1234", "!?"]
+    lines = []
+    for _ in range(size):
+        text = " ".join(rng.choice(words) for _ in range(length // 6))
+        lines.append(f'PRINT "{text}"')
+    return "\n".join(lines)
+
+
+def mixed(size: int, rng: random.Random) -> str:
+    # A bit of everything, like a real program.
+    lines = ["LET i = 0", "LET total = 0", "INPUT n"]
+    index = 0
+    while len(lines) < size:
+        lines += [
+            f"LABEL top{index}",
+            'PRINT "next round"',
+            f"WHILE i < n * {rng.randint(2, 9)} REPEAT",
+            f"IF i / 2 == {rng.randint(0, 9)} THEN",
+            "LET total = total + i * i - 1",
+            "ENDIF",
+            "LET i = i + 1",
+            "ENDWHILE",
+            f"IF total > {rng.randint(100, 999)} THEN",
+            f"GOTO top{index}",
+            "ENDIF",
+            "PRINT total",
+        ]
+        index += 1
+    return "\n".join(lines)
+
+
+PROGRAMS: Dict[str, Callable[[int, random.Random], str]] = {
+    "flat": flat,
+    "nested": nested,
+    "expressions": expressions,
+    "variables": variables,
+    "labels": labels,
+    "strings": strings,
+    "mixed": mixed,
+}
+
+
+# Loops to run, for --engines.
+# Each makes a program and its input, going round about `size` times.
+
+
+def fibonacci(size: int) -> Tuple[str, str]:
+    # tiny/fibonacci.tiny.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiny", "fibonacci.tiny")
+    with open(path, "r") as source_file:
+        return source_file.read(), f"{size}\n"
+
+
+def nested_loops(size: int) -> Tuple[str, str]:
+    # A WHILE inside a WHILE, the inner one going round 100 times.
+    source = (
+        "INPUT n\nLET s = 0\nLET i = 0\nWHILE i < n REPEAT\nLET j = 0\nWHILE j < 100 REPEAT\n"
+        "LET s = s + i * j / 7\nLET j = j + 1\nENDWHILE\nLET i = i + 1\nENDWHILE\nPRINT s"
+    )
+    return source, f"{max(1, size // 100)}\n"
+
+
+def branches(size: int) -> Tuple[str, str]:
+    # IFs in a loop, taken some of the time.
+    source = (
+        "INPUT n\nLET i = 0\nLET a = 0\nLET b = 0\nWHILE i < n REPEAT\nIF i - i / 3 * 3 < 1 THEN\nLET a = a + i\n"
+        "ENDIF\nIF a > b * 2 THEN\nLET b = b + a / 4\nENDIF\nLET i = i + 1\nENDWHILE\nPRINT a + b"
+    )
+    return source, f"{size}\n"
+
+
+LOOPS: Dict[str, Callable[[int], Tuple[str, str]]] = {
+    "fibonacci": fibonacci,
+    "nested-loops": nested_loops,
+    "branches": branches,
+}
+
+
+# Timing #
+
+
+class ReplayLexer:
+    """ Hands the parser tokens lexed earlier, so parsing can be timed on its own. """
+
+    def __init__(self, tokens: List[Token]):
+        self.tokens = iter(tokens)
+        self.eof = tokens[-1]
+
+    def get_token(self) -> Token:
+        return next(self.tokens, self.eof)
+
+
+def best_time(function: Callable[[], object], repeat: int):
+    # The shortest of `repeat` runs, and the result of the last one.
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def lex(source: str) -> List[Token]:
+    return list(RegexLexer(source))
+
+
+def emit(program) -> str:
+    emitter = Emitter(None)
+    CGenerator(emitter).program(program)
+    output = io.StringIO()
+    emitter.write_to(output)
+    return output.getvalue()
+
+
+def compile_all(source: str) -> str:
+    return emit(TreeParser(RegexLexer(source)).program())
+
+
+def run(name: str, size: int, repeat: int, seed: int) -> Dict[str, object]:
+    source = PROGRAMS[name](size, random.Random(seed))
+    lex_seconds, tokens = best_time(lambda: lex(source), repeat)
+    parse_seconds, program = best_time(lambda: TreeParser(ReplayLexer(tokens)).program(), repeat)
+    emit_seconds, code = best_time(lambda: emit(program), repeat)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "program.ir")
+        ir.dump(program, path)
+        ir_bytes = os.path.getsize(path)
+        ir_load_seconds, _ = best_time(lambda: ir.load(path), repeat)
+    del program
+
+    tracemalloc.start()
+    compile_all(source)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "benchmark": name,
+        "size": size,
+        "source_bytes": len(source),
+        "tokens": len(tokens) - 1,  # Not counting EOF.
+        "lex_seconds": round(lex_seconds, 6),
+        "parse_seconds": round(parse_seconds, 6),
+        "emit_seconds": round(emit_seconds, 6),
+        "tokens_per_second": round((len(tokens) - 1) / lex_seconds),
+        "c_bytes": len(code),
+        "ir_bytes": ir_bytes,
+        "ir_load_seconds": round(ir_load_seconds, 6),
+        "peak_memory_bytes": peak,
+    }
+
+
+def execute(engine: str, program, input: str) -> str:
+    # Run a program on one of the --run engines, returning what it printed.
+    output = io.StringIO()
+    if engine == "python":
+        pygen.run(pygen.compile_program(program), io.StringIO(input), output)
+    else:
+        hot_loop = vm.HOT_LOOP if engine == "tiered" else None
+        vm.run(vm.compile_program(program), io.StringIO(input), output, hot_loop)
+    return output.getvalue()
+
+
+def run_engines(name: str, size: int, repeat: int) -> Dict[str, object]:
+    # Time running a loop on each engine. They have to print the same.
+    source, input = LOOPS[name](size)
+    program = TreeParser(RegexLexer(source)).program()
+    result: Dict[str, object] = {"benchmark": name, "size": size}
+    outputs = set()
+    for engine in ["vm", "tiered", "python"]:
+        seconds, output = best_time(lambda: execute(engine, program, input), repeat)
+        result[f"{engine}_seconds"] = round(seconds, 6)
+        outputs.add(output)
+    if len(outputs) != 1:
+        raise AssertionError(f"the engines disagree on {name}")
+    return result
+
+
+def report_engines(names: List[str], size: int, repeat: int) -> None:
+    print(f"{'benchmark':<14} {'vm s':>9} {'tiered s':>9} {'python s':>9} {'speedup':>8}")
+    for name in names or LOOPS:
+        result = run_engines(name, size, repeat)
+        print(
+            f"{name:<14} {result['vm_seconds']:>9.4f} {result['tiered_seconds']:>9.4f} "
+            f"{result['python_seconds']:>9.4f} {result['vm_seconds'] / result['tiered_seconds']:>7.2f}x"
+        )
+
+
+# Results #
+
+
+def previous_results(path: str, version: str) -> Dict[tuple, Dict[str, object]]:
+    # The last result recorded for each benchmark and size by a different version of the compiler.
+    previous = {}
+    if not os.path.exists(path):
+        return previous
+    with open(path, "r") as results_file:
+        for line in results_file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if result.get("version") != version:
+                previous[(result.get("benchmark"), result.get("size"))] = result
+    return previous
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argument_parser = argparse.ArgumentParser(description="Benchmark the Teeny Tiny compiler.")
+    argument_parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"which to run, of {', '.join(PROGRAMS)}, or with --engines {', '.join(LOOPS)} (default: all)",
+    )
+    argument_parser.add_argument("--size", type=int, default=20000, help="statements in each program")
+    argument_parser.add_argument("--repeat", type=int, default=3, help="runs to take the best time of")
+    argument_parser.add_argument("--seed", type=int, default=0, help="random seed for the programs")
+    argument_parser.add_argument("--results", default=RESULTS, help="file to append results to")
+    argument_parser.add_argument(
+        "--threshold", type=float, default=0.10, help="report a slowdown bigger than this as a regression"
+    )
+    argument_parser.add_argument(
+        "--engines",
+        action="store_true",
+        help="time running long loops on the bytecode interpreter, the tiered one and as Python, "
+        "instead of timing the compiler",
+    )
+    arguments = argument_parser.parse_args(argv)
+    for name in arguments.benchmarks:
+        if name not in (LOOPS if arguments.engines else PROGRAMS):
+            argument_parser.error(f"unknown benchmark {name}")
+    if arguments.engines:
+        report_engines(arguments.benchmarks, arguments.size, arguments.repeat)
+        return 0
+
+    version = cache.compiler_version()[:12]
+    previous = previous_results(arguments.results, version)
+    regressions = 0
+    print(
+        f"{'benchmark':<12} {'tokens':>9} {'lex s':>9} {'parse s':>9} {'emit s':>9} {'tokens/s':>10} "
+        f"{'peak MB':>8} {'IR/source':>9} {'IR load s':>9}"
+    )
+    with open(arguments.results, "a") as results_file:
+        for name in arguments.benchmarks or PROGRAMS:
+            result = run(name, arguments.size, arguments.repeat, arguments.seed)
+            result.update(version=version, python=sys.version.split()[0], time=int(time.time()))
+            results_file.write(json.dumps(result) + "\n")
+            print(
+                f"{name:<12} {result['tokens']:>9} {result['lex_seconds']:>9.4f} {result['parse_seconds']:>9.4f} "
+                f"{result['emit_seconds']:>9.4f} {result['tokens_per_second']:>10} "
+                f"{result['peak_memory_bytes'] / 1e6:>8.1f} {result['ir_bytes'] / result['source_bytes']:>9.2f} "
+                f"{result['ir_load_seconds']:>9.4f}"
+            )
+            old = previous.get((name, arguments.size))
+            if old is None:
+                continue
+            for phase in ["lex_seconds", "parse_seconds", "emit_seconds", "ir_load_seconds"]:
+                # Results from before a phase was timed don't have it.
+                ratio = result[phase] / old[phase] if old.get(phase) else 1.0
+                if ratio > 1 + arguments.threshold:
+                    regressions += 1
+                    print(f"  regression: {phase} is {ratio:.2f}x version {old['version']}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
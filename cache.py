@@ -0,0 +1,127 @@
+""" An on-disk cache of generated C, so unchanged programs aren't compiled again.
+
+Entries are addressed by a hash of the source, the options it was compiled with and the compiler
+itself, so editing any of the three misses the cache rather than giving stale output. The cache is
+kept under a size limit by deleting the least recently used entries; a hit touches the entry's
+modification time, which is what "recently used" goes by.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import List, Optional
+
+# Where the cache lives, unless TEENY_TINY_CACHE says otherwise.
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "teenytiny")
+MAX_SIZE = 64 * 1024 * 1024  # Bytes of generated C to keep before evicting.
+
+# The modules that decide what C comes out. Changing any of them changes every key.
+COMPILER_MODULES = [
+    "lex.py", "parse.py", "nodes.py", "codegen.py", "emit.py", "optimize.py", "semantics.py", "ir.py", "compiler.py"
+]
+
+_compiler_version: Optional[str] = None
+
+
+def compiler_version() -> str:
+    # A hash of the compiler's own source, computed once per run.
+    global _compiler_version
+    if _compiler_version is None:
+        digest = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in COMPILER_MODULES:
+            with open(os.path.join(directory, name), "rb") as module_file:
+                digest.update(name.encode() + b"\0" + module_file.read() + b"\0")
+        _compiler_version = digest.hexdigest()
+    return _compiler_version
+
+
+def key(source_path: str, options: List[str]) -> str:
+    # The cache key for compiling a source file with the given options.
+    digest = hashlib.sha256()
+    digest.update(compiler_version().encode() + b"\0")
+    digest.update("\0".join(options).encode() + b"\0\0")
+    with open(source_path, "rb") as source_file:
+        for chunk in iter(lambda: source_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Cache:
+    """ A directory of generated C files named by their keys. """
+
+    def __init__(self, directory: Optional[str] = None, max_size: int = MAX_SIZE):
+        if directory is None:
+            directory = os.environ.get("TEENY_TINY_CACHE", DEFAULT_DIRECTORY)
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".c")
+
+    def fetch(self, key: str, output_path: str) -> bool:
+        # Copy the cached C for a key to output_path. Returns False on a miss.
+        path = self.path(key)
+        try:
+            shutil.copyfile(path, output_path)
+        except FileNotFoundError:
+            return False
+        # Mark it as recently used. It may have just been evicted by another process.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def store(self, key: str, output_path: str) -> None:
+        # Save the C at output_path under a key, then evict old entries if over the limit.
+        # The cache is only a shortcut, so if it can't be written to the compile still succeeds.
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            handle, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        except OSError:
+            return
+        # Copy to a temporary file and rename it into place, so a reader never sees half an entry.
+        try:
+            with open(handle, "wb") as temporary_file, open(output_path, "rb") as output_file:
+                shutil.copyfileobj(output_file, temporary_file)
+            os.replace(temporary_path, self.path(key))
+        except BaseException as error:
+            try:
+                os.unlink(temporary_path)
+            except OSError:
+                pass
+            if isinstance(error, OSError):
+                return
+            raise
+        self.evict()
+
+    def evict(self) -> None:
+        # Delete the least recently used entries until the cache fits in max_size. Like store, this
+        # never fails: an entry that can't be looked at or deleted is left for next time.
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    if not entry.name.endswith(".c"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        except OSError:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass  # Another process evicted it first.
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,496 @@
+from typing import AbstractSet, List, Optional
+
+import nodes
+from emit import Emitter
+from lex import TokenType
+from optimize import is_long_safe
+
+# The runtime --buffered-io puts before main(). PRINT writes to a big buffer instead of calling
+# printf, formatting numbers itself where it can do so exactly, and INPUT reads numbers with getc
+# instead of scanf. The output is flushed before every INPUT, so prompts still show up in time, and
+# at the end.
+BUFFERED_IO = r"""
+#include <ctype.h>
+#include <float.h>
+#include <stdlib.h>
+#include <string.h>
+
+static char tt_out[1 << 16];
+static size_t tt_used;
+
+static void tt_flush(void) {
+    if (tt_used) {
+        fwrite(tt_out, 1, tt_used, stdout);
+        fflush(stdout);
+        tt_used = 0;
+    }
+}
+
+static void tt_write(const char *text, size_t length) {
+    if (length > sizeof tt_out - tt_used) {
+        tt_flush();
+        if (length > sizeof tt_out) {
+            fwrite(text, 1, length, stdout);
+            return;
+        }
+    }
+    memcpy(tt_out + tt_used, text, length);
+    tt_used += length;
+}
+
+#define tt_puts(text) tt_write(text, sizeof text - 1)
+
+/* printf("%.2f\n", value). A float has a 24 bit mantissa, so value * 100 is exact as a double, and
+   below 2**53 it can be rounded to a whole number of hundredths the way printf does: to nearest,
+   ties to even. Anything bigger, infinite or NaN goes to snprintf. */
+static void tt_print(float value) {
+    char text[64];
+    char *end = text + sizeof text, *start = end;
+    double scaled = (double)value * 100;
+    if (scaled > -9007199254740992.0 && scaled < 9007199254740992.0) {
+        int negative = value < 0 || (value == 0 && 1 / value < 0); /* -0.0 too, without math.h. */
+        double magnitude = negative ? -scaled : scaled;
+        unsigned long long hundredths = (unsigned long long)magnitude;
+        double fraction = magnitude - (double)hundredths;
+        if (fraction > 0.5 || (fraction == 0.5 && (hundredths & 1))) {
+            hundredths++;
+        }
+        *--start = '\n';
+        *--start = (char)('0' + hundredths % 10);
+        *--start = (char)('0' + hundredths / 10 % 10);
+        *--start = '.';
+        hundredths /= 100;
+        do {
+            *--start = (char)('0' + hundredths % 10);
+            hundredths /= 10;
+        } while (hundredths);
+        if (negative) {
+            *--start = '-';
+        }
+        tt_write(start, (size_t)(end - start));
+    } else {
+        tt_write(text, (size_t)snprintf(text, sizeof text, "%.2f\n", value));
+    }
+}
+
+/* Input is read a character at a time, without locking stdin for each one where POSIX allows. */
+#ifdef _POSIX_C_SOURCE
+#define tt_getc() getc_unlocked(stdin)
+#else
+#define tt_getc() getc(stdin)
+#endif
+
+/* The characters of the number being read. */
+static char *tt_text;
+static size_t tt_length, tt_capacity;
+
+static int tt_keep(int c) {
+    /* Add a character to the number, and read the next. */
+    if (tt_length + 1 >= tt_capacity) {
+        tt_capacity = tt_capacity ? 2 * tt_capacity : 64;
+        tt_text = realloc(tt_text, tt_capacity);
+        if (!tt_text) {
+            abort();
+        }
+    }
+    tt_text[tt_length++] = (char)c;
+    return tt_getc();
+}
+
+/* strtof(tt_text), as scanf would convert it. Where the digits make a whole number of at most 2**24
+   and the power of ten is at most 10**10, both are exact as floats and a single float multiplication
+   or division rounds the result correctly (Clinger's fast path), which is much quicker. */
+static float tt_convert(void) {
+#if FLT_EVAL_METHOD == 0
+    static const float powers[] = {1e0f, 1e1f, 1e2f, 1e3f, 1e4f, 1e5f, 1e6f, 1e7f, 1e8f, 1e9f, 1e10f};
+    const char *p = tt_text;
+    unsigned long mantissa = 0;
+    int negative = 0, scale = 0, exponent = 0, exponent_negative = 0;
+    float value;
+    if (*p == '+' || *p == '-') {
+        negative = *p++ == '-';
+    }
+    if (!(isdigit((unsigned char)*p) || *p == '.') || (p[0] == '0' && tolower((unsigned char)p[1]) == 'x')) {
+        return strtof(tt_text, NULL);
+    }
+    for (; isdigit((unsigned char)*p) || *p == '.'; p++) {
+        if (*p == '.') {
+            scale = 1;
+        } else if (mantissa > (1ul << 24) / 10) {
+            return strtof(tt_text, NULL);
+        } else {
+            mantissa = mantissa * 10 + (unsigned long)(*p - '0');
+            exponent -= scale;
+        }
+    }
+    if (mantissa > (1ul << 24)) {
+        return strtof(tt_text, NULL);
+    }
+    if (*p) {
+        /* The exponent. */
+        int written = 0;
+        p++;
+        if (*p == '+' || *p == '-') {
+            exponent_negative = *p++ == '-';
+        }
+        for (; *p; p++) {
+            if (written > 100) {
+                return strtof(tt_text, NULL);
+            }
+            written = written * 10 + (*p - '0');
+        }
+        exponent += exponent_negative ? -written : written;
+    }
+    if (exponent < -10 || exponent > 10) {
+        return strtof(tt_text, NULL);
+    }
+    value = exponent < 0 ? (float)mantissa / powers[-exponent] : (float)mantissa * powers[exponent];
+    return negative ? -value : value;
+#else
+    return strtof(tt_text, NULL);
+#endif
+}
+
+/* scanf("%f", variable). Like scanf, it reads the longest run of characters that could still start
+   a number, even if it then turns out not to be one: "1e+x" reads as 1 and loses the "e+". Returns
+   EOF at the end of the input, 0 if there's no number and 1 if there is. */
+static int tt_scan(float *variable) {
+    size_t count = 0, mark;
+    int c, hexadecimal = 0, point = 0;
+    tt_flush();
+    do {
+        c = tt_getc();
+    } while (c != EOF && isspace(c));
+    if (c == EOF) {
+        return EOF;
+    }
+    tt_length = 0;
+    if (c == '+' || c == '-') {
+        c = tt_keep(c);
+    }
+    if (tolower(c) == 'i' || tolower(c) == 'n') {
+        const char *word = tolower(c) == 'i' ? "infinity" : "nan";
+        while (word[count] && tolower(c) == word[count]) {
+            c = tt_keep(c);
+            count++;
+        }
+        if (c != EOF) {
+            ungetc(c, stdin);
+        }
+        if (count != 3 && count != 8) {
+            return 0;
+        }
+    } else {
+        if (c == '0') {
+            c = tt_keep(c);
+            count = 1;
+            if (tolower(c) == 'x') {
+                c = tt_keep(c);
+                hexadecimal = 1;
+                count = 0;
+            }
+        }
+        while (hexadecimal ? isxdigit(c) : isdigit(c)) {
+            c = tt_keep(c);
+            count++;
+        }
+        if (c == '.') {
+            c = tt_keep(c);
+            point = 1;
+            while (hexadecimal ? isxdigit(c) : isdigit(c)) {
+                c = tt_keep(c);
+                count++;
+            }
+        }
+        if (count) {
+            /* An exponent without digits isn't part of the number, though it's still read. */
+            mark = tt_length;
+            if (tolower(c) == (hexadecimal ? 'p' : 'e')) {
+                c = tt_keep(c);
+                if (c == '+' || c == '-') {
+                    c = tt_keep(c);
+                }
+                if (!isdigit(c)) {
+                    tt_length = mark;
+                }
+                while (isdigit(c)) {
+                    c = tt_keep(c);
+                }
+            }
+        }
+        if (c != EOF) {
+            ungetc(c, stdin);
+        }
+        /* glibc takes "0x." as a zero, but not "0x". */
+        if (!count && !(hexadecimal && point)) {
+            return 0;
+        }
+    }
+    tt_text[tt_length] = 0;
+    *variable = tt_convert();
+    return 1;
+}
+
+/* scanf("%*s"): skip whitespace, then everything up to the next whitespace. */
+static void tt_skip(void) {
+    int c;
+    do {
+        c = tt_getc();
+    } while (c != EOF && isspace(c));
+    while (c != EOF && !isspace(c)) {
+        c = tt_getc();
+    }
+    if (c != EOF) {
+        ungetc(c, stdin);
+    }
+}
+"""
+
+
+# The runtime --instrument puts before main(). Each statement adds one to its counter as it runs,
+# and each WHILE loop adds the processor time spent in it, from clock(), each time it runs from its
+# WHILE to its end. A pass that GOTO enters or leaves partway is missed, or if it comes back in by
+# GOTO, counted from the WHILE it last started at. When main returns, the counts and times are
+# written to the file named by TT_PROFILE, or out.profile, for report.py. Building with
+# -DTT_NO_CLOCK leaves the clock out and keeps only the counts.
+INSTRUMENT = r"""
+#include <stdlib.h>
+#include <time.h>
+
+#ifdef TT_NO_CLOCK
+#define tt_start(loop)
+#define tt_stop(loop)
+#else
+/* main's variables can shadow clock, but not this. */
+static clock_t tt_clock(void) {
+    return clock();
+}
+
+/* A GOTO into a loop reaches its end without having started its clock, so only a running one stops. */
+#define tt_start(loop) (tt_started[loop] = tt_clock(), tt_running[loop] = 1)
+#define tt_stop(loop) \
+    (tt_running[loop] ? (tt_clocks[loop] += tt_clock() - tt_started[loop], tt_running[loop] = 0) : 0)
+#endif
+
+/* A line "statement LINE COUNT" for each statement and "loop LINE SECONDS" for each loop. */
+static void tt_profile(const unsigned long *lines, const unsigned long long *counts, size_t statements,
+                       const unsigned long *loop_lines, const clock_t *clocks, size_t loops) {
+    const char *path = getenv("TT_PROFILE");
+    FILE *file;
+    size_t i;
+    if (!path || !*path) {
+        path = "out.profile";
+    }
+    file = fopen(path, "w");
+    if (!file) {
+        perror(path);
+        return;
+    }
+    fputs("teeny tiny profile 1\n", file);
+    for (i = 0; i < statements; i++) {
+        fprintf(file, "statement %lu %llu\n", lines[i], counts[i]);
+    }
+#ifndef TT_NO_CLOCK
+    for (i = 0; i < loops; i++) {
+        fprintf(file, "loop %lu %.6f\n", loop_lines[i], (double)clocks[i] / CLOCKS_PER_SEC);
+    }
+#else
+    (void)loop_lines;
+    (void)clocks;
+    (void)loops;
+#endif
+    fclose(file);
+}
+"""
+
+
+class CGenerator:
+    """ Walks the syntax tree built by parse.TreeParser and emits C through an Emitter.
+
+    The output is the same, byte for byte, as what Parser emits while parsing, unless it's given
+    variables to declare as `long` (see optimize.integer_variables) or asked for buffered I/O or
+    instrumentation.
+    """
+
+    def __init__(
+        self,
+        emitter: Emitter,
+        integers: AbstractSet[str] = frozenset(),
+        buffered_io: bool = False,
+        instrument: bool = False,
+    ):
+        self.emitter = emitter
+        self.symbols = set()  # Variables declared so far.
+        self.integers = integers  # Variables to declare as long rather than float.
+        self.buffered_io = buffered_io  # Use the BUFFERED_IO runtime rather than printf and scanf.
+        self.instrument = instrument  # Count statements and time loops with the INSTRUMENT runtime.
+        self.lines: List[int] = []  # The source line of each statement counted, by counter.
+        self.loop_lines: List[int] = []  # The source line of each loop timed, by loop number.
+
+    def program(self, program: nodes.Program) -> None:
+        # Emit initial boilerplate.
+        self.emitter.header_line("#include <stdio.h>")
+        if self.buffered_io:
+            for line in BUFFERED_IO.splitlines()[1:]:
+                self.emitter.header_line(line)
+        if self.instrument:
+            for line in INSTRUMENT.splitlines()[1:]:
+                self.emitter.header_line(line)
+        self.emitter.header_line("int main (void) {")
+
+        self.block(program.statements)
+
+        # Emit the ending bits.
+        if self.buffered_io:
+            self.emitter.emit_line("tt_flush();")
+        if self.instrument:
+            self.profile()
+        self.emitter.emit_line("return 0;")
+        self.emitter.emit_line("}")
+
+    def profile(self) -> None:
+        # Declare the counters and loop clocks, now that all of them are known, and write them out.
+        # C has no empty arrays, so there's always at least one element.
+        statements = len(self.lines)
+        loops = len(self.loop_lines)
+        for name, lines in [("tt_lines", self.lines), ("tt_loop_lines", self.loop_lines)]:
+            self.emitter.header_line(f"static const unsigned long {name}[] = {{")
+            for start in range(0, len(lines), 16):
+                self.emitter.header_line(", ".join(str(line) for line in lines[start : start + 16]) + ",")
+            if not lines:
+                self.emitter.header_line("0")
+            self.emitter.header_line("};")
+        self.emitter.header_line(f"static unsigned long long tt_counts[{max(statements, 1)}];")
+        self.emitter.header_line(f"static clock_t tt_clocks[{max(loops, 1)}];")
+        self.emitter.header_line("#ifndef TT_NO_CLOCK")
+        self.emitter.header_line(f"static clock_t tt_started[{max(loops, 1)}];")
+        self.emitter.header_line(f"static unsigned char tt_running[{max(loops, 1)}];")
+        self.emitter.header_line("#endif")
+        self.emitter.emit_line(f"tt_profile(tt_lines, tt_counts, {statements}, tt_loop_lines, tt_clocks, {loops});")
+
+    def count(self, node: nodes.Node) -> None:
+        # Count a statement each time it runs.
+        if self.instrument:
+            self.emitter.emit_line(f"tt_counts[{len(self.lines)}]++;")
+            self.lines.append(node.line)
+
+    def block(self, statements) -> None:
+        # The bodies of IFs and WHILEs are walked with a stack of iterators rather than by recursion,
+        # so blocks can nest as deeply as the parser allows.
+        stack = [iter(statements)]
+        loops: List[Optional[int]] = [None]  # The number of the loop each block is timed as, if it is.
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                stack.pop()
+                loop = loops.pop()
+                if stack:
+                    self.emitter.emit_line("}")
+                if loop is not None:
+                    self.emitter.emit_line(f"tt_stop({loop});")
+            elif isinstance(node, nodes.If):
+                self.count(node)
+                self.emitter.emit_line(f"if ({self.comparison(node.comparison)}) {{")
+                stack.append(iter(node.body))
+                loops.append(None)
+            elif isinstance(node, nodes.While):
+                self.count(node)
+                loop = None
+                if self.instrument:
+                    loop = len(self.loop_lines)
+                    self.loop_lines.append(node.line)
+                    self.emitter.emit_line(f"tt_start({loop});")
+                self.emitter.emit_line(f"while ({self.comparison(node.comparison)}) {{")
+                stack.append(iter(node.body))
+                loops.append(loop)
+            else:
+                if not isinstance(node, nodes.Label):
+                    self.count(node)
+                self.statement(node)
+
+    def declare(self, name: str) -> None:
+        # If the variable doesn't already exist, declare it.
+        if name not in self.symbols:
+            self.symbols.add(name)
+            self.emitter.header_line(f"{'long' if name in self.integers else 'float'} {name};")
+
+    def statement(self, node: nodes.Node) -> None:
+        # A statement without a body. IFs and WHILEs are block's, which keeps its own stack of them.
+        if isinstance(node, nodes.Print):
+            if isinstance(node.value, str):
+                # Simple string.
+                if self.buffered_io:
+                    self.emitter.emit_line(f'tt_puts("{node.value}\\n");')
+                else:
+                    self.emitter.emit_line(f'printf("{node.value}\\n");')
+            elif self.buffered_io:
+                self.emitter.emit_line(f"tt_print((float)({self.expression(node.value)}));")
+            else:
+                # Emit the result as a float.
+                self.emitter.emit_line(f'printf("%.2f\\n", (float)({self.expression(node.value)}));')
+
+        elif isinstance(node, nodes.Label):
+            self.emitter.emit_line(f"{node.name}:")
+            # Counted after the label, so that jumping to it counts too.
+            self.count(node)
+
+        elif isinstance(node, nodes.Goto):
+            self.emitter.emit_line(f"goto {node.name};")
+
+        elif isinstance(node, nodes.Let):
+            self.declare(node.name)
+            self.emitter.emit_line(f"{node.name} = {self.expression(node.expression)};")
+
+        elif isinstance(node, nodes.Input):
+            self.declare(node.name)
+            # Emit `scanf` but also validate the input.
+            # If invalid, set the variable to 0 and clear the input.
+            if self.buffered_io:
+                self.emitter.emit_line(f"if(0 == tt_scan(&{node.name})) {{")
+                self.emitter.emit_line(f"{node.name} = 0;")
+                self.emitter.emit_line("tt_skip();")
+            else:
+                self.emitter.emit_line(f'if(0 == scanf("%f", &{node.name})) {{')
+                self.emitter.emit_line(f"{node.name} = 0;")
+                self.emitter.emit_line('scanf("%*s");')
+            self.emitter.emit_line("}")
+
+        else:
+            raise TypeError(f"Not a statement without a body: {node!r}")
+
+    # Expressions are turned into strings rather than emitted piece by piece.
+
+    def comparison(self, node: nodes.Comparison) -> str:
+        return self.join(node, self.expression)
+
+    def expression(self, node: nodes.Expression) -> str:
+        return self.join(node, self.term)
+
+    def term(self, node: nodes.Term) -> str:
+        if self.integers and not is_long_safe(node, self.integers):
+            # Work it out in floats, as if the long variables were the floats they stand in for.
+            return self.join(node, self.float_unary)
+        return self.join(node, self.unary)
+
+    def unary(self, node: nodes.Unary) -> str:
+        if node.primary.kind == TokenType.IDENT:
+            # Only declared already unless optimization removed the statements that assigned it.
+            self.declare(node.primary.text)
+        if node.operator is None:
+            return node.primary.text
+        return node.operator + node.primary.text
+
+    def float_unary(self, node: nodes.Unary) -> str:
+        if node.primary.kind == TokenType.IDENT and node.primary.text in self.integers:
+            self.declare(node.primary.text)
+            return (node.operator or "") + "(float)" + node.primary.text
+        return self.unary(node)
+
+    @staticmethod
+    def join(node, operand_code) -> str:
+        # Interleave the operands' code with the operators between them.
+        parts = [operand_code(node.operands[0])]
+        for operator, operand in zip(node.operators, node.operands[1:]):
+            parts.append(operator)
+            parts.append(operand_code(operand))
+        return "".join(parts)
@@ -0,0 +1,98 @@
+""" The compiler as a library.
+
+    import compiler
+    try:
+        result = compiler.compile_string(source, compiler.Options(optimize=2))
+    except compiler.CompileError as error:
+        print(f"{error.line}:{error.column}: {error}")
+    else:
+        print(result.code)
+
+Nothing here exits or touches the file system, so one process can compile as many programs as it
+likes without paying for a fresh interpreter each time.
+"""
+import io
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+import nodes
+import stats
+from codegen import CGenerator
+from emit import Emitter
+from errors import CompileError, LexerError, ParserError
+from lex import Lexer, RegexLexer
+from optimize import integer_variables, optimize
+from parse import Parser, TreeParser
+
+__all__ = ["CompileError", "LexerError", "ParserError", "Options", "Result", "compile_string", "generate", "generate_program"]
+
+
+@dataclass(frozen=True)
+class Options:
+    """ How to compile, as the command line options of the same names. """
+
+    optimize: int = 0  # -O: 1 folds constants, 2 also removes dead code, 3 optimizes loops.
+    ast: bool = False  # --ast: generate C from a syntax tree. Implied by optimizing.
+    stats: bool = False  # --stats: time and count the phases of the compile (see stats.py).
+    int_vars: bool = False  # --int-vars: declare variables proven to hold only small integers as long.
+    buffered_io: bool = False  # --buffered-io: PRINT and INPUT through a buffered runtime.
+    instrument: bool = False  # --instrument: count each statement and time each loop as it runs.
+
+    @property
+    def use_tree(self) -> bool:
+        return self.ast or self.optimize > 0 or self.int_vars or self.buffered_io or self.instrument
+
+
+@dataclass
+class Result:
+    """ What compiling a program produced. """
+
+    code: str  # The C program.
+    stats: Optional[Dict[str, Any]] = None  # The stats.Recorder report, if asked for.
+
+
+def compile_string(source: str, options: Options = Options()) -> Result:
+    # Compile Teeny Tiny source to C. Raises CompileError if the program is invalid.
+    recorder = stats.Recorder() if options.stats or stats.subscribed() else None
+    emitter = Emitter(None)
+    generate(RegexLexer(source), emitter, options, recorder)
+    output = io.StringIO()
+    if recorder is None:
+        emitter.write_to(output)
+        return Result(output.getvalue())
+    with recorder.phase("write"):
+        emitter.write_to(output)
+    code = output.getvalue()
+    recorder.bytes_emitted = len(code.encode())
+    return Result(code, recorder.finish())
+
+
+def generate(lexer: Lexer, emitter: Emitter, options: Options, recorder: Optional[stats.Recorder] = None) -> None:
+    # Parse the tokens from a lexer and emit the C for them, recording each phase if given a recorder.
+    if recorder is not None:
+        # Always build the tree, to have something to count. The C is the same either way.
+        lexer = recorder.lexer(lexer)
+        with recorder.phase("parse"):
+            program = TreeParser(lexer).program()
+        generate_program(program, emitter, options, recorder)
+    elif options.use_tree:
+        generate_program(TreeParser(lexer).program(), emitter, options)
+    else:
+        Parser(lexer, emitter).program()
+
+
+def generate_program(
+    program: nodes.Program, emitter: Emitter, options: Options, recorder: Optional[stats.Recorder] = None
+) -> None:
+    # Emit the C for a program that's already been parsed, such as one read back with ir.load.
+    if recorder is None:
+        program = optimize(program, options.optimize)
+        integers = integer_variables(program) if options.int_vars else frozenset()
+        CGenerator(emitter, integers, options.buffered_io, options.instrument).program(program)
+        return
+    recorder.program(program)
+    with recorder.phase("optimize"):
+        program = optimize(program, options.optimize)
+        integers = integer_variables(program) if options.int_vars else frozenset()
+    with recorder.phase("generate"):
+        CGenerator(emitter, integers, options.buffered_io, options.instrument).program(program)
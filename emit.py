@@ -1,27 +1,46 @@
+import shutil
+import tempfile
+from typing import IO, List, Optional
+
+# Generated code is kept in memory up to this many characters, then spilled to a temporary file.
+SPOOL_SIZE = 16 * 1024 * 1024
+
+
 class Emitter:
     """ The Emitter object keeps track of the generated code and outputs it.
         A helper class for appending strings together.
+
+        Fragments are appended to a spooled temporary file instead of being concatenated onto a
+        string, so emitting is linear in the size of the output and large programs spill to disk
+        rather than being held in memory twice.
     """
 
-    def __init__(self, full_path):
-        self.full_path: str = full_path  # The path to write the resulting C code
-        self.header: str = ""  # Things to prepend to the code later on
-        self.code: str = ""  # The C code to emit
+    def __init__(self, full_path: Optional[str]):
+        self.full_path = full_path  # The path to write the resulting C code, if writing to a file
+        self.header: List[str] = []  # Things to prepend to the code later on
+        self.code = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, mode="w+")  # The C code to emit
 
     def emit_code(self, code: str) -> None:
         # Add a fragment of C code
-        self.code += code
+        self.code.write(code)
 
     def emit_line(self, code: str) -> None:
         # Add a fragment of C code that ends a line
-        self.code += code + "\n"
+        self.code.write(code)
+        self.code.write("\n")
 
     def header_line(self, code) -> None:
         # Add a line of C code to the top of the C code file
-        self.header += code + "\n"
+        self.header.append(code + "\n")
 
     def write(self) -> None:
-        # Write out the resulting C code to a file
+        # Write out the resulting C code to a file.
         with open(self.full_path, "w") as output_file:
-            output_file.write(self.header + self.code)
+            self.write_to(output_file)
 
+    def write_to(self, output_file: IO[str]) -> None:
+        # Write out the resulting C code to an open file, streaming the code after the header.
+        output_file.writelines(self.header)
+        self.code.seek(0)
+        shutil.copyfileobj(self.code, output_file)
+        self.code.close()
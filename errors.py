@@ -0,0 +1,31 @@
+""" The errors the compiler reports, as exceptions.
+
+Printing one gives the message the compiler has always exited with, so the command line prints
+exactly what it did before. A program embedding the compiler catches CompileError instead, and
+gets where in the source the problem is from `line` and `column` (both counted from 1).
+"""
+
+
+class CompileError(Exception):
+    """ Something wrong with the Teeny Tiny program being compiled. """
+
+    prefix = "Error."
+
+    def __init__(self, message: str, line: int = 0, column: int = 0):
+        super().__init__(message)
+        self.message = message
+        self.line = line
+        self.column = column
+
+    def __str__(self) -> str:
+        return f"{self.prefix} {self.message}"
+
+
+class LexerError(CompileError):
+    """ A character or token the lexer doesn't recognise. """
+
+    prefix = "Lexing error."
+
+
+class ParserError(CompileError):
+    """ Tokens that don't follow the grammar, or GOTOs and LABELs that don't match up. """
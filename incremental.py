@@ -0,0 +1,278 @@
+""" Incremental compilation, for editors that recompile after every keystroke.
+
+The program is split into chunks, one per top-level statement: a PRINT, LET and so on, or a whole
+IF or WHILE block down to its ENDIF or ENDWHILE. Each chunk keeps its syntax tree and the C
+generated for it. When the source changes, only the chunks overlapping the changed lines are
+lexed, parsed and generated again, and the C for the program is pieced back together from the
+chunks' C.
+
+Some checks span the whole program: variables assigned before they are read, labels declared once,
+and GOTOs to declared labels. Each chunk keeps a summary of the names it reads, assigns, declares
+and jumps to, and the checks run over those summaries. When an edit leaves the summaries the same,
+as most edits inside an expression do, the checks are skipped too.
+
+If anything is wrong with the program, the whole thing is compiled again to report the same error,
+at the same place, that compiling it from scratch would.
+"""
+import bisect
+import operator
+import re
+from typing import Iterable, List, Optional, Set, Tuple
+
+import compiler
+import nodes
+from codegen import CGenerator
+from emit import Emitter
+from errors import CompileError
+from lex import RegexLexer, TokenType
+from optimize import fold_block, walk
+from parse import TreeParser
+
+# The first word on a line, if the line has a token at all.
+_FIRST_WORD = re.compile(r"[ \t\r]*(?:(#.*)|([A-Za-z][A-Za-z0-9]*))?")
+_OPENS = {"IF", "WHILE"}
+_CLOSES = {"ENDIF", "ENDWHILE"}
+
+HEADER = "#include <stdio.h>\nint main (void) {\n"
+FOOTER = "return 0;\n}\n"
+
+
+class ChunkParser(TreeParser):
+    """ A TreeParser for one chunk, which leaves the checks that span chunks to the caller.
+
+    Reads of variables the chunk hasn't assigned are recorded in `needs` instead of being errors,
+    and GOTOs to labels outside the chunk are allowed.
+    """
+
+    def __init__(self, lexer):
+        super().__init__(lexer)
+        self.needs = {}  # Variables read before the chunk assigns them, in order (a dict as an ordered set).
+
+    def chunk(self) -> List[nodes.Node]:
+        while self.is_token(TokenType.NEWLINE):
+            self.next_token()
+        statements = []
+        while not self.is_token(TokenType.EOF):
+            statements.append(self.statement())
+        return statements
+
+    def primary(self) -> nodes.Primary:
+        if self.is_token(TokenType.IDENT) and self.current_token.text not in self.symbols:
+            self.needs[self.current_token.text] = None
+            node = nodes.Primary(TokenType.IDENT, self.current_token.text)
+            self.next_token()
+            return node
+        return super().primary()
+
+
+class Chunk:
+    """ A run of source lines holding one top-level statement, and everything compiled from it. """
+
+    __slots__ = ("text", "valid", "code", "needs", "assigns", "labels", "gotos", "declares")
+
+    def __init__(self, text: str, level: int):
+        self.text = text
+        self.valid = True
+        self.code = ""  # The C for the chunk's statements.
+        self.needs: Tuple[str, ...] = ()  # Variables it reads before assigning them.
+        self.assigns: Set[str] = set()  # Variables it assigns with LET or INPUT.
+        self.labels: Tuple[str, ...] = ()  # Labels it declares.
+        self.gotos: Set[str] = set()  # Labels it jumps to.
+        self.declares: Tuple[str, ...] = ()  # Variables in the order CGenerator declares them.
+        try:
+            parser = ChunkParser(RegexLexer(text))
+            statements = parser.chunk()
+        except CompileError:
+            self.valid = False
+            return
+        if level >= 1:
+            statements = fold_block(statements)
+        emitter = Emitter(None)
+        generator = CGenerator(emitter)
+        generator.block(statements)
+        emitter.code.seek(0)
+        self.code = emitter.code.read()
+        emitter.code.close()
+        self.needs = tuple(parser.needs)
+        self.assigns = parser.symbols
+        self.labels = tuple(node.name for node in walk(statements) if isinstance(node, nodes.Label))
+        self.gotos = parser.labels_gone_to
+        self.declares = tuple(line[len("float ") : -len(";\n")] for line in emitter.header)
+
+    def summary(self):
+        # What the checks across chunks and the declarations depend on.
+        return self.needs, self.assigns, self.labels, self.gotos, self.declares
+
+
+class IncrementalCompiler:
+    """ Compiles successive versions of one program, reusing the work for the unchanged parts.
+
+        incremental = IncrementalCompiler()
+        result = incremental.update(source)  # Compiles all of it.
+        result = incremental.update(edited_source)  # Only what changed.
+
+    Raises CompileError from update() for an invalid program, and keeps up with the source anyway,
+    so the next update is still incremental. Dead code elimination (-O2) and --int-vars need the
+    whole program, so neither is supported, and nor are --buffered-io and --instrument.
+    """
+
+    def __init__(self, options: compiler.Options = compiler.Options()):
+        if options.optimize > 1:
+            raise ValueError("incremental compilation supports -O0 and -O1 only")
+        if options.int_vars:
+            raise ValueError("incremental compilation doesn't support --int-vars")
+        if options.buffered_io:
+            raise ValueError("incremental compilation doesn't support --buffered-io")
+        if options.instrument:
+            raise ValueError("incremental compilation doesn't support --instrument")
+        self.level = options.optimize
+        self.lines: List[str] = []
+        self.starts: List[int] = []  # The first line of each chunk.
+        self.chunks: List[Chunk] = []
+        self.valid = True  # Whether the program passed the checks across chunks.
+        self.declarations = ""  # The variable declarations, as C.
+
+    def update(self, source: str) -> compiler.Result:
+        # Compile a new version of the whole source.
+        lines = source.split("\n")
+        old = self.lines
+        # Find the lines that changed: everything between the common prefix and suffix.
+        prefix = common_prefix(old, lines)
+        limit = min(len(old), len(lines)) - prefix
+        suffix = min(common_prefix(reversed(old), reversed(lines)), limit)
+        return self.edit(prefix, len(old) - suffix, lines[prefix : len(lines) - suffix])
+
+    def edit(self, start: int, end: int, replacement: List[str]) -> compiler.Result:
+        # Replace source lines start up to end (counted from 0) with new ones, and recompile.
+        # The first update has to be through update(), or an edit of an empty program.
+        self.lines[start:end] = replacement
+        shift = len(replacement) - (end - start)
+
+        # Start at the chunk before the one holding the first changed line: blank lines belong to
+        # the chunk before them, so an edit at the start of a chunk can change the one before.
+        first = max(bisect.bisect_right(self.starts, start) - 2, 0)
+        line = self.starts[first] if first > 0 else 0
+
+        # The old chunks after the edit, by where they start now. Chunking stops as soon as it
+        # reaches one of them, since the rest are unchanged.
+        later = bisect.bisect_left(self.starts, end)
+
+        def resume(new_line: int) -> Optional[int]:
+            # The index of the old chunk that now starts at new_line, if there is one.
+            index = bisect.bisect_left(self.starts, new_line - shift, later)
+            if index < len(self.starts) and self.starts[index] == new_line - shift:
+                return index
+            return None
+
+        reused = {chunk.text: chunk for chunk in self.chunks[first:later]}
+        starts, chunks = [], []
+        boundaries = Boundaries(self.lines, line, start + len(replacement), resume)
+        for chunk_start, chunk_end in boundaries:
+            text = "\n".join(self.lines[chunk_start:chunk_end])
+            chunk = reused.get(text)
+            if chunk is None:
+                chunk = Chunk(text, self.level)
+            starts.append(chunk_start)
+            chunks.append(chunk)
+        stop = len(self.chunks) if boundaries.stop_index is None else boundaries.stop_index
+        removed = self.chunks[first:stop]
+        self.chunks[first:stop] = chunks
+        self.starts[first:stop] = starts
+        if shift:
+            moved = first + len(starts)
+            self.starts[moved:] = [chunk_start + shift for chunk_start in self.starts[moved:]]
+
+        # Run the checks across chunks, unless the summaries are the same as before.
+        if not (
+            self.valid
+            and len(removed) == len(chunks)
+            and all(old.valid and new.valid and old.summary() == new.summary() for old, new in zip(removed, chunks))
+        ):
+            self.check()
+        if not self.valid:
+            # Compile from scratch, which raises the error.
+            return compiler.compile_string("\n".join(self.lines), compiler.Options(optimize=self.level))
+        return compiler.Result(
+            HEADER + self.declarations + "".join([chunk.code for chunk in self.chunks]) + FOOTER
+        )
+
+    def check(self) -> None:
+        # Check variables, labels and GOTOs over the whole program, and work out the declarations.
+        self.valid = False
+        assigned = set()
+        labels = set()
+        gotos = set()
+        declared = {}
+        for chunk in self.chunks:
+            if not chunk.valid:
+                return
+            for name in chunk.needs:
+                if name not in assigned:
+                    return
+            assigned |= chunk.assigns
+            for label in chunk.labels:
+                if label in labels:
+                    return
+                labels.add(label)
+            gotos |= chunk.gotos
+            for name in chunk.declares:
+                declared[name] = None
+        if not gotos <= labels:
+            return
+        self.valid = True
+        self.declarations = "".join(f"float {name};\n" for name in declared)
+
+
+class Boundaries:
+    """ Splits lines into chunks, from a chunk start until it meets a chunk from before the edit.
+
+    A chunk starts at a line with a token on it, when no IF or WHILE is open, and runs up to the
+    next one. Iterating gives (start, end) pairs; afterwards, `stop_index` is the index of the old
+    chunk it stopped at, or None if it ran to the end of the program.
+    """
+
+    def __init__(self, lines: List[str], line: int, edited_end: int, resume):
+        self.lines = lines
+        self.line = line
+        self.edited_end = edited_end
+        self.resume = resume
+        self.stop_index: Optional[int] = None
+
+    def __iter__(self):
+        lines = self.lines
+        start = self.line
+        depth = 0
+        has_token = False  # Blank lines at the start of the program join the first chunk.
+        for line in range(self.line, len(lines)):
+            word = first_word(lines[line])
+            if word is not None:
+                if depth == 0 and has_token:
+                    yield start, line
+                    if line >= self.edited_end:
+                        self.stop_index = self.resume(line)
+                        if self.stop_index is not None:
+                            return
+                    start = line
+                has_token = True
+            if word in _OPENS:
+                depth += 1
+            elif word in _CLOSES and depth > 0:
+                depth -= 1
+        yield start, len(lines)
+
+
+def common_prefix(a: Iterable[str], b: Iterable[str]) -> int:
+    # How many lines at the start of a and b are the same. Compares in C, with map().
+    differs = list(map(operator.ne, a, b))
+    try:
+        return differs.index(True)
+    except ValueError:
+        return len(differs)
+
+
+def first_word(line: str) -> Optional[str]:
+    # The first word on a line, "" if it starts with some other token, or None if it has none.
+    match = _FIRST_WORD.match(line)
+    if match.end() == len(line) and match.group(2) is None:
+        return None  # Blank, or a comment.
+    return match.group(2) or ""
@@ -0,0 +1,343 @@
+""" A compact binary form of a parsed program, so it can be used again without lexing and parsing.
+
+    ir.dump(program, "program.ir")
+    program = ir.load("program.ir")  # The same nodes.Program, read with mmap.
+
+The file is a header, four tables of interned text (identifiers, labels, number literals as written
+and PRINT strings) and then the program as one array of 32-bit words, all little endian:
+
+    header   b"TTIR", format version, number of code words
+    table    count, bytes of text; the end offset of each entry; the UTF-8 text, padded to 4 bytes
+    code     the top level statement count, then each statement in order
+
+A statement starts with a word holding its line and opcode. Then come its operands: a table index,
+an expression, or for IF and WHILE the comparison, the number of statements in the body and then
+the body. A comparison is a count of expressions, each a word with its number of unaries and the
+comparison operator before it, and then the unaries. A unary is one word: its table index, whether
+it's an identifier, its sign and the operator before it. The terms and expressions fall out of the
+operators, just as they do when parsing. Blocks are read and written with a stack rather than
+recursion, so nesting depth doesn't matter.
+
+Fitting in those words limits a program to lines numbered below 2**29, 2**25 distinct identifiers
+and 2**25 distinct number literals, and an expression to fewer than 2**28 unaries. dumps raises
+ValueError for a program past any of them.
+"""
+import gc
+import mmap
+import struct
+import sys
+from array import array
+from typing import Dict, List, Optional
+
+import nodes
+from lex import TokenType
+
+MAGIC = b"TTIR"
+VERSION = 1
+HEADER = struct.Struct("<4sII")  # Magic, version, code words.
+TABLE = struct.Struct("<II")  # Entries, bytes of text.
+
+# Statement opcodes, in the low three bits of the statement's first word. The line is the rest.
+PRINT_STRING = 0
+PRINT = 1
+LET = 2
+INPUT = 3
+LABEL = 4
+GOTO = 5
+IF = 6
+WHILE = 7
+
+# The operator before an expression or a unary, in the low four bits of its word. 0 is none.
+OPERATORS = [None, "+", "-", "*", "/", "==", "!=", ">", ">=", "<", "<="]
+OPERATOR_CODES = {operator: code for code, operator in enumerate(OPERATORS)}
+SIGNS = [None, "+", "-"]  # A unary's own operator, in the next two bits.
+SIGN_CODES = {sign: code for code, sign in enumerate(SIGNS)}
+IDENTIFIER = 1 << 6  # Set in a unary whose index is into the identifiers rather than the numbers.
+INDEX_SHIFT = 7
+
+# What fits in the rest of a 32-bit word.
+MAX_LINES = 1 << 29
+MAX_INDEX = 1 << 32 - INDEX_SHIFT  # Of identifiers and of number literals, which unaries index.
+MAX_UNARIES = 1 << 28
+
+# The tables, in file order.
+NAMES = 0
+LABELS = 1
+NUMBERS = 2
+STRINGS = 3
+
+
+def is_ir(path: str) -> bool:
+    # Whether a file is IR rather than Teeny Tiny source.
+    with open(path, "rb") as input_file:
+        return input_file.read(len(MAGIC)) == MAGIC
+
+
+# Writing #
+
+
+class Encoder:
+    """ Turns a program into code words and text tables. """
+
+    def __init__(self):
+        self.words = array("I")
+        self.tables: List[Dict[str, int]] = [{}, {}, {}, {}]
+
+    def intern(self, table: int, text: str) -> int:
+        entries = self.tables[table]
+        index = entries.get(text)
+        if index is None:
+            index = len(entries)
+            if index == MAX_INDEX and table in (NAMES, NUMBERS):
+                kind = "identifiers" if table == NAMES else "number literals"
+                raise ValueError(f"IR holds at most {MAX_INDEX} distinct {kind}")
+            entries[text] = index
+        return index
+
+    def program(self, program: nodes.Program) -> None:
+        words = self.words
+        words.append(len(program.statements))
+        blocks = [iter(program.statements)]
+        while blocks:
+            node = next(blocks[-1], None)
+            if node is None:
+                blocks.pop()
+                continue
+            if node.line >= MAX_LINES:
+                raise ValueError(f"line {node.line}: IR holds at most {MAX_LINES - 1} lines")
+            line = node.line << 3
+            if isinstance(node, nodes.Print):
+                if isinstance(node.value, str):
+                    words.extend((line | PRINT_STRING, self.intern(STRINGS, node.value)))
+                else:
+                    words.append(line | PRINT)
+                    self.expression(node.value, None)
+            elif isinstance(node, nodes.Let):
+                words.extend((line | LET, self.intern(NAMES, node.name)))
+                self.expression(node.expression, None)
+            elif isinstance(node, nodes.Input):
+                words.extend((line | INPUT, self.intern(NAMES, node.name)))
+            elif isinstance(node, nodes.Label):
+                words.extend((line | LABEL, self.intern(LABELS, node.name)))
+            elif isinstance(node, nodes.Goto):
+                words.extend((line | GOTO, self.intern(LABELS, node.name)))
+            elif isinstance(node, (nodes.If, nodes.While)):
+                comparison = node.comparison
+                words.extend((line | (IF if isinstance(node, nodes.If) else WHILE), len(comparison.operands)))
+                for operator, expression in zip([None] + comparison.operators, comparison.operands):
+                    self.expression(expression, operator)
+                words.append(len(node.body))
+                blocks.append(iter(node.body))
+            else:
+                raise TypeError(f"Not a statement: {node!r}")
+
+    def expression(self, node: nodes.Expression, before: Optional[str]) -> None:
+        # An expression, after the comparison operator `before` if it's in a comparison.
+        words = self.words
+        unaries = sum(len(term.operands) for term in node.operands)
+        if unaries >= MAX_UNARIES:
+            raise ValueError(f"IR holds at most {MAX_UNARIES - 1} unaries in an expression")
+        words.append(unaries << 4 | OPERATOR_CODES[before])
+        for term_operator, term in zip([None] + node.operators, node.operands):
+            for operator, unary in zip([term_operator] + term.operators, term.operands):
+                primary = unary.primary
+                if primary.kind == TokenType.IDENT:
+                    word = self.intern(NAMES, primary.text) << INDEX_SHIFT | IDENTIFIER
+                else:
+                    word = self.intern(NUMBERS, primary.text) << INDEX_SHIFT
+                words.append(word | SIGN_CODES[unary.operator] << 4 | OPERATOR_CODES[operator])
+
+
+def dumps(program: nodes.Program) -> bytes:
+    # The program as IR.
+    encoder = Encoder()
+    encoder.program(program)
+    words = encoder.words
+    if sys.byteorder != "little":
+        words.byteswap()
+    parts = [HEADER.pack(MAGIC, VERSION, len(words))]
+    for entries in encoder.tables:
+        texts = [text.encode() for text in entries]
+        ends = array("I")
+        end = 0
+        for text in texts:
+            end += len(text)
+            ends.append(end)
+        if sys.byteorder != "little":
+            ends.byteswap()
+        parts.append(TABLE.pack(len(texts), end))
+        parts.append(ends.tobytes())
+        parts.extend(texts)
+        parts.append(bytes(-end % 4))
+    parts.append(words.tobytes())
+    return b"".join(parts)
+
+
+def dump(program: nodes.Program, path: str) -> None:
+    # Encoded first, so a program too big for IR doesn't leave an empty file behind.
+    data = dumps(program)
+    with open(path, "wb") as output_file:
+        output_file.write(data)
+
+
+# Reading #
+
+
+def load(path: str) -> nodes.Program:
+    # Read a program written by dump, mapping the file rather than reading it.
+    with open(path, "rb") as input_file:
+        if not input_file.read(len(MAGIC)):
+            # mmap can't map an empty file.
+            raise ValueError(f"{path} is not a Teeny Tiny IR file")
+        with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return loads(data)
+
+
+def loads(data) -> nodes.Program:
+    # Decode IR from bytes or anything else with the buffer protocol.
+    with memoryview(data) as view:
+        if len(view) < HEADER.size:
+            raise ValueError("not a Teeny Tiny IR file")
+        magic, version, length = HEADER.unpack_from(view, 0)
+        if magic != MAGIC:
+            raise ValueError("not a Teeny Tiny IR file")
+        if version != VERSION:
+            raise ValueError(f"IR format version {version}, expected {VERSION}")
+        position = HEADER.size
+        tables = []
+        for _ in range(4):
+            if position + TABLE.size > len(view):
+                raise ValueError("truncated Teeny Tiny IR file")
+            count, size = TABLE.unpack_from(view, position)
+            position += TABLE.size
+            ends = words_at(view, position, count, "I")
+            position += count * 4
+            if position + size > len(view):
+                raise ValueError("truncated Teeny Tiny IR file")
+            text = view[position : position + size]
+            tables.append([str(text[start:end], "utf-8") for start, end in zip([0] + ends, ends)])
+            text.release()
+            position += size + -size % 4
+        words = words_at(view, position, length, "I")
+    # The tree has no cycles for the garbage collector to find, and it would otherwise spend most of
+    # the load looking through the nodes as they're made.
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return Decoder(words, tables).program()
+    except IndexError:
+        raise ValueError("corrupt Teeny Tiny IR file") from None
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def words_at(view: memoryview, position: int, count: int, code: str) -> List[int]:
+    # `count` 32-bit little endian words from a buffer, as a list.
+    if position + count * 4 > len(view):
+        raise ValueError("truncated Teeny Tiny IR file")
+    with view[position : position + count * 4] as raw:
+        if sys.byteorder == "little":
+            with raw.cast(code) as words:
+                return words.tolist()
+        swapped = array(code, raw)
+        swapped.byteswap()
+        return swapped.tolist()
+
+
+class Decoder:
+    """ Builds the nodes back up from the code words. """
+
+    def __init__(self, words: List[int], tables: List[List[str]]):
+        self.words = words
+        self.names, self.labels, self.numbers, self.strings = tables
+        self.position = 0
+        # Unaries are never changed once made, so equal ones can be the same node.
+        self.unaries: Dict[int, nodes.Unary] = {}
+
+    def program(self) -> nodes.Program:
+        words = self.words
+        names = self.names
+        labels = self.labels
+        statements: List[nodes.Node] = []
+        # Each open block, with how many of its statements are still to come.
+        blocks = [[statements, words[0]]]
+        self.position = 1
+        while blocks:
+            block = blocks[-1]
+            if not block[1]:
+                blocks.pop()
+                continue
+            block[1] -= 1
+            position = self.position
+            word = words[position]
+            opcode, line = word & 7, word >> 3
+            if opcode == PRINT:
+                self.position = position + 1
+                block[0].append(nodes.Print(self.expression(), line))
+            elif opcode == IF or opcode == WHILE:
+                self.position = position + 2
+                operands = []
+                operators = []
+                for _ in range(words[position + 1]):
+                    operators.append(OPERATORS[words[self.position] & 15])
+                    operands.append(self.expression())
+                comparison = nodes.Comparison(operands, operators[1:])
+                body: List[nodes.Node] = []
+                node_class = nodes.If if opcode == IF else nodes.While
+                block[0].append(node_class(comparison, body, line))
+                blocks.append([body, words[self.position]])
+                self.position += 1
+            else:
+                # The rest have a table index.
+                index = words[position + 1]
+                self.position = position + 2
+                if opcode == LET:
+                    block[0].append(nodes.Let(names[index], self.expression(), line))
+                elif opcode == PRINT_STRING:
+                    block[0].append(nodes.Print(self.strings[index], line))
+                elif opcode == INPUT:
+                    block[0].append(nodes.Input(names[index], line))
+                elif opcode == LABEL:
+                    block[0].append(nodes.Label(labels[index], line))
+                else:
+                    block[0].append(nodes.Goto(labels[index], line))
+        return nodes.Program(statements)
+
+    def expression(self) -> nodes.Expression:
+        # Group the unaries into terms by the operators between them, like parse.Parser.expression.
+        words = self.words
+        position = self.position
+        count = words[position] >> 4
+        self.position = position + 1 + count
+        cache = self.unaries
+        terms = []
+        operators = []
+        unaries = []
+        term_operators = []
+        for word in words[position + 1 : position + 1 + count]:
+            unary = cache.get(word >> 4)
+            if unary is None:
+                unary = cache[word >> 4] = self.unary(word)
+            operator = word & 15
+            if operator >= 3:
+                # * or /.
+                unaries.append(unary)
+                term_operators.append(OPERATORS[operator])
+            elif operator:
+                terms.append(nodes.Term(unaries, term_operators))
+                operators.append(OPERATORS[operator])
+                unaries = [unary]
+                term_operators = []
+            else:
+                unaries.append(unary)
+        terms.append(nodes.Term(unaries, term_operators))
+        return nodes.Expression(terms, operators)
+
+    def unary(self, word: int) -> nodes.Unary:
+        index = word >> INDEX_SHIFT
+        if word & IDENTIFIER:
+            primary = nodes.Primary(TokenType.IDENT, self.names[index])
+        else:
+            primary = nodes.Primary(TokenType.NUMBER, self.numbers[index])
+        return nodes.Unary(SIGNS[word >> 4 & 3], primary)
@@ -1,5 +1,15 @@
+import collections
 import enum
+import itertools
+import locale
+import os
+import re
 import sys
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import IO, Iterator, List, Optional, Tuple
+
+from errors import LexerError
 
 
 class Lexer:
@@ -12,8 +22,19 @@ class Lexer:
         self.current_char = ""
         # Current position in the string.
         self.current_position = -1
+        # Current line number and the position that line starts at, for token line/column.
+        self.line = 1
+        self.line_start = 0
         self.next_char()
 
+    def __iter__(self) -> Iterator['Token']:
+        # Lazily yield tokens up to and including EOF.
+        while True:
+            token = self.get_token()
+            yield token
+            if token.kind == TokenType.EOF:
+                return
+
     def next_char(self):
         # Process the next character.
         self.current_position += 1
@@ -29,8 +50,8 @@ class Lexer:
         return self.source[self.current_position + 1]
 
     def abort(self, message):
-        # Invalid token found, print error message and exit.
-        sys.exit(f"Lexing error. {message}")
+        # Invalid token found, report where it is.
+        raise LexerError(message, self.line, self.current_position - self.line_start + 1)
 
     def skip_whitespace(self):
         # Skip whitespace except newlines, which we will use to indicate the end of a statement.
@@ -47,6 +68,8 @@ class Lexer:
         # Return the next token.
         self.skip_whitespace()
         self.skip_comment()
+        line = self.line
+        column = self.current_position - self.line_start + 1
 
         # Check the first character of this token to see if we can decide what it is.
         # If it is a multiple character operator (e.g., `!=`), number, identifier, or keyword, then we process the rest.
@@ -145,15 +168,225 @@ class Lexer:
                 self.abort("Expected !=, got !" + self.peek())
         elif self.current_char == "\n":
             token = Token(self.current_char, TokenType.NEWLINE)
+            self.line += 1
+            self.line_start = self.current_position + 1
         elif self.current_char == "\0":
             token = Token(self.current_char, TokenType.EOF)
         else:
             # Unknown token!
             self.abort(f"Unknown token: {self.current_char}")
+        token.line = line
+        token.column = column
         self.next_char()
         return token
 
 
+class RegexLexer(Lexer):
+    """ A drop-in replacement for Lexer that recognizes a whole token with one compiled pattern.
+
+    Lexer walks the source a character at a time, which dominates compile time on large programs.
+    This one matches the leading whitespace, an optional comment and the token itself in a single
+    `re.match` call. Anything the pattern doesn't cover (errors, non-ASCII text, `\0`) falls back
+    to Lexer.get_token from the same position, so the token stream and error messages are identical.
+    """
+
+    def get_token(self) -> 'Token':
+        # Return the next token.
+        position = self.current_position
+        if position >= self.len:
+            self.current_position = position + 1
+            self.current_char = "\0"
+            return Token("\0", TokenType.EOF, self.line, position - self.line_start + 1)
+        match = _TOKEN_PATTERN.match(self.source, position)
+        if match is None:
+            # Let the character-at-a-time lexer deal with it (and report any errors).
+            self.current_char = self.source[position]
+            return super().get_token()
+        # current_char is only needed by the slow path, which sets it itself.
+        end = match.end()
+        self.current_position = end
+        kind = match.lastgroup
+        token_text = match.group(kind)
+        line = self.line
+        column = match.start(kind) - self.line_start + 1
+        if kind == "OP":
+            if token_text == "\n":
+                self.line = line + 1
+                self.line_start = end
+            return Token(token_text, _OPERATORS[token_text], line, column)
+        if kind == "IDENT":
+            return Token(token_text, _KEYWORDS.get(token_text, TokenType.IDENT), line, column)
+        if kind == "STRING":
+            # The column of the opening quote.
+            column -= 1
+        return Token(token_text, _LITERALS[kind], line, column)
+
+
+class StreamLexer(RegexLexer):
+    """ A RegexLexer that reads its source from a file object one line at a time.
+
+    No token spans a line (strings may not contain newlines and comments stop at one), so the
+    source buffer only ever holds the current line and memory stays flat however big the input is.
+    The token stream is the same as lexing `input_file.read()` with Lexer.
+    """
+
+    def __init__(self, input_file: IO[str]):
+        super().__init__("")
+        self.input_file = input_file
+        # Start with an empty buffer so the first get_token reads the first line.
+        self.source = ""
+        self.len = 0
+        self.current_position = 0
+
+    def get_token(self) -> 'Token':
+        # Return the next token, reading another line once the current one is used up.
+        while self.current_position >= self.len and self.input_file is not None:
+            line = self.input_file.readline()
+            if not line.endswith("\n"):
+                # Last line. Append a newline like Lexer does with the whole source.
+                line += "\n"
+                self.input_file = None
+            self.source = line
+            self.len = len(line)
+            self.current_position = 0
+            self.line_start = 0
+        return super().get_token()
+
+
+class ParallelLexer:
+    """ Lexes a source file in line-aligned chunks on a pool of processes, for very large programs.
+
+    No token spans a line (see StreamLexer), so the file is cut after a newline every `chunk_size`
+    bytes and each chunk is read and lexed by a worker on its own. The tokens come back in order with
+    their line numbers moved on by the lines before the chunk. A lexing error is only raised once the
+    tokens before it have been handed out, so the parser sees exactly what StreamLexer would give it.
+    On a free-threaded build the workers are threads, which don't have to send the tokens back.
+
+        with ParallelLexer(path) as lexer:
+            program = TreeParser(lexer).program()
+    """
+
+    def __init__(self, path: str, jobs: Optional[int] = None, chunk_size: int = 1 << 22):
+        self.path = path
+        # The workers decode the bytes themselves, as open() would.
+        self.encoding = locale.getpreferredencoding(False)
+        self.chunks = collections.deque(_chunk_ranges(path, chunk_size))
+        jobs = jobs or os.cpu_count() or 1
+        self.executor = None
+        if jobs > 1 and len(self.chunks) > 1:
+            if getattr(sys, "_is_gil_enabled", lambda: True)():
+                self.executor = ProcessPoolExecutor(jobs)
+            else:
+                self.executor = ThreadPoolExecutor(jobs)
+        # Chunks being lexed. Only a few are queued ahead, so memory doesn't grow with the file.
+        self.lookahead = 2 * jobs
+        self.pending: collections.deque[Future] = collections.deque()
+        # Handing out tokens is the part that doesn't run in parallel, so get_token goes straight
+        # to the C iterators and Python only runs between chunks.
+        self.get_token = itertools.chain.from_iterable(self.chunk_tokens()).__next__
+
+    def __enter__(self) -> 'ParallelLexer':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # Stop the workers, dropping chunks nobody is going to read.
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def __iter__(self) -> Iterator['Token']:
+        # Lazily yield tokens up to and including EOF.
+        while True:
+            token = self.get_token()
+            yield token
+            if token.kind == TokenType.EOF:
+                return
+
+    def chunk_tokens(self) -> Iterator[Iterator['Token']]:
+        # Each chunk's tokens in turn, with their lines numbered from the start of the file.
+        lines = 0
+        while self.chunks or self.pending:
+            texts, kinds, chunk_lines, columns, line_count, error = self.next_chunk()
+            offset = lines
+            lines += line_count
+            # Make each Token as the parser asks for it. Making them all up front costs twice as much,
+            # mostly in the garbage collector going over the ones already made.
+            yield map(Token, texts, map(_KINDS.__getitem__, kinds), map(offset.__add__, chunk_lines), columns)
+            if error is not None:
+                message, line, column = error
+                raise LexerError(message, line + offset, column)
+        # Only the last chunk ends with EOF. Keep handing it out, as the other lexers do.
+        self.close()
+        yield itertools.repeat(Token(texts[-1], TokenType.EOF, chunk_lines[-1] + offset, columns[-1]))
+
+    def next_chunk(self):
+        # The next chunk's result from _lex_chunk, keeping the workers a few chunks ahead.
+        if self.executor is None:
+            return _lex_chunk(self.path, *self.chunks.popleft(), self.encoding)
+        while self.chunks and len(self.pending) < self.lookahead:
+            chunk = self.chunks.popleft()
+            self.pending.append(self.executor.submit(_lex_chunk, self.path, *chunk, self.encoding))
+        return self.pending.popleft().result()
+
+
+def _chunk_ranges(path: str, chunk_size: int) -> List[Tuple[int, int, bool]]:
+    # Cut the file into (start, end, last) byte ranges, each but the last ending just after a newline.
+    # A newline byte is never part of a longer character in UTF-8 or a single byte encoding.
+    size = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, "rb") as input_file:
+        while size - start > chunk_size:
+            input_file.seek(start + chunk_size - 1)
+            input_file.readline()
+            end = input_file.tell()
+            if end >= size:
+                break
+            ranges.append((start, end, False))
+            start = end
+    ranges.append((start, size, True))
+    return ranges
+
+
+def _lex_chunk(path: str, start: int, end: int, last: bool, encoding: str):
+    # Lex one chunk of a file in a worker. Returns the tokens as flat lists, which are much cheaper to
+    # send between processes than Tokens, with lines counted from the start of the chunk, the number
+    # of lines in the chunk, and (message, line, column) if lexing stopped with an error.
+    with open(path, "rb") as input_file:
+        input_file.seek(start)
+        source = input_file.read(end - start).decode(encoding)
+    if "\r" in source:
+        # Translate line endings like reading the file in text mode does.
+        source = source.replace("\r\n", "\n").replace("\r", "\n")
+    line_count = source.count("\n")
+    if not last:
+        # The lexer adds the newline back, and the next chunk carries on from the following line.
+        source = source[:-1]
+    lexer = RegexLexer(source)
+    texts: List[str] = []
+    kinds = array("h")
+    lines = array("l")
+    columns = array("l")
+    error = None
+    try:
+        while True:
+            token = lexer.get_token()
+            if token.kind is TokenType.EOF and not last:
+                break
+            texts.append(token.text)
+            kinds.append(token.kind.value)
+            lines.append(token.line)
+            columns.append(token.column)
+            if token.kind is TokenType.EOF:
+                break
+    except LexerError as exception:
+        error = (exception.message, exception.line, exception.column)
+    return texts, kinds, lines, columns, line_count, error
+
+
 class TokenType(enum.Enum):
     EOF = -1
     NEWLINE = 0
@@ -188,17 +421,62 @@ class TokenType(enum.Enum):
 
 class Token:
     # Contains the original text and the types of token
-    def __init__(self, text: str, kind: TokenType):
+    # Slots keep tokens small, there's one for every word and operator in the source.
+    __slots__ = ("text", "kind", "line", "column")
+
+    def __init__(self, text: str, kind: TokenType, line: int = 0, column: int = 0):
         # The token's actual text. Used for identifiers, strings, and numbers.
         self.text = text
         # The TokenType that this token is classified as.
         self.kind = kind
+        # Where the token starts in the source, both counting from 1.
+        self.line = line
+        self.column = column
 
     @staticmethod
     def check_if_keyword(text: str):
-        for kind in TokenType:
-            # Relies on all keyword enum values being 1XX.
-            # if kind.name == text and kind.value >= 100 and kind.value < 200:
-            if kind.name == text and (100 <= kind.value < 200):
-                return kind
-        return None
+        # Look the text up in the keyword table. Returns None for identifiers.
+        return _KEYWORDS.get(text)
+
+
+# Keyword text to token type. Relies on all keyword enum values being 1XX.
+_KEYWORDS = {kind.name: kind for kind in TokenType if 100 <= kind.value < 200}
+
+# Token type values to token types, for ParallelLexer.
+_KINDS = {kind.value: kind for kind in TokenType}
+
+_LITERALS = {"NUMBER": TokenType.NUMBER, "STRING": TokenType.STRING}
+
+# Operator (and newline) text to token type, for RegexLexer.
+_OPERATORS = {
+    "\n": TokenType.NEWLINE,
+    "+": TokenType.PLUS,
+    "-": TokenType.MINUS,
+    "*": TokenType.ASTERISK,
+    "/": TokenType.SLASH,
+    "=": TokenType.EQ,
+    "==": TokenType.EQEQ,
+    "!=": TokenType.NOTEQ,
+    "<": TokenType.LT,
+    "<=": TokenType.LTEQ,
+    ">": TokenType.GT,
+    ">=": TokenType.GTEQ,
+}
+
+# Whitespace, an optional comment and then exactly one token. The pattern is ASCII-only and refuses
+# to end a number or identifier right before a non-ASCII character, since str.isdigit()/isalnum()
+# (which Lexer uses) accept more than the ASCII classes; those cases go through the slow path.
+# The (?![0-9]) guards stop the digit runs from backtracking into a shorter match.
+_TOKEN_PATTERN = re.compile(
+    r"""
+    [ \t\r]*
+    (?:\#[^\n]*)?
+    (?:
+        (?P<OP>\n|==|!=|<=|>=|[-+*/=<>])
+      | "(?P<STRING>[^"\r\n\t\\%]*)"
+      | (?P<NUMBER>[0-9]+(?![0-9])(?:\.[0-9]+(?![0-9])|(?!\.))(?![^\x00-\x7f]))
+      | (?P<IDENT>[A-Za-z][A-Za-z0-9]*(?![A-Za-z0-9]|[^\x00-\x7f]))
+    )
+    """,
+    re.VERBOSE,
+)
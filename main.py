@@ -1,23 +1,361 @@
+import argparse
+import cProfile
+import json
+import os
+import pstats
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
 
+import cache
+import compiler
+import ir
+import nodes
+import pygen
+import server
+import stats
+import vm
 from emit import Emitter
-from lex import Lexer
-from parse import Parser
+from errors import CompileError
+from lex import Lexer, ParallelLexer, StreamLexer
+from optimize import optimize
+from parse import TreeParser
 
 
 def main():
-    if len(sys.argv) != 2:
-        sys.exit("Error: Compiler needs source file as argument.")
-    with open(sys.argv[1], "r") as input_file:
-        input_contents = input_file.read()
-
-    # Initialize the emitter, lexer and parser.
-    emitter = Emitter("out.c")
-    lexer = Lexer(input_contents)
-    parser = Parser(lexer, emitter)
-
-    parser.program()  # Start the parser.
-    emitter.write()  # Write the output to file.
+    try:
+        command(sys.argv[1:])
+    except CompileError as error:
+        sys.exit(str(error))
+
+
+def command(argv: List[str]) -> None:
+    argument_parser = argparse.ArgumentParser(description="Teeny Tiny to C compiler.")
+    argument_parser.add_argument(
+        "source",
+        nargs="*",
+        help="Teeny Tiny source file, or IR written by --emit-ir. Give several, or a directory of .tiny files, "
+        "to compile them all",
+    )
+    argument_parser.add_argument(
+        "--ast",
+        action="store_true",
+        help="build a syntax tree and generate C from it, instead of emitting while parsing",
+    )
+    argument_parser.add_argument(
+        "-O",
+        dest="optimize",
+        type=int,
+        choices=[0, 1, 2, 3],
+        default=0,
+        help="optimization level: 1 folds constants, 2 also removes dead code, 3 also optimizes loops and "
+        "common subexpressions (implies --ast)",
+    )
+    argument_parser.add_argument(
+        "--int-vars",
+        action="store_true",
+        help="declare variables that provably only hold integers within +-2**24 as long, not float, "
+        "which doesn't change the output (implies --ast)",
+    )
+    argument_parser.add_argument(
+        "--buffered-io",
+        action="store_true",
+        help="print and read numbers through a small buffered runtime instead of printf and scanf, "
+        "which is faster for programs with a lot of input or output (implies --ast)",
+    )
+    argument_parser.add_argument(
+        "--instrument",
+        action="store_true",
+        help="count how many times each statement runs and time each WHILE loop, writing the profile to "
+        "out.profile (or $TT_PROFILE) when the program ends. See report.py (implies --ast)",
+    )
+    argument_parser.add_argument(
+        "--run",
+        action="store_true",
+        help="run the program on a built-in bytecode interpreter instead of writing C",
+    )
+    argument_parser.add_argument(
+        "--engine",
+        choices=["vm", "tiered", "python"],
+        default="vm",
+        help="what --run runs the program on: the bytecode interpreter, the interpreter translating loops "
+        "to Python once they have run a while, or the whole program translated to Python",
+    )
+    argument_parser.add_argument(
+        "--emit-ir",
+        metavar="FILE",
+        help="write the parsed program to FILE as compact binary IR instead of writing C. Give FILE as the "
+        "source to compile or --run it again without parsing (see ir.py)",
+    )
+    argument_parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="always compile, instead of reusing C generated for the same source and options",
+    )
+    argument_parser.add_argument(
+        "-j",
+        dest="jobs",
+        type=int,
+        help="compile in batch mode, or serve, with this many processes (default: one per CPU)",
+    )
+    argument_parser.add_argument(
+        "--lex-jobs",
+        type=int,
+        metavar="N",
+        help="lex the source in chunks on N processes (0 for one per CPU), for very large programs",
+    )
+    argument_parser.add_argument(
+        "--out-dir",
+        help="in batch mode, write each NAME.tiny to NAME.c here rather than next to the source",
+    )
+    argument_parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="run as a compile server, answering JSON requests a line at a time (see server.py)",
+    )
+    argument_parser.add_argument(
+        "--socket",
+        help="with --serve, listen on this Unix socket instead of reading standard input",
+    )
+    argument_parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print JSON with the time taken by each phase and counts of what went through it",
+    )
+    argument_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="like --stats, and also list the functions the compiler spent the most time in",
+    )
+    arguments = argument_parser.parse_args(argv)
+    if arguments.serve:
+        server.serve(arguments.socket, arguments.jobs)
+        return
+    if not arguments.source:
+        argument_parser.error("the following arguments are required: source")
+    options = compiler.Options(
+        optimize=arguments.optimize,
+        ast=arguments.ast or arguments.run,
+        int_vars=arguments.int_vars,
+        buffered_io=arguments.buffered_io,
+        instrument=arguments.instrument,
+    )
+
+    # One file compiles to out.c as it always has. More than one, or asking for batch mode
+    # options, compiles each to its own .c file.
+    single = (
+        len(arguments.source) == 1
+        and not os.path.isdir(arguments.source[0])
+        and arguments.jobs is None
+        and arguments.out_dir is None
+    )
+    if not single:
+        if (
+            arguments.run
+            or arguments.stats
+            or arguments.profile
+            or arguments.lex_jobs is not None
+            or arguments.emit_ir is not None
+        ):
+            argument_parser.error("--run, --stats, --profile, --lex-jobs and --emit-ir take a single source file")
+        sources = find_sources(arguments.source)
+        outputs = output_paths(sources, arguments.out_dir)
+        if len(set(outputs)) < len(outputs):
+            argument_parser.error("two sources would be written to the same .c file")
+        if arguments.out_dir is not None:
+            os.makedirs(arguments.out_dir, exist_ok=True)
+        failures = compile_batch(sources, outputs, arguments.jobs, options, arguments.cache)
+        sys.exit(1 if failures else 0)
+    source = arguments.source[0]
+
+    if arguments.emit_ir is not None:
+        try:
+            ir.dump(read_program(source, arguments.lex_jobs), arguments.emit_ir)
+        except ValueError as error:
+            sys.exit(str(error))
+        return
+    if arguments.run:
+        program = optimize(read_program(source, arguments.lex_jobs), arguments.optimize)
+        try:
+            if arguments.engine == "python":
+                pygen.run(pygen.compile_program(program))
+            else:
+                hot_loop = vm.HOT_LOOP if arguments.engine == "tiered" else None
+                vm.run(vm.compile_program(program), hot_loop=hot_loop)
+        except ZeroDivisionError as error:
+            sys.exit(f"Runtime error. {error}")
+        return
+    if arguments.stats or arguments.profile:
+        # Measure a real compile, not a copy from the cache.
+        recorder = stats.Recorder()
+        if arguments.profile:
+            profiler = cProfile.Profile()
+            profiler.runcall(compile_file, source, "out.c", options, False, recorder, arguments.lex_jobs)
+        else:
+            compile_file(source, "out.c", options, False, recorder, arguments.lex_jobs)
+        report = {"source": source, **recorder.finish()}
+        if arguments.profile:
+            report["functions"] = hot_functions(profiler)
+        print(json.dumps(report, indent=2))
+        return
+    compile_file(source, "out.c", options, arguments.cache, lex_jobs=arguments.lex_jobs)
+
+
+def compile_file(
+    source: str,
+    output: str,
+    options: compiler.Options,
+    use_cache: bool,
+    recorder: Optional[stats.Recorder] = None,
+    lex_jobs: Optional[int] = None,
+) -> None:
+    # Compile one source file to C. Raises CompileError if the program is invalid.
+
+    # Reuse the C from an earlier compile of the same source, with the same options and compiler.
+    if use_cache:
+        compile_cache = cache.Cache()
+        key = cache.key(
+            source,
+            [
+                f"ast={options.use_tree}",
+                f"O={options.optimize}",
+                f"int_vars={options.int_vars}",
+                f"buffered_io={options.buffered_io}",
+                f"instrument={options.instrument}",
+            ],
+        )
+        if compile_cache.fetch(key, output):
+            return
+
+    # Initialize the emitter, and compile.
+    emitter = Emitter(output)
+    if ir.is_ir(source):
+        # Already parsed.
+        if recorder is None:
+            compiler.generate_program(ir.load(source), emitter, options)
+        else:
+            with recorder.phase("load"):
+                program = ir.load(source)
+            compiler.generate_program(program, emitter, options, recorder)
+    else:
+        with source_lexer(source, lex_jobs) as lexer:
+            compiler.generate(lexer, emitter, options, recorder)
+    if recorder is None:
+        emitter.write()  # Write the output to file.
+    else:
+        with recorder.phase("write"):
+            emitter.write()
+        recorder.bytes_emitted = os.path.getsize(output)
+    if use_cache:
+        compile_cache.store(key, output)
+
+
+@contextmanager
+def source_lexer(source: str, lex_jobs: Optional[int]) -> Iterator[Lexer]:
+    # A lexer for a source file: streaming it a line at a time, or with --lex-jobs lexing it in chunks
+    # on a pool of processes. Either way the file has to stay open, or the pool running, while parsing.
+    if lex_jobs is None:
+        with open(source, "r") as input_file:
+            yield StreamLexer(input_file)
+    else:
+        with ParallelLexer(source, lex_jobs or None) as lexer:
+            yield lexer
+
+
+def read_program(source: str, lex_jobs: Optional[int]) -> nodes.Program:
+    # The syntax tree of a source file, read straight from the file if it's IR.
+    if ir.is_ir(source):
+        return ir.load(source)
+    with source_lexer(source, lex_jobs) as lexer:
+        return TreeParser(lexer).program()
+
+
+def hot_functions(profiler: cProfile.Profile, count: int = 20) -> List[dict]:
+    # The functions that took the most time, not counting the functions they called.
+    entries = pstats.Stats(profiler).stats
+    rows = sorted(entries.items(), key=lambda item: item[1][2], reverse=True)[:count]
+    return [
+        {
+            "function": f"{os.path.basename(filename)}:{line}({name})",
+            "calls": calls,
+            "own_seconds": round(own, 6),
+            "cumulative_seconds": round(cumulative, 6),
+        }
+        for (filename, line, name), (_, calls, own, cumulative, _) in rows
+    ]
+
+
+# Batch mode #
+
+
+def find_sources(paths: List[str]) -> List[str]:
+    # The files to compile: each path given, with directories replaced by the .tiny files in them.
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            sources.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".tiny")
+            )
+        else:
+            sources.append(path)
+    return sources
+
+
+def output_paths(sources: List[str], out_dir: Optional[str]) -> List[str]:
+    # Where each source's C goes: NAME.c, in out_dir or next to NAME.tiny.
+    outputs = []
+    for source in sources:
+        name = os.path.splitext(os.path.basename(source))[0] + ".c"
+        directory = out_dir if out_dir is not None else os.path.dirname(source)
+        outputs.append(os.path.join(directory, name))
+    return outputs
+
+
+def compile_batch(
+    sources: List[str], outputs: List[str], jobs: Optional[int], options: compiler.Options, use_cache: bool
+) -> int:
+    # Compile every source in a pool of processes, report each failure and the overall throughput,
+    # and return how many failed.
+    start = time.perf_counter()
+    failures = 0
+    # Hand each worker several files at a time, rather than one round trip per file.
+    chunk_size = max(1, len(sources) // ((jobs or os.cpu_count() or 1) * 4))
+    count = len(sources)
+    with ProcessPoolExecutor(jobs) as executor:
+        results = executor.map(
+            compile_one,
+            sources,
+            outputs,
+            [options] * count,
+            [use_cache] * count,
+            chunksize=chunk_size,
+        )
+        for source, error in zip(sources, results):
+            if error is not None:
+                failures += 1
+                print(f"{source}: {error}", file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Compiled {count - failures} of {count} files in {elapsed:.2f}s ({count / elapsed:.1f} files/s).",
+        file=sys.stderr,
+    )
+    return failures
+
+
+def compile_one(source: str, output: str, options: compiler.Options, use_cache: bool) -> Optional[str]:
+    # Compile a file in a worker process. Returns the error message, instead of exiting, if it fails.
+    try:
+        compile_file(source, output, options, use_cache)
+    except CompileError as error:
+        return str(error)
+    except OSError as error:
+        return str(error)
+    except ValueError as error:  # Including UnicodeDecodeError, for a source that isn't UTF-8.
+        return str(error)
+    return None
 
 
 if __name__ == "__main__":
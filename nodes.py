@@ -0,0 +1,149 @@
+from typing import List, Optional, Union
+
+from lex import TokenType
+
+
+class Node:
+    """ Base class for the nodes of the abstract syntax tree built by parse.TreeParser.
+
+    There's one node class per production in the grammar (see parse.Parser). Nodes use __slots__
+    to stay small; every slot is a field, so equality and repr are defined over them.
+    """
+
+    __slots__ = ()
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+# Expressions #
+
+
+class Primary(Node):
+    # primary ::= number | ident
+    __slots__ = ("kind", "text")
+
+    def __init__(self, kind: TokenType, text: str):
+        self.kind = kind  # TokenType.NUMBER or TokenType.IDENT
+        self.text = text  # The number as written, or the variable name
+
+
+class Unary(Node):
+    # unary ::= ["+" | "-"] primary
+    __slots__ = ("operator", "primary")
+
+    def __init__(self, operator: Optional[str], primary: Primary):
+        self.operator = operator  # "+", "-" or None
+        self.primary = primary
+
+
+class Term(Node):
+    # term ::= unary {( "/" | "*" ) unary}
+    __slots__ = ("operands", "operators")
+
+    def __init__(self, operands: List[Unary], operators: List[str]):
+        # operators[i] sits between operands[i] and operands[i + 1].
+        self.operands = operands
+        self.operators = operators
+
+
+class Expression(Node):
+    # expression ::= term {( "-" | "+" ) term}
+    __slots__ = ("operands", "operators")
+
+    def __init__(self, operands: List[Term], operators: List[str]):
+        self.operands = operands
+        self.operators = operators
+
+
+class Comparison(Node):
+    # comparison ::= expression (("==" | "!=" | ">" | ">=" | "<" | "<=") expression)+
+    __slots__ = ("operands", "operators")
+
+    def __init__(self, operands: List[Expression], operators: List[str]):
+        self.operands = operands
+        self.operators = operators
+
+
+# Statements #
+# Each statement records the source line it starts on.
+
+
+class Print(Node):
+    # "PRINT" (expression | string) nl
+    __slots__ = ("value", "line")
+
+    def __init__(self, value: Union[str, Expression], line: int = 0):
+        self.value = value  # The string's text, or an expression
+        self.line = line
+
+
+class If(Node):
+    # "IF" comparison "THEN" nl {statement} "ENDIF" nl
+    __slots__ = ("comparison", "body", "line")
+
+    def __init__(self, comparison: Comparison, body: List[Node], line: int = 0):
+        self.comparison = comparison
+        self.body = body
+        self.line = line
+
+
+class While(Node):
+    # "WHILE" comparison "REPEAT" nl {statement} "ENDWHILE" nl
+    __slots__ = ("comparison", "body", "line")
+
+    def __init__(self, comparison: Comparison, body: List[Node], line: int = 0):
+        self.comparison = comparison
+        self.body = body
+        self.line = line
+
+
+class Label(Node):
+    # "LABEL" ident nl
+    __slots__ = ("name", "line")
+
+    def __init__(self, name: str, line: int = 0):
+        self.name = name
+        self.line = line
+
+
+class Goto(Node):
+    # "GOTO" ident nl
+    __slots__ = ("name", "line")
+
+    def __init__(self, name: str, line: int = 0):
+        self.name = name
+        self.line = line
+
+
+class Let(Node):
+    # "LET" ident "=" expression nl
+    __slots__ = ("name", "expression", "line")
+
+    def __init__(self, name: str, expression: Expression, line: int = 0):
+        self.name = name
+        self.expression = expression
+        self.line = line
+
+
+class Input(Node):
+    # "INPUT" ident nl
+    __slots__ = ("name", "line")
+
+    def __init__(self, name: str, line: int = 0):
+        self.name = name
+        self.line = line
+
+
+class Program(Node):
+    # program ::= {statement}
+    __slots__ = ("statements",)
+
+    def __init__(self, statements: List[Node]):
+        self.statements = statements
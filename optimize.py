@@ -0,0 +1,970 @@
+""" Optimization passes over the syntax tree built by parse.TreeParser.
+
+Passes take a nodes.Program and return a new one, leaving the original alone. Every rewrite has to
+give exactly the same result as the C the tree would otherwise compile to, so arithmetic is done
+with C's types and rounding (see semantics.py) and only left-to-right prefixes of a chain of
+operators are folded, since `x * 2 * 3` is `(x * 2) * 3` and not `x * 6` in floating point.
+"""
+import itertools
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import nodes
+import semantics
+from lex import TokenType
+
+
+def optimize(program: nodes.Program, level: int) -> nodes.Program:
+    # Run the passes for an optimization level (-O). Level 0 leaves the program alone.
+    if level >= 1:
+        program = fold_constants(program)
+    if level >= 2:
+        program = eliminate_dead_code(program)
+    if level >= 3:
+        names = (f"_t{number}" for number in itertools.count(1))
+        program = optimize_loops(program, names)
+        program = eliminate_common_subexpressions(program, names)
+    return program
+
+
+# Constant folding (-O1) #
+
+
+def fold_constants(program: nodes.Program) -> nodes.Program:
+    # Evaluate constant arithmetic and comparisons, and drop `x * 1`, `1 * x`, `x / 1` and `x - 0`.
+    # `x + 0` is kept: if x is -0.0 the sum is 0.0, which prints differently.
+    return nodes.Program(fold_block(program.statements))
+
+
+def fold_block(statements: List[nodes.Node]) -> List[nodes.Node]:
+    # Fold every statement, copying IFs and WHILEs with a stack rather than recursing into them.
+    folded = []
+    stack = [(iter(statements), folded)]
+    while stack:
+        block, copy = stack[-1]
+        node = next(block, None)
+        if node is None:
+            stack.pop()
+        elif isinstance(node, (nodes.If, nodes.While)):
+            inner = type(node)(fold_comparison(node.comparison), [], node.line)
+            copy.append(inner)
+            stack.append((iter(node.body), inner.body))
+        else:
+            copy.append(fold_statement(node))
+    return folded
+
+
+def fold_statement(node: nodes.Node) -> nodes.Node:
+    # Any statement but IF and WHILE, which fold_block takes care of.
+    if isinstance(node, nodes.Print) and isinstance(node.value, nodes.Expression):
+        return nodes.Print(fold_expression(node.value), node.line)
+    if isinstance(node, nodes.Let):
+        return nodes.Let(node.name, fold_expression(node.expression), node.line)
+    return node
+
+
+def fold_comparison(node: nodes.Comparison) -> nodes.Comparison:
+    operands = [fold_expression(operand) for operand in node.operands]
+    operands, operators = fold_prefix(
+        operands, list(node.operators), expression_constant, semantics.compare, constant_expression
+    )
+    return nodes.Comparison(operands, operators)
+
+
+def fold_expression(node: nodes.Expression) -> nodes.Expression:
+    operands = [fold_term(operand) for operand in node.operands]
+    operands, operators = fold_prefix(
+        operands, list(node.operators), term_constant, semantics.arithmetic, constant_term
+    )
+
+    folded_operands = [operands[0]]
+    folded_operators = []
+    for operator, operand in zip(operators, operands[1:]):
+        first = operand.operands[0]
+        if first.operator is not None:
+            # Move a sign at the start of the term into the operator before it: `a - -6 * b` is
+            # `a + 6 * b` exactly, and C would read `a--6*b` as a decrement anyway.
+            if first.operator == "-":
+                operator = "+" if operator == "-" else "-"
+            operand = nodes.Term([nodes.Unary(None, first.primary)] + operand.operands[1:], operand.operators)
+        if operator == "-" and term_constant(operand) == (semantics.INT, 0):
+            continue
+        folded_operators.append(operator)
+        folded_operands.append(operand)
+    return nodes.Expression(folded_operands, folded_operators)
+
+
+def fold_term(node: nodes.Term) -> nodes.Term:
+    operands, operators = fold_prefix(
+        list(node.operands), list(node.operators), constant, semantics.arithmetic, constant_unary
+    )
+
+    # Multiplying or dividing by an int 1 is exact whatever the type of the other side.
+    one = (semantics.INT, 1)
+    if len(operands) > 1 and operators[0] == "*" and constant(operands[0]) == one:
+        operands = operands[1:]
+        operators = operators[1:]
+    folded_operands = [operands[0]]
+    folded_operators = []
+    for operator, operand in zip(operators, operands[1:]):
+        if constant(operand) != one:
+            folded_operators.append(operator)
+            folded_operands.append(operand)
+    return nodes.Term(folded_operands, folded_operators)
+
+
+def fold_prefix(operands, operators, value_of, apply, node_of):
+    # Fold the longest run of constant operands at the start of an operator chain into one.
+    value = value_of(operands[0])
+    if value is None:
+        return operands, operators
+    count = 1
+    while count < len(operands):
+        right = value_of(operands[count])
+        if right is None:
+            break
+        result = apply(operators[count - 1], value, right)
+        if result is None:
+            break
+        value = result
+        count += 1
+    if count == 1:
+        return operands, operators
+    return [node_of(value)] + operands[count:], operators[count - 1 :]
+
+
+# Constants in the tree #
+
+
+def constant(node: nodes.Unary) -> Optional[semantics.Value]:
+    # The value of a unary that's a number, or None.
+    if node.primary.kind != TokenType.NUMBER:
+        return None
+    value = semantics.literal(node.primary.text)
+    if value is not None and node.operator == "-":
+        return semantics.negate(value)
+    return value
+
+
+def term_constant(node: nodes.Term) -> Optional[semantics.Value]:
+    if len(node.operands) == 1:
+        return constant(node.operands[0])
+    return None
+
+
+def expression_constant(node: nodes.Expression) -> Optional[semantics.Value]:
+    if len(node.operands) == 1:
+        return term_constant(node.operands[0])
+    return None
+
+
+def constant_unary(value: semantics.Value) -> nodes.Unary:
+    # A unary that evaluates to the value, as a literal with a minus sign if it needs one.
+    kind, number = value
+    if semantics.is_negative(value):
+        return nodes.Unary("-", nodes.Primary(TokenType.NUMBER, semantics.text((kind, -number))))
+    return nodes.Unary(None, nodes.Primary(TokenType.NUMBER, semantics.text(value)))
+
+
+def constant_term(value: semantics.Value) -> nodes.Term:
+    return nodes.Term([constant_unary(value)], [])
+
+
+def constant_expression(value: semantics.Value) -> nodes.Expression:
+    return nodes.Expression([constant_term(value)], [])
+
+
+# Dead code elimination (-O2) #
+
+
+def eliminate_dead_code(program: nodes.Program) -> nodes.Program:
+    # Remove unreachable statements after a GOTO, labels nobody goes to, IF and WHILE statements
+    # whose (folded) condition is false, and LETs to variables that are never read.
+    # Removing one thing can make another dead, so repeat until nothing changes.
+    statements = program.statements
+    while True:
+        labels = {node.name for node in walk(statements) if isinstance(node, nodes.Goto)}
+        read = set()
+        for node in walk(statements):
+            for expression in expressions(node):
+                read.update(variables(expression))
+        pruned = prune_block(statements, labels, read)
+        # Pruning only ever removes statements, so nothing changed if none were removed.
+        if count(pruned) == count(statements):
+            return nodes.Program(statements)
+        statements = pruned
+
+
+def prune_block(statements: List[nodes.Node], labels: Set[str], read: Set[str]) -> List[nodes.Node]:
+    # Copy the block without the dead statements. Nested blocks are kept on a stack, each with its
+    # copy so far and whether the statement being looked at is reachable.
+    pruned = []
+    stack = [[iter(statements), pruned, True]]
+    while stack:
+        frame = stack[-1]
+        block, copy, reachable = frame
+        node = next(block, None)
+        if node is None:
+            stack.pop()
+            continue
+
+        if not reachable:
+            # Skip statements after a GOTO until one a GOTO could jump to.
+            if not contains_label(node, labels):
+                continue
+            frame[2] = True
+
+        if isinstance(node, nodes.Label) and node.name not in labels:
+            continue
+        if isinstance(node, nodes.Let) and node.name not in read:
+            continue
+        if isinstance(node, (nodes.If, nodes.While)):
+            if is_false(node.comparison) and not contains_label(node, labels):
+                continue
+            inner = type(node)(node.comparison, [], node.line)
+            copy.append(inner)
+            stack.append([iter(node.body), inner.body, True])
+            continue
+        copy.append(node)
+        if isinstance(node, nodes.Goto):
+            frame[2] = False
+    return pruned
+
+
+def is_false(node: nodes.Comparison) -> bool:
+    # True if the comparison is a constant zero.
+    value = expression_constant(node.operands[0]) if len(node.operands) == 1 else None
+    return value is not None and value[1] == 0
+
+
+def contains_label(node: nodes.Node, labels: Set[str]) -> bool:
+    # True if the statement is, or has inside it, one of the labels.
+    return any(isinstance(inner, nodes.Label) and inner.name in labels for inner in walk([node]))
+
+
+# Integer variables (--int-vars) #
+
+# The largest integer a float holds exactly, with every integer below it.
+FLOAT_EXACT = 2 ** 24
+
+
+def integer_variables(program: nodes.Program) -> Set[str]:
+    # The variables that only ever hold integers, which C can keep in a `long` instead of a `float`.
+    # Integer arithmetic gives the same results as float arithmetic on integers as long as every
+    # value stays within +-2**24, so that has to be proven, not assumed.
+    #
+    # A variable qualifies if it is never INPUT and every LET to it is an integer expression: no
+    # division, integer literals within that range, and only variables that qualify too. A float can
+    # also be -0.0, which prints as "-0.00" and a long can't, so nothing that could make one is
+    # allowed either: negating a variable, or multiplying one by anything but positive literals.
+    #
+    # Variables negated anywhere are left as floats too: GCC folds `-(float)a + 0` to `-(float)a`,
+    # since (float)a is never -0.0, which makes -0.0 rather than 0.0 when a is 0.
+    #
+    # Then each needs a bound (see variable_bounds), and everything C works out in integer
+    # arithmetic with it, anywhere in the program, has to stay in range.
+    assigned = {}
+    excluded = set()
+    for node in walk(program.statements):
+        if isinstance(node, nodes.Let):
+            assigned.setdefault(node.name, []).append(node.expression)
+        elif isinstance(node, nodes.Input):
+            excluded.add(node.name)
+        for expression in expressions(node):
+            excluded.update(negated_variables(expression))
+    candidates = set(assigned) - excluded
+    counters = counter_bounds(program)
+    # Drop variables assigned from ones that were dropped, until nothing changes.
+    while True:
+        integers = {
+            name for name in candidates if all(is_integral(expression, candidates) for expression in assigned[name])
+        }
+        bounds = variable_bounds(integers, assigned, counters)
+        integers = set(bounds)
+        for node in walk(program.statements):
+            for expression in expressions(node):
+                operands = expression.operands if isinstance(expression, nodes.Comparison) else [expression]
+                for operand in operands:
+                    if long_range(operand, integers, bounds) is None:
+                        integers -= variables_read(operand)
+        if integers == candidates:
+            return integers
+        candidates = integers
+
+
+def counter_bounds(program: nodes.Program) -> Dict[str, int]:
+    # The variables only ever assigned as the counters of WHILE loops (see find_counter), with the
+    # biggest magnitude each can reach. A loop with a label in it could be jumped into, past its
+    # condition, so those don't count.
+    summaries = summarize(program.statements)
+    blocks = [program.statements]
+    blocks.extend(node.body for node in walk(program.statements) if isinstance(node, (nodes.If, nodes.While)))
+    bounds: Dict[str, int] = {}
+    counting: Dict[str, Set[int]] = {}  # The ids of the LETs that start and step each counter.
+    for block in blocks:
+        for index, node in enumerate(block):
+            if isinstance(node, nodes.While) and not summaries[id(node)][1]:
+                counter = find_counter(block, index, summaries)
+                if counter is not None:
+                    name, _, bound, increment, start = counter
+                    bounds[name] = max(bounds.get(name, 0), bound)
+                    counting.setdefault(name, set()).update((id(increment), id(start)))
+    for node in walk(program.statements):
+        if isinstance(node, (nodes.Let, nodes.Input)) and node.name in bounds and id(node) not in counting[node.name]:
+            del bounds[node.name]
+    return bounds
+
+
+def variable_bounds(
+    integers: Set[str], assigned: Dict[str, List[nodes.Expression]], counters: Dict[str, int]
+) -> Dict[str, int]:
+    # The biggest magnitude each of the variables can hold, for those that can be shown to stay
+    # within +-2**24. A counter is bounded by its loop. Any other variable is bounded by the largest
+    # of the expressions assigned to it, worked out again until none of them grows. Bounds that only
+    # depend on each other settle within a pass per variable, so one still growing after that is
+    # growing by itself, like a running total in a loop, and has no bound.
+    bounds = {name: counters.get(name, 0) for name in integers if counters.get(name, 0) <= FLOAT_EXACT}
+    others = [name for name in bounds if name not in counters]
+    for _ in range(len(others) + 1):
+        growing = set()
+        for name in others:
+            for expression in assigned[name]:
+                bound = long_range(expression, integers, bounds)
+                if bound is None or bound > FLOAT_EXACT:
+                    growing.add(name)
+                    bounds[name] = FLOAT_EXACT + 1
+                elif bound > bounds[name]:
+                    growing.add(name)
+                    bounds[name] = bound
+        if not growing:
+            break
+    return {name: bound for name, bound in bounds.items() if name not in growing and bound <= FLOAT_EXACT}
+
+
+def long_range(node: nodes.Expression, integers: Set[str], bounds: Dict[str, int]) -> Optional[int]:
+    # The biggest magnitude of the integer part of an expression: the terms C works out in integer
+    # arithmetic, up to the first that's a float. None if anything worked out in integer arithmetic
+    # with one of the variables could leave +-2**24, or reads one without a bound.
+    total = 0
+    reads = False
+    summing = True
+    for term in node.operands:
+        integral, bound, term_reads = long_term_range(term, integers, bounds)
+        if bound is None:
+            return None
+        if summing and integral:
+            total += bound
+            reads = reads or term_reads
+            if reads and total > FLOAT_EXACT:
+                return None
+        else:
+            summing = False
+    return total
+
+
+def long_term_range(node: nodes.Term, integers: Set[str], bounds: Dict[str, int]) -> Tuple[bool, Optional[int], bool]:
+    # Whether the term is all integers, the biggest magnitude of its integer part (or None, as for
+    # long_range) and whether that reads one of the variables.
+    if not is_long_safe(node, integers):
+        # The variables are converted to floats, as in a float build.
+        return False, 0, False
+    product = 1
+    reads = False
+    for unary in node.operands:
+        if unary.primary.kind == TokenType.IDENT:
+            if unary.primary.text not in integers:
+                return False, product, reads
+            if unary.primary.text not in bounds:
+                return False, None, True
+            product *= bounds[unary.primary.text]
+            reads = True
+        else:
+            value = semantics.literal(unary.primary.text)
+            if value is None or value[0] == semantics.DOUBLE:
+                return False, product, reads
+            product *= abs(value[1])
+        if reads and product > FLOAT_EXACT:
+            return False, None, True
+    return True, product, reads
+
+
+def variables_read(node: nodes.Expression) -> Set[str]:
+    return {
+        unary.primary.text
+        for term in node.operands
+        for unary in term.operands
+        if unary.primary.kind == TokenType.IDENT
+    }
+
+
+def negated_variables(node: nodes.Node) -> Iterator[str]:
+    # The names of the variables an expression or comparison reads with a unary minus.
+    for expression in node.operands if isinstance(node, nodes.Comparison) else [node]:
+        for term in expression.operands:
+            for unary in term.operands:
+                if unary.operator == "-" and unary.primary.kind == TokenType.IDENT:
+                    yield unary.primary.text
+
+
+def is_integral(node: nodes.Expression, integers: Set[str]) -> bool:
+    # True if the expression is integer arithmetic on integer literals and the given variables.
+    for term in node.operands:
+        if not is_long_safe(term, integers):
+            return False
+        for unary in term.operands:
+            if unary.primary.kind == TokenType.IDENT:
+                if unary.primary.text not in integers:
+                    return False
+            else:
+                value = semantics.literal(unary.primary.text)
+                if value is None or value[0] == semantics.DOUBLE or value[1] > FLOAT_EXACT:
+                    return False
+    return True
+
+
+def is_long_safe(node: nodes.Term, integers: Set[str]) -> bool:
+    # True if the term gives the same result with the given variables as longs as with them as
+    # floats, the sign of a zero included. C does an operation on two integers in integer
+    # arithmetic, where the float version would divide exactly, or make -0.0 out of negating a zero
+    # or multiplying one by a negative number.
+    if "/" in node.operators:
+        return False
+    variables = [
+        unary for unary in node.operands if unary.primary.kind == TokenType.IDENT and unary.primary.text in integers
+    ]
+    if any(unary.operator == "-" for unary in variables):
+        return False
+    if variables and len(node.operands) > 1:
+        # A product: one of the variables, times positive literals.
+        if len(variables) > 1:
+            return False
+        for unary in node.operands:
+            if unary.primary.kind == TokenType.NUMBER:
+                value = semantics.literal(unary.primary.text)
+                if unary.operator == "-" or value is None or value[1] == 0:
+                    return False
+    return True
+
+
+# Loops and common subexpressions (-O3) #
+# These passes keep values in variables of their own, named _t1, _t2 and so on, which can't clash
+# with a Teeny Tiny variable since those can't contain an underscore. The new variables are floats,
+# so only subexpressions of type float (with a variable and no double literal) are moved into one:
+# C computes those in float anyway, so storing the result doesn't round it.
+
+
+def optimize_loops(program: nodes.Program, names: Iterator[str]) -> nodes.Program:
+    # Move the float subexpressions a WHILE loop doesn't change out of its condition and body, to
+    # just before the loop, and replace `i * k` with a variable that goes up by k each time round
+    # where i is a counter. Loops with a label inside are left alone, since a GOTO could jump in.
+    summaries = summarize(program.statements)
+    optimized = []
+    hoisted = []  # (Block copy, WHILE copy in it, Loop) for each loop optimized.
+    # Each frame is the block, where we are in it, its copy, the loops it's inside, and the loop
+    # it's the body of, if any.
+    stack = [[program.statements, 0, optimized, (), None]]
+    while stack:
+        frame = stack[-1]
+        block, index, copy, loops, owner = frame
+        if index == len(block):
+            stack.pop()
+            continue
+        frame[1] += 1
+        node = block[index]
+
+        if isinstance(node, (nodes.If, nodes.While)):
+            comparison = node.comparison
+            for loop in loops:
+                comparison = loop.comparison(comparison)
+            loop = None
+            if isinstance(node, nodes.While) and not summaries[id(node)][1]:
+                loop = Loop(summaries[id(node)][0], names, node.line)
+                counter = find_counter(block, index, summaries)
+                if counter is not None:
+                    loop.reduce_strength(node.body, *counter[:4])
+                loops = loops + (loop,)
+                comparison = loop.comparison(comparison)
+            inner = type(node)(comparison, [], node.line)
+            copy.append(inner)
+            if loop is not None:
+                hoisted.append((copy, inner, loop))
+            stack.append([node.body, 0, inner.body, loops, loop])
+        else:
+            statement = node
+            for loop in loops:
+                statement = loop.statement(statement)
+            copy.append(statement)
+            if owner is not None and node is owner.increment:
+                copy.extend(owner.updates())
+
+    # Put what each loop hoisted just before it.
+    before = {id(inner): loop.hoisted for _, inner, loop in hoisted if loop.hoisted}
+    blocks = {id(copy): copy for copy, inner, _ in hoisted if id(inner) in before}
+    for copy in blocks.values():
+        statements = []
+        for statement in copy:
+            statements.extend(before.get(id(statement), []))
+            statements.append(statement)
+        copy[:] = statements
+    return nodes.Program(optimized)
+
+
+class Loop:
+    """ A WHILE loop being optimized by optimize_loops, and what it moves out of the loop. """
+
+    def __init__(self, assigned: Set[str], names: Iterator[str], line: int):
+        self.assigned = set(assigned)  # Variables the loop changes.
+        self.names = names
+        self.line = line
+        self.hoisted: List[nodes.Let] = []  # To go just before the loop.
+        self.temporaries: Dict[str, str] = {}  # repr() of a hoisted expression to its variable.
+        self.counter: Optional[str] = None  # The induction variable, if strength is reduced.
+        self.step = 0
+        self.increment: Optional[nodes.Let] = None
+        self.multiples: Dict[int, str] = {}  # k to the variable that holds counter * k.
+
+    def temporary(self, expression: nodes.Expression) -> str:
+        # The variable holding an expression computed before the loop.
+        key = repr(expression)
+        if key not in self.temporaries:
+            self.temporaries[key] = next(self.names)
+            self.hoisted.append(nodes.Let(self.temporaries[key], expression, self.line))
+        return self.temporaries[key]
+
+    def invariant(self, node: nodes.Unary) -> bool:
+        return node.primary.kind is TokenType.NUMBER or node.primary.text not in self.assigned
+
+    def changes(self, node: nodes.Expression) -> bool:
+        # False if rewriting the expression would leave it as it is, which is worth finding out
+        # quickly since every loop a statement is in rewrites it. Anything moved out of the loop
+        # starts with an invariant unary, followed by another in the same term or the next one.
+        if self.multiples:
+            return True
+        operands = node.operands
+        for index, term in enumerate(operands):
+            if self.invariant(term.operands[0]) and (len(term.operands) > 1 or (index == 0 and len(operands) > 1)):
+                return True
+        return False
+
+    # Strength reduction #
+
+    def reduce_strength(self, body: List[nodes.Node], counter: str, step: int, bound: int, increment: nodes.Let):
+        # Find the products of the counter and positive int literals k in the loop, and keep each in a
+        # variable. The counter stays within +-bound, so they're exact as long as bound * k is.
+        self.counter, self.step, self.increment = counter, step, increment
+        for node in walk(body):
+            for expression in expressions(node):
+                for operand in expression.operands if isinstance(expression, nodes.Comparison) else [expression]:
+                    for term in operand.operands:
+                        self.multiply(term, counter, bound)
+
+    def multiply(self, term: nodes.Term, counter: str, bound: int) -> None:
+        k = counter_multiple(term, counter)
+        if k is not None and k not in self.multiples and bound * k <= FLOAT_EXACT:
+            name = next(self.names)
+            self.multiples[k] = name
+            self.assigned.add(name)
+            product = nodes.Term(term.operands[:2], ["*"])
+            self.hoisted.append(nodes.Let(name, nodes.Expression([product], []), self.line))
+
+    def updates(self) -> List[nodes.Let]:
+        # The LETs that go after the counter's increment, to keep the products up to date.
+        operator = "+" if self.step > 0 else "-"
+        return [
+            nodes.Let(
+                name,
+                nodes.Expression([variable_term(name), constant_term((semantics.INT, abs(self.step) * k))], [operator]),
+                self.increment.line,
+            )
+            for k, name in self.multiples.items()
+        ]
+
+    def reduce(self, node: nodes.Term) -> nodes.Term:
+        k = counter_multiple(node, self.counter)
+        if k not in self.multiples:
+            return node
+        return nodes.Term([variable_unary(self.multiples[k])] + node.operands[2:], node.operators[1:])
+
+    # Rewriting #
+
+    def statement(self, node: nodes.Node) -> nodes.Node:
+        if isinstance(node, nodes.Print) and isinstance(node.value, nodes.Expression) and self.changes(node.value):
+            return nodes.Print(self.expression(node.value), node.line)
+        if isinstance(node, nodes.Let) and self.changes(node.expression):
+            return nodes.Let(node.name, self.expression(node.expression), node.line)
+        return node
+
+    def comparison(self, node: nodes.Comparison) -> nodes.Comparison:
+        if not any(self.changes(operand) for operand in node.operands):
+            return node
+        return nodes.Comparison([self.expression(operand) for operand in node.operands], node.operators)
+
+    def expression(self, node: nodes.Expression) -> nodes.Expression:
+        operands = [self.reduce(term) for term in node.operands] if self.multiples else list(node.operands)
+        operators = list(node.operators)
+
+        # The longest float prefix of invariant terms, then the longest in each term that's left.
+        # Terms with integer division are left out: moved before the loop, a division by zero could
+        # crash a program that never ran the loop.
+        length = 0
+        kind = None
+        for count, term in enumerate(operands, 1):
+            if not all(self.invariant(unary) for unary in term.operands) or integer_division(term):
+                break
+            kind = semantics.kind_of(term) if kind is None else semantics.common(kind, semantics.kind_of(term))
+            if kind == semantics.DOUBLE:
+                break
+            if kind == semantics.FLOAT and (count > 1 or len(term.operands) > 1):
+                length = count
+        if length:
+            name = self.temporary(nodes.Expression(operands[:length], operators[: length - 1]))
+            operands = [variable_term(name)] + operands[length:]
+            operators = operators[length - 1 :]
+        for index in range(1 if length else 0, len(operands)):
+            operands[index] = self.term(operands[index])
+        return nodes.Expression(operands, operators)
+
+    def term(self, node: nodes.Term) -> nodes.Term:
+        length = 0
+        kind = None
+        for count, unary in enumerate(node.operands, 1):
+            if not self.invariant(unary):
+                break
+            if kind is None:
+                kind = semantics.kind_of(unary)
+            else:
+                kind = semantics.common(kind, semantics.kind_of(unary))
+                if node.operators[count - 2] == "/" and kind in (semantics.INT, semantics.LONG):
+                    break
+            if kind == semantics.DOUBLE:
+                break
+            if kind == semantics.FLOAT and count > 1:
+                length = count
+        if not length:
+            return node
+        prefix = nodes.Term(node.operands[:length], node.operators[: length - 1])
+        name = self.temporary(nodes.Expression([prefix], []))
+        return nodes.Term([variable_unary(name)] + node.operands[length:], node.operators[length - 1 :])
+
+
+def summarize(statements: List[nodes.Node]) -> Dict[int, Tuple[Set[str], bool]]:
+    # For each IF and WHILE (by id()), the variables assigned in its body and whether there's a label
+    # in it. Worked out from the innermost out, so each body is only looked at once.
+    summaries = {}
+    stack = [(node, False) for node in statements if isinstance(node, (nodes.If, nodes.While))]
+    while stack:
+        node, done = stack.pop()
+        if not done:
+            stack.append((node, True))
+            stack.extend((inner, False) for inner in node.body if isinstance(inner, (nodes.If, nodes.While)))
+            continue
+        assigned = set()
+        labelled = False
+        for inner in node.body:
+            if isinstance(inner, (nodes.Let, nodes.Input)):
+                assigned.add(inner.name)
+            elif isinstance(inner, nodes.Label):
+                labelled = True
+            elif isinstance(inner, (nodes.If, nodes.While)):
+                assigned |= summaries[id(inner)][0]
+                labelled = labelled or summaries[id(inner)][1]
+        summaries[id(node)] = (assigned, labelled)
+    return summaries
+
+
+def find_counter(
+    block: List[nodes.Node], index: int, summaries
+) -> Optional[Tuple[str, int, int, nodes.Let, nodes.Let]]:
+    # If the WHILE at block[index] counts a variable from one int literal to another, as in
+    #
+    #   LET i = 0
+    #   WHILE i < 10 REPEAT
+    #       ...
+    #       LET i = i + 1
+    #   ENDWHILE
+    #
+    # return the variable, its step, the biggest magnitude it can reach, the LET that steps it and
+    # the LET that starts it.
+    loop = block[index]
+    comparison = loop.comparison
+    if len(comparison.operators) != 1:
+        return None
+    counter = variable_name(comparison.operands[0])
+    limit = expression_constant(comparison.operands[1])
+    if counter is None or limit is None or limit[0] != semantics.INT:
+        return None
+
+    # The body assigns it once, at the top level, stepping it towards the limit.
+    increments = []
+    for node in loop.body:
+        if isinstance(node, (nodes.If, nodes.While)) and counter in summaries[id(node)][0]:
+            return None
+        if isinstance(node, (nodes.Let, nodes.Input)) and node.name == counter:
+            increments.append(node)
+    step = counter_step(increments[0], counter) if len(increments) == 1 else None
+    if step is None or comparison.operators[0] not in ("<", "<=", ">", ">="):
+        return None
+    if (step > 0) != (comparison.operators[0] in ("<", "<=")):
+        return None
+
+    # And it's set to an int literal before the loop, with nothing in between that could change it
+    # or jump past the LET.
+    for node in reversed(block[:index]):
+        if isinstance(node, (nodes.Label, nodes.Goto)):
+            return None
+        if isinstance(node, (nodes.If, nodes.While)):
+            assigned, labelled = summaries[id(node)]
+            if labelled or counter in assigned:
+                return None
+        if isinstance(node, (nodes.Let, nodes.Input)) and node.name == counter:
+            start = expression_constant(node.expression) if isinstance(node, nodes.Let) else None
+            if start is None or start[0] != semantics.INT:
+                return None
+            return counter, step, max(abs(start[1]), abs(limit[1]) + abs(step)), increments[0], node
+    return None
+
+
+def counter_step(node: nodes.Node, counter: str) -> Optional[int]:
+    # c if the statement is `LET counter = counter + c` or `counter - c`, c a nonzero int literal.
+    if not isinstance(node, nodes.Let) or len(node.expression.operands) != 2:
+        return None
+    if variable_name(nodes.Expression(node.expression.operands[:1], [])) != counter:
+        return None
+    step = term_constant(node.expression.operands[1])
+    if step is None or step[0] != semantics.INT or step[1] == 0:
+        return None
+    return step[1] if node.expression.operators[0] == "+" else -step[1]
+
+
+def counter_multiple(node: nodes.Term, counter: str) -> Optional[int]:
+    # k if the term starts `counter * k` or `k * counter`, k a positive int literal.
+    if len(node.operands) < 2 or node.operators[0] != "*":
+        return None
+    first, second = node.operands[:2]
+    for unary, factor in ((first, second), (second, first)):
+        if unary.operator is None and unary.primary.kind == TokenType.IDENT and unary.primary.text == counter:
+            value = constant(factor) if factor.operator is None else None
+            if value is not None and value[0] == semantics.INT and value[1] > 0:
+                return value[1]
+    return None
+
+
+def eliminate_common_subexpressions(program: nodes.Program, names: Iterator[str]) -> nodes.Program:
+    # Within each run of LET, PRINT and INPUT statements, work out a float subexpression that's
+    # computed more than once with the same variable values just once, into a variable.
+    optimized = []
+    stack = [(iter(program.statements), optimized)]
+    while stack:
+        block, copy = stack[-1]
+        run = []
+        node = next(block, None)
+        while isinstance(node, (nodes.Let, nodes.Print, nodes.Input)):
+            run.append(node)
+            node = next(block, None)
+        copy.extend(common_subexpressions(run, names))
+        if node is None:
+            stack.pop()
+        elif isinstance(node, (nodes.If, nodes.While)):
+            inner = type(node)(node.comparison, [], node.line)
+            copy.append(inner)
+            stack.append((iter(node.body), inner.body))
+        else:
+            copy.append(node)
+    return nodes.Program(optimized)
+
+
+class Uses:
+    """ The subexpressions of one expression that common_subexpressions replaces with variables. """
+
+    def __init__(self, expression: nodes.Expression):
+        self.expression = expression
+        self.prefix = 0  # The number of terms at the start replaced, or 0.
+        self.prefix_key = 0
+        self.terms: Dict[int, Tuple[int, int]] = {}  # Term index to the unaries replaced and their key.
+
+    def covers(self, index: Optional[int], length: int) -> bool:
+        # True if the prefix (of the expression if index is None, else of that term) is part of a
+        # bigger one already replaced.
+        if index is None:
+            return length < self.prefix
+        return index < self.prefix or length < self.terms.get(index, (0, 0))[0]
+
+
+def common_subexpressions(statements: List[nodes.Node], names: Iterator[str]) -> List[nodes.Node]:
+    # The candidates are the prefixes of each expression's chain of terms and each term's chain of
+    # unaries, since those are what C computes as a value. Each is given a key, the same for the same
+    # operations on the same literals and the same variables between assignments to them.
+    keys: Dict[tuple, int] = {}
+    versions: Dict[str, int] = {}
+    sizes: Dict[int, int] = {}
+    occurrences: Dict[int, List[Tuple[Uses, Optional[int], int]]] = {}
+    uses: List[Optional[Uses]] = []
+
+    def unary_key(node: nodes.Unary) -> tuple:
+        if node.primary.kind == TokenType.IDENT:
+            return node.operator, node.primary.text, versions.get(node.primary.text, 0)
+        return node.operator, node.primary.text
+
+    def found(key: int, size: int, place: Tuple[Uses, Optional[int], int]) -> None:
+        sizes[key] = size
+        occurrences.setdefault(key, []).append(place)
+
+    for statement in statements:
+        expression = statement_expression(statement)
+        if expression is None:
+            uses.append(None)
+        else:
+            use = Uses(expression)
+            uses.append(use)
+            chain_key = None
+            chain_kind = None  # None before the first term, DOUBLE once the chain can't be replaced.
+            chain_size = 0
+            for index, term in enumerate(expression.operands):
+                key = keys.setdefault(("unary",) + unary_key(term.operands[0]), len(keys))
+                kind = semantics.kind_of(term.operands[0])
+                for length in range(2, len(term.operands) + 1):
+                    unary = term.operands[length - 1]
+                    key = keys.setdefault((key, term.operators[length - 2]) + unary_key(unary), len(keys))
+                    kind = semantics.common(kind, semantics.kind_of(unary))
+                    if kind == semantics.DOUBLE:
+                        break
+                    if kind == semantics.FLOAT:
+                        found(key, length, (use, index, length))
+                if chain_kind == semantics.DOUBLE:
+                    continue
+                chain_size += len(term.operands)
+                if chain_kind is None:
+                    chain_key = keys.setdefault(("term", key), len(keys))
+                    chain_kind = kind
+                    continue
+                chain_key = keys.setdefault((chain_key, expression.operators[index - 1], key), len(keys))
+                chain_kind = semantics.common(chain_kind, kind)
+                if chain_kind == semantics.FLOAT:
+                    found(chain_key, chain_size, (use, None, index + 1))
+        if isinstance(statement, (nodes.Let, nodes.Input)):
+            versions[statement.name] = versions.get(statement.name, 0) + 1
+
+    # Take the biggest first. Occurrences inside one that's replaced don't count any more.
+    chosen: Dict[int, Optional[str]] = {}
+    for key in sorted(occurrences, key=sizes.get, reverse=True):
+        live = [(use, index, length) for use, index, length in occurrences[key] if not use.covers(index, length)]
+        if len(live) < 2:
+            continue
+        chosen[key] = None
+        for use, index, length in live:
+            if index is None:
+                use.prefix, use.prefix_key = length, key
+            else:
+                use.terms[index] = (length, key)
+    if not chosen:
+        return statements
+
+    optimized = []
+
+    def name(key: int, expression: nodes.Expression, line: int) -> str:
+        # The variable for a subexpression, assigned just before its first use.
+        if chosen[key] is None:
+            chosen[key] = next(names)
+            optimized.append(nodes.Let(chosen[key], expression, line))
+        return chosen[key]
+
+    for statement, use in zip(statements, uses):
+        if use is None or not (use.prefix or use.terms):
+            optimized.append(statement)
+            continue
+        operands = list(use.expression.operands)
+        operators = list(use.expression.operators)
+        for index, (length, key) in sorted(use.terms.items()):
+            term = operands[index]
+            prefix = nodes.Term(term.operands[:length], term.operators[: length - 1])
+            operands[index] = nodes.Term(
+                [variable_unary(name(key, nodes.Expression([prefix], []), statement.line))] + term.operands[length:],
+                term.operators[length - 1 :],
+            )
+        if use.prefix:
+            prefix = nodes.Expression(operands[: use.prefix], operators[: use.prefix - 1])
+            operands = [variable_term(name(use.prefix_key, prefix, statement.line))] + operands[use.prefix :]
+            operators = operators[use.prefix - 1 :]
+        expression = nodes.Expression(operands, operators)
+        if isinstance(statement, nodes.Let):
+            optimized.append(nodes.Let(statement.name, expression, statement.line))
+        else:
+            optimized.append(nodes.Print(expression, statement.line))
+    return optimized
+
+
+def statement_expression(node: nodes.Node) -> Optional[nodes.Expression]:
+    # The expression a LET or PRINT evaluates, if any.
+    if isinstance(node, nodes.Let):
+        return node.expression
+    if isinstance(node, nodes.Print) and isinstance(node.value, nodes.Expression):
+        return node.value
+    return None
+
+
+def integer_division(node: nodes.Term) -> bool:
+    # True if the term divides in integer arithmetic, which fails on a zero divisor.
+    kind = semantics.kind_of(node.operands[0])
+    for operator, unary in zip(node.operators, node.operands[1:]):
+        kind = semantics.common(kind, semantics.kind_of(unary))
+        if operator == "/" and kind in (semantics.INT, semantics.LONG):
+            return True
+    return False
+
+
+def variable_name(node: nodes.Expression) -> Optional[str]:
+    # The name of the variable if the expression is just one, unsigned.
+    if len(node.operands) != 1 or len(node.operands[0].operands) != 1:
+        return None
+    unary = node.operands[0].operands[0]
+    if unary.operator is None and unary.primary.kind == TokenType.IDENT:
+        return unary.primary.text
+    return None
+
+
+def variable_unary(name: str) -> nodes.Unary:
+    return nodes.Unary(None, nodes.Primary(TokenType.IDENT, name))
+
+
+def variable_term(name: str) -> nodes.Term:
+    return nodes.Term([variable_unary(name)], [])
+
+
+# Walking the tree #
+
+
+def walk(statements: List[nodes.Node]) -> Iterator[nodes.Node]:
+    # Every statement in the block and, recursively, in the bodies of IFs and WHILEs.
+    stack = list(reversed(statements))
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, (nodes.If, nodes.While)):
+            stack.extend(reversed(node.body))
+
+
+def count(statements: List[nodes.Node]) -> int:
+    # How many statements there are, counting those in the bodies of IFs and WHILEs.
+    return sum(1 for _ in walk(statements))
+
+
+def expressions(node: nodes.Node) -> List[nodes.Node]:
+    # The expressions (and comparisons) a statement evaluates itself, not counting its body.
+    if isinstance(node, nodes.Print) and isinstance(node.value, nodes.Expression):
+        return [node.value]
+    if isinstance(node, (nodes.If, nodes.While)):
+        return [node.comparison]
+    if isinstance(node, nodes.Let):
+        return [node.expression]
+    return []
+
+
+def variables(node: nodes.Node) -> Iterator[str]:
+    # The names of the variables read by an expression or comparison.
+    if isinstance(node, nodes.Comparison):
+        for expression in node.operands:
+            yield from variables(expression)
+    else:
+        for term in node.operands:
+            for unary in term.operands:
+                if unary.primary.kind == TokenType.IDENT:
+                    yield unary.primary.text
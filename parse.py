@@ -1,7 +1,8 @@
-import sys
-from typing import Optional
+from typing import Optional, Tuple
 
+import nodes
 from emit import Emitter
+from errors import ParserError
 from lex import Lexer, Token, TokenType
 
 
@@ -33,7 +34,7 @@ class Parser:
     primary ::= number | ident
     """
 
-    def __init__(self, lexer: Lexer, emitter: Emitter):
+    def __init__(self, lexer: Lexer, emitter: Optional[Emitter]):
         self.emitter = emitter
         self.lexer = lexer
         self.symbols = set()  # Variables declared so far.
@@ -55,7 +56,7 @@ class Parser:
     def match(self, kind: TokenType) -> None:
         # Try to match current token. If not, error. Advances the current token.
         if not self.is_token(kind):
-            self.abort(f"Expected {kind.name}, got {self.current_token.name}")
+            self.abort(f"Expected {kind.name}, got {self.current_token.kind.name}")
         self.next_token()
 
     def next_token(self) -> None:
@@ -65,7 +66,8 @@ class Parser:
         # No need to worry about parsing the EOF. Lexer handles that.
 
     def abort(self, message: str) -> None:
-        sys.exit(f"Error. {message}")
+        # Report the error at the current token.
+        raise ParserError(message, self.current_token.line, self.current_token.column)
 
     # Production rules #
 
@@ -94,7 +96,26 @@ class Parser:
                 self.abort(f"Attempting to GOTO to undeclared label: {label}")
 
     def statement(self) -> None:
-        # One of the following statements...
+        # One statement and, for an IF or WHILE, the statements in its body. Blocks are parsed with a
+        # stack of the keywords that end the open ones rather than by recursion, so they can nest
+        # as deeply as a program likes.
+        ends = []
+        while True:
+            if ends and self.is_token(ends[-1]):
+                # "ENDIF" nl | "ENDWHILE" nl
+                self.match(ends.pop())
+                self.emitter.emit_line("}")
+                self.nl()
+            else:
+                end = self.statement_head()
+                if end is not None:
+                    ends.append(end)
+            if not ends:
+                return
+
+    def statement_head(self) -> Optional[TokenType]:
+        # A statement, or the start of an IF or WHILE up to its body. Returns the keyword that ends
+        # the body, or None if the statement is finished.
 
         # Check the first token to see what kind of statement this is.
         if self.is_token(TokenType.PRINT):
@@ -119,10 +140,8 @@ class Parser:
             self.match(TokenType.THEN)
             self.nl()
             self.emitter.emit_line(") {")
-            while not self.is_token(TokenType.ENDIF):
-                # Zero or more statements in the body.
-                self.statement()
-            self.match(TokenType.ENDIF)
+            # Zero or more statements in the body.
+            return TokenType.ENDIF
 
         elif self.is_token(TokenType.WHILE):
             # "WHILE" comparison "REPEAT" block "ENDWHILE"
@@ -132,11 +151,8 @@ class Parser:
             self.match(TokenType.REPEAT)
             self.nl()
             self.emitter.emit_line(") {")
-            while not self.is_token(TokenType.ENDWHILE):
-                # Zero or more statements in the loop body.
-                self.statement()
-            self.match(TokenType.ENDWHILE)
-            self.emitter.emit_line("}")
+            # Zero or more statements in the loop body.
+            return TokenType.ENDWHILE
 
         elif self.is_token(TokenType.LABEL):
             # "LABEL" ident
@@ -194,6 +210,7 @@ class Parser:
 
         # Newline.
         self.nl()
+        return None
 
     def nl(self) -> None:
         # nl ::= '\n'+
@@ -231,45 +248,230 @@ class Parser:
 
     def expression(self) -> None:
         # expression ::= term {( "-" | "+" ) term}
-        self.term()
-        # Can have 0 or more +/- and expressions.
-        while self.is_token(TokenType.PLUS) or self.is_token(TokenType.MINUS):
+        # term ::= unary {( "/" | "*" ) unary}
+        # unary ::= ["+" | "-"] primary
+        # Most tokens in a program are in expressions, so all three rules are parsed by this one
+        # loop instead of a call per rule per operand. The C is the same tokens in the same order.
+        while True:
+            # Optional unary +/-
+            kind = self.current_token.kind
+            if kind is TokenType.PLUS or kind is TokenType.MINUS:
+                self.emitter.emit_code(self.current_token.text)
+                self.next_token()
+            self.primary()
+            # Can have 0 or more +, -, * and / and more unaries.
+            kind = self.current_token.kind
+            if not (
+                kind is TokenType.PLUS
+                or kind is TokenType.MINUS
+                or kind is TokenType.ASTERISK
+                or kind is TokenType.SLASH
+            ):
+                return
             self.emitter.emit_code(self.current_token.text)
             self.next_token()
-            self.term()
 
-    def term(self) -> None:
-        # term ::= unary {( "/" | "*" ) unary}
-        self.unary()
-        # Can have 0 or more *// and expressions.
-        while self.is_token(TokenType.ASTERISK) or self.is_token(TokenType.SLASH):
-            self.emitter.emit_code(self.current_token.text)
+    def primary(self):
+        # primary ::= number | ident
+        token = self.current_token
+
+        if token.kind is TokenType.NUMBER:
+            self.emitter.emit_code(token.text)
+            self.next_token()
+        elif token.kind is TokenType.IDENT:
+            # Ensure the variable already exists.
+            if token.text not in self.symbols:
+                self.abort(f"Referencing variable before assignment: {token.text}")
+            self.emitter.emit_code(token.text)
             self.next_token()
-            self.unary()
+        else:
+            # Error!
+            self.abort(f"Unexpected token at {self.current_token.text}")
+
+
+class TreeParser(Parser):
+    """ A Parser that builds an abstract syntax tree (see nodes.py) instead of emitting C.
+
+    It checks the same grammar and reports the same errors as Parser. `program()` returns a
+    nodes.Program, which codegen.CGenerator turns into the same C that Parser would have emitted.
+    """
+
+    def __init__(self, lexer: Lexer):
+        super().__init__(lexer, None)
+
+    # Production rules #
+
+    def program(self) -> nodes.Program:
+        # program ::= {statement}
+
+        # Since some newlines are required in our grammar, we need to skip the excess.
+        while self.is_token(TokenType.NEWLINE):
+            self.next_token()
+
+        # Parse all the statements in the program.
+        statements = []
+        while not self.is_token(TokenType.EOF):
+            statements.append(self.statement())
+
+        # Check that each label referenced in a GOTO is declared.
+        for label in self.labels_gone_to:
+            if label not in self.labels_declared:
+                self.abort(f"Attempting to GOTO to undeclared label: {label}")
+        return nodes.Program(statements)
+
+    def statement(self) -> nodes.Node:
+        # One statement and, for an IF or WHILE, the statements in its body. As in Parser, open
+        # blocks are kept on a stack rather than parsed by recursion.
+        node, end = self.statement_head()
+        blocks = [(node, end)] if end is not None else []
+        while blocks:
+            block, end = blocks[-1]
+            if self.is_token(end):
+                # "ENDIF" nl | "ENDWHILE" nl
+                self.match(end)
+                self.nl()
+                blocks.pop()
+            else:
+                inner, inner_end = self.statement_head()
+                # Zero or more statements in the body.
+                block.body.append(inner)
+                if inner_end is not None:
+                    blocks.append((inner, inner_end))
+        return node
+
+    def statement_head(self) -> Tuple[nodes.Node, Optional[TokenType]]:
+        # A statement, or an IF or WHILE with an empty body, and the keyword that ends the body.
+        line = self.current_token.line
+
+        # Check the first token to see what kind of statement this is.
+        if self.is_token(TokenType.PRINT):
+            # "PRINT" (expression | string)
+            self.next_token()
+            if self.is_token(TokenType.STRING):
+                node = nodes.Print(self.current_token.text, line)
+                self.next_token()
+            else:
+                node = nodes.Print(self.expression(), line)
+
+        elif self.is_token(TokenType.IF):
+            # "IF" comparison "THEN" {statement} "ENDIF"
+            self.next_token()
+            comparison = self.comparison()
+            self.match(TokenType.THEN)
+            self.nl()
+            return nodes.If(comparison, [], line), TokenType.ENDIF
 
-    def unary(self) -> None:
+        elif self.is_token(TokenType.WHILE):
+            # "WHILE" comparison "REPEAT" block "ENDWHILE"
+            self.next_token()
+            comparison = self.comparison()
+            self.match(TokenType.REPEAT)
+            self.nl()
+            return nodes.While(comparison, [], line), TokenType.ENDWHILE
+
+        elif self.is_token(TokenType.LABEL):
+            # "LABEL" ident
+            self.next_token()
+            # Make sure this label doesn't already exist.
+            if self.current_token.text in self.labels_declared:
+                self.abort(f"Label already exists: {self.current_token.text}")
+            self.labels_declared.add(self.current_token.text)
+            node = nodes.Label(self.current_token.text, line)
+            self.match(TokenType.IDENT)
+
+        elif self.is_token(TokenType.GOTO):
+            # "GOTO" ident
+            self.next_token()
+            self.labels_gone_to.add(self.current_token.text)
+            node = nodes.Goto(self.current_token.text, line)
+            self.match(TokenType.IDENT)
+
+        elif self.is_token(TokenType.LET):
+            # "LET" ident "=" expression
+            self.next_token()
+            name = self.current_token.text
+            self.symbols.add(name)
+            self.match(TokenType.IDENT)
+            self.match(TokenType.EQ)
+            node = nodes.Let(name, self.expression(), line)
+
+        elif self.is_token(TokenType.INPUT):
+            # "INPUT" ident
+            self.next_token()
+            self.symbols.add(self.current_token.text)
+            node = nodes.Input(self.current_token.text, line)
+            self.match(TokenType.IDENT)
+
+        else:
+            # This is not a valid statement. Error!
+            self.abort(
+                f"Invalid statement at {self.current_token.text} ({self.current_token.kind.name})"
+            )
+
+        # Newline.
+        self.nl()
+        return node, None
+
+    def comparison(self) -> nodes.Comparison:
+        # comparison ::= expression (("==" | "!=" | ">" | ">=" | "<" | "<=") expression)+
+        operands = [self.expression()]
+        operators = []
+        # Can have 0 or more comparison operators and expressions.
+        while self.is_comparison_operator():
+            operators.append(self.current_token.text)
+            self.next_token()
+            operands.append(self.expression())
+        return nodes.Comparison(operands, operators)
+
+    def expression(self) -> nodes.Expression:
+        # expression ::= term {( "-" | "+" ) term}
+        # term ::= unary {( "/" | "*" ) unary}
         # unary ::= ["+" | "-"] primary
+        # Most tokens in a program are in expressions, so all three rules are parsed by this one
+        # loop instead of a call per rule per operand. It builds the same nodes the rules describe.
+        terms = []
+        operators = []
+        unaries = []
+        term_operators = []
+        while True:
+            # Optional unary +/-
+            kind = self.current_token.kind
+            operator = None
+            if kind is TokenType.PLUS or kind is TokenType.MINUS:
+                operator = self.current_token.text
+                self.next_token()
+            unaries.append(nodes.Unary(operator, self.primary()))
 
-        # Optional unary +/-
-        if self.is_token(TokenType.PLUS) or self.is_token(TokenType.MINUS):
-            self.emitter.emit_code(self.current_token.text)
+            token = self.current_token
+            kind = token.kind
+            if kind is TokenType.ASTERISK or kind is TokenType.SLASH:
+                # Another unary in this term.
+                term_operators.append(token.text)
+                self.next_token()
+                continue
+            terms.append(nodes.Term(unaries, term_operators))
+            if kind is not TokenType.PLUS and kind is not TokenType.MINUS:
+                return nodes.Expression(terms, operators)
+            # Another term.
+            operators.append(token.text)
             self.next_token()
-        self.primary()
+            unaries = []
+            term_operators = []
 
-    def primary(self):
+    def primary(self) -> nodes.Primary:
         # primary ::= number | ident
+        token = self.current_token
 
-        if self.is_token(TokenType.NUMBER):
-            self.emitter.emit_code(self.current_token.text)
+        if token.kind is TokenType.NUMBER:
+            node = nodes.Primary(TokenType.NUMBER, token.text)
             self.next_token()
-        elif self.is_token(TokenType.IDENT):
+        elif token.kind is TokenType.IDENT:
             # Ensure the variable already exists.
-            if self.current_token.text not in self.symbols:
-                self.abort(
-                    f"Referencing variable before assignment: {self.current_token.text}"
-                )
-            self.emitter.emit_code(self.current_token.text)
+            if token.text not in self.symbols:
+                self.abort(f"Referencing variable before assignment: {token.text}")
+            node = nodes.Primary(TokenType.IDENT, token.text)
             self.next_token()
         else:
             # Error!
             self.abort(f"Unexpected token at {self.current_token.text}")
+        return node
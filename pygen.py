@@ -0,0 +1,354 @@
+""" Runs Teeny Tiny programs in-process by translating them to Python.
+
+The syntax tree becomes the source of one Python function, which is compiled with `compile()`
+and called. Variables are locals of that function, IF and WHILE become Python `if` and `while`,
+and arithmetic goes through the same C semantics as the bytecode interpreter (see semantics.py),
+so the output matches the compiled `out.c`.
+
+Python has no goto, so a program that uses GOTO is cut into basic blocks at its labels and jumps,
+and run as a loop that dispatches on the number of the block to run next, through a tree of ifs.
+So is a program whose blocks nest more deeply than Python allows: more than 20 loops inside one
+another, or 100 levels of indentation. Long chains of operators are split up with temporaries, so
+their parentheses don't nest too deeply either.
+"""
+import math
+import sys
+from typing import IO, Callable, Dict, List, Optional
+
+import nodes
+import semantics
+from lex import TokenType
+from optimize import walk
+from semantics import DOUBLE, FLOAT, INT, LONG
+
+COMPARISONS = {"<", "<=", ">", ">=", "==", "!="}
+
+# How deeply structured code may nest: Python allows 20 loops inside one another and 100 levels of
+# indentation, and the function body and the statements inside the innermost block take one each.
+MAX_LOOPS = 19
+MAX_DEPTH = 98
+
+# Operators in a chain before its value so far is put in a temporary.
+CHAIN_LENGTH = 16
+
+
+def integer_divide(a: int, b: int, bits: int) -> int:
+    # C integer division, wrapping at `bits` bits.
+    if b == 0:
+        raise ZeroDivisionError("Integer division by zero.")
+    return semantics.wrap(semantics.truncate_divide(a, b), bits)
+
+
+# Everything the generated code calls, passed in as arguments so they're fast local lookups.
+RUNTIME = {
+    "_f32": semantics.to_float,
+    "_div": semantics.divide,
+    "_idiv": integer_divide,
+    "_wrap": semantics.wrap,
+    "_fmt": semantics.format_float,
+}
+
+
+class PythonGenerator:
+    """ Generates the Python source for a program from parse.TreeParser. """
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.variables: Dict[str, str] = {}  # Teeny Tiny name to Python local.
+        self.blocks = 0  # Basic blocks allocated so far, when lowering GOTOs.
+        self.temporaries = 0  # Temporaries allocated so far, for long chains.
+
+    def program(self, program: nodes.Program) -> str:
+        body_start = len(self.lines)
+        self.body(program.statements)
+        body = self.lines[body_start:]
+
+        arguments = ", ".join(["_scan", "_skip", "_write"] + sorted(RUNTIME))
+        header = [f"def program({arguments}):"]
+        # C leaves them uninitialized. Zero is what a fresh stack page holds.
+        header.extend(f"    {local} = 0.0" for local in self.variables.values())
+        return "\n".join(header + body + ["    return", ""])
+
+    def loop(self, node: nodes.While, slots: Dict[str, int]) -> str:
+        # The source of a function running one WHILE on the bytecode interpreter's variables, for
+        # vm.run to call once the loop is hot. The variables are locals while it runs.
+        self.body([node])
+        body = self.lines
+        arguments = ", ".join(["_variables", "_scan", "_skip", "_write"] + sorted(RUNTIME))
+        header = [f"def loop({arguments}):"]
+        header.extend(f"    {local} = _variables[{slots[name]}]" for name, local in self.variables.items())
+        footer = [f"    _variables[{slots[name]}] = {local}" for name, local in self.variables.items()]
+        return "\n".join(header + body + footer + [""])
+
+    def line(self, indent: int, code: str) -> None:
+        self.lines.append("    " * indent + code)
+
+    def local(self, name: str) -> str:
+        # The Python local for a variable. Prefixed so they can't clash with keywords or the runtime.
+        if name not in self.variables:
+            self.variables[name] = "v_" + name
+        return self.variables[name]
+
+    def body(self, statements: List[nodes.Node]) -> None:
+        # Statements as structured code if Python can take them that way, or else as basic blocks.
+        if is_structured(statements):
+            self.block(statements, 1)
+        else:
+            self.dispatch(statements)
+
+    # Structured code, for programs without GOTO #
+
+    def block(self, statements: List[nodes.Node], indent: int) -> None:
+        start = len(self.lines)
+        for statement in statements:
+            if isinstance(statement, nodes.If):
+                self.line(indent, f"if {self.condition(statement.comparison)}:")
+                self.block(statement.body, indent + 1)
+            elif isinstance(statement, nodes.While):
+                self.line(indent, f"while {self.condition(statement.comparison)}:")
+                self.block(statement.body, indent + 1)
+            else:
+                self.simple_statement(statement, indent)
+        if len(self.lines) == start:
+            self.line(indent, "pass")
+
+    def simple_statement(self, node: nodes.Node, indent: int) -> None:
+        # Any statement but IF and WHILE. Labels do nothing, and GOTOs are handled by dispatch.
+        if isinstance(node, nodes.Print):
+            if isinstance(node.value, str):
+                self.line(indent, f"_write({node.value + chr(10)!r})")
+            else:
+                value = self.to_float(*self.expression(node.value))
+                self.line(indent, f'_write(_fmt({value}) + "\\n")')
+        elif isinstance(node, nodes.Let):
+            value = self.to_float(*self.expression(node.expression))
+            self.line(indent, f"{self.local(node.name)} = {value}")
+        elif isinstance(node, nodes.Input):
+            local = self.local(node.name)
+            self.line(indent, "_count, _value = _scan()")
+            self.line(indent, "if _count == 1:")
+            self.line(indent + 1, f"{local} = _value")
+            # Not a number. Set the variable to 0 and skip the bad input.
+            self.line(indent, "elif _count == 0:")
+            self.line(indent + 1, f"{local} = 0.0")
+            self.line(indent + 1, "_skip()")
+
+    # Basic blocks, for programs with GOTO #
+
+    def dispatch(self, statements: List[nodes.Node]) -> None:
+        # Lower the statements to numbered blocks that each end by naming the next one.
+        self.blocks = 1
+        self.labels: Dict[str, int] = {}
+        for node in walk(statements):
+            if isinstance(node, nodes.Label):
+                self.labels[node.name] = self.new_block()
+        self.end = self.new_block()
+        lines = self.lines
+        self.lines = []
+        self.starts = {0: 0}  # Block number to where its code starts in self.lines.
+        self.flatten(statements)
+        self.start(self.end)
+        self.line(3, "break")
+        blocks: List[List[str]] = [[] for _ in range(self.blocks)]
+        order = sorted(self.starts, key=self.starts.get)
+        for block, end in zip(order, order[1:] + [None]):
+            blocks[block] = self.lines[self.starts[block] : None if end is None else self.starts[end]]
+        self.lines = lines
+        self.line(1, "_block = 0")
+        self.line(1, "while True:")
+        self.tree(blocks, 0, len(blocks), 2)
+
+    def tree(self, blocks: List[List[str]], low: int, high: int, indent: int) -> None:
+        # Choose between blocks low to high by halves, so a jump takes a few comparisons rather
+        # than one per block, and the ifs nest only as deeply as the log of the number of blocks.
+        while high - low > 1:
+            middle = (low + high) // 2
+            self.line(indent, f"if _block < {middle}:")
+            self.tree(blocks, low, middle, indent + 1)
+            self.line(indent, "else:")
+            low = middle
+            indent += 1
+        # The block's code was generated at an indent of 3.
+        self.lines.extend("    " * (indent - 3) + line for line in blocks[low])
+
+    def new_block(self) -> int:
+        self.blocks += 1
+        return self.blocks - 1
+
+    def jump(self, block: int) -> None:
+        self.line(3, f"_block = {block}")
+        self.line(3, "continue")
+
+    def begin(self, block: int) -> None:
+        # The code from here on is the block's.
+        self.starts[block] = len(self.lines)
+
+    def start(self, block: int) -> None:
+        # Fall through into a new block.
+        self.jump(block)
+        self.begin(block)
+
+    def flatten(self, statements: List[nodes.Node]) -> None:
+        # Blocks nest as deeply as they like, so they're walked with a stack of what's left of each
+        # and what to do at its end.
+        stack = [(iter(statements), None)]
+        while stack:
+            statement = next(stack[-1][0], None)
+            if statement is None:
+                end = stack.pop()[1]
+                if end is not None:
+                    end()
+            elif isinstance(statement, nodes.If):
+                after = self.new_block()
+                self.line(3, f"if not {self.condition(statement.comparison)}:")
+                self.line(4, f"_block = {after}")
+                self.line(4, "continue")
+                stack.append((iter(statement.body), lambda after=after: self.start(after)))
+            elif isinstance(statement, nodes.While):
+                top = self.new_block()
+                after = self.new_block()
+                self.start(top)
+                self.line(3, f"if not {self.condition(statement.comparison)}:")
+                self.line(4, f"_block = {after}")
+                self.line(4, "continue")
+                stack.append((iter(statement.body), lambda top=top, after=after: self.loop_end(top, after)))
+            elif isinstance(statement, nodes.Label):
+                self.start(self.labels[statement.name])
+            elif isinstance(statement, nodes.Goto):
+                self.jump(self.labels[statement.name])
+                # Anything after the GOTO is unreachable until the next label, but it still
+                # needs a block to live in.
+                self.begin(self.new_block())
+            else:
+                self.simple_statement(statement, 3)
+
+    def loop_end(self, top: int, after: int) -> None:
+        self.jump(top)
+        self.begin(after)
+
+    # Expressions #
+    # Each returns the Python code for the value and its C type.
+
+    def condition(self, node: nodes.Comparison) -> str:
+        # A comparison used as a condition. A single comparison doesn't need turning into 1 or 0.
+        if len(node.operators) == 1:
+            left, left_kind = self.expression(node.operands[0])
+            right, right_kind = self.expression(node.operands[1])
+            kind = semantics.common(left_kind, right_kind)
+            left, right = self.convert(left, left_kind, kind), self.convert(right, right_kind, kind)
+            return f"{left} {node.operators[0]} {right}"
+        return self.comparison(node)[0]
+
+    def comparison(self, node: nodes.Comparison):
+        return self.chain(node, self.expression)
+
+    def expression(self, node: nodes.Expression):
+        return self.chain(node, self.term)
+
+    def term(self, node: nodes.Term):
+        return self.chain(node, self.unary)
+
+    def unary(self, node: nodes.Unary):
+        primary = node.primary
+        if primary.kind == TokenType.IDENT:
+            local = self.local(primary.text)
+            return (f"(-{local})" if node.operator == "-" else local), FLOAT
+        value = semantics.literal(primary.text)
+        if value is None:
+            value = (DOUBLE, float(primary.text))
+        kind, number = value
+        if node.operator == "-":
+            number = -number if kind == DOUBLE else semantics.wrap(-number, semantics.BITS[kind])
+        if kind != DOUBLE:
+            return f"({number})", kind
+        number = float(number)
+        if math.isinf(number):
+            # A literal with hundreds of digits. repr() would give `inf`, which isn't Python.
+            return ("(-1e999)" if number < 0 else "(1e999)"), kind
+        return f"({number!r})", kind
+
+    def chain(self, node, operand):
+        # A left-associative chain of operators, each applied C style. Each operator wraps the code
+        # so far in another call or parentheses, so every CHAIN_LENGTH operators the value so far
+        # goes in a temporary, with an assignment expression in a tuple that's evaluated in order.
+        code, kind = operand(node.operands[0])
+        steps = []
+        for index, (operator, right_node) in enumerate(zip(node.operators, node.operands[1:])):
+            if index and not index % CHAIN_LENGTH:
+                self.temporaries += 1
+                steps.append(f"(_t{self.temporaries} := {code})")
+                code = f"_t{self.temporaries}"
+            right, right_kind = operand(right_node)
+            common = semantics.common(kind, right_kind)
+            left = self.convert(code, kind, common)
+            right = self.convert(right, right_kind, common)
+            if operator in COMPARISONS:
+                code, kind = f"(1 if {left} {operator} {right} else 0)", INT
+            elif common in (INT, LONG):
+                bits = semantics.BITS[common]
+                if operator == "/":
+                    code = f"_idiv({left}, {right}, {bits})"
+                else:
+                    code = f"_wrap({left} {operator} {right}, {bits})"
+                kind = common
+            else:
+                code = f"_div({left}, {right})" if operator == "/" else f"({left} {operator} {right})"
+                if common == FLOAT:
+                    code = f"_f32{code}" if code.startswith("(") else f"_f32({code})"
+                kind = common
+        if steps:
+            code = f"({', '.join(steps)}, {code})[-1]"
+        return code, kind
+
+    def convert(self, code: str, kind: str, to: str) -> str:
+        if to == FLOAT and kind != FLOAT:
+            return f"_f32({code})"
+        if to == DOUBLE and kind in (INT, LONG):
+            return f"float({code})"
+        return code
+
+    def to_float(self, code: str, kind: str) -> str:
+        return self.convert(code, kind, FLOAT)
+
+
+def is_structured(statements: List[nodes.Node]) -> bool:
+    # Whether statements can be Python ifs and whiles: they have no GOTOs and don't nest too deeply.
+    stack = [(iter(statements), 0)]
+    while stack:
+        node = next(stack[-1][0], None)
+        if node is None:
+            stack.pop()
+        elif isinstance(node, nodes.Goto):
+            return False
+        elif isinstance(node, (nodes.If, nodes.While)):
+            loops = stack[-1][1] + isinstance(node, nodes.While)
+            if loops > MAX_LOOPS or len(stack) > MAX_DEPTH:
+                return False
+            stack.append((iter(node.body), loops))
+    return True
+
+
+def compile_program(program: nodes.Program) -> Callable:
+    # Compile the program to a Python function taking the runtime as its arguments.
+    source = PythonGenerator().program(program)
+    namespace = {}
+    exec(compile(source, "<teeny tiny>", "exec"), namespace)
+    return namespace["program"]
+
+
+def compile_loop(node: nodes.While, variables: List[str]) -> Callable:
+    # Compile a WHILE to a Python function over vm.run's variables, given their names by slot.
+    # The loop can't contain labels or GOTOs.
+    slots = {name: slot for slot, name in enumerate(variables)}
+    source = PythonGenerator().loop(node, slots)
+    namespace = {}
+    exec(compile(source, "<teeny tiny loop>", "exec"), namespace)
+    return namespace["loop"]
+
+
+def run(function: Callable, input_file: Optional[IO[str]] = None, output_file: Optional[IO[str]] = None) -> None:
+    # Call a compiled program, reading INPUT from input_file and writing PRINT to output_file
+    # (standard input and output by default).
+    scanner = semantics.Scanner(input_file if input_file is not None else sys.stdin)
+    write = (output_file if output_file is not None else sys.stdout).write
+    function(scanner.scan_float, scanner.skip_word, write, **RUNTIME)
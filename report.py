@@ -0,0 +1,96 @@
+""" Maps the profile written by a program compiled with --instrument back to its Teeny Tiny source.
+
+    python3 main.py --instrument program.tiny && cc -o program out.c && ./program
+    python3 report.py out.profile program.tiny           # The source, with counts and loop times.
+    python3 report.py out.profile program.tiny --top 10  # The ten lines that ran the most.
+
+Each line of the listing shows how many times the statement on that line ran, and for a WHILE how
+many times it was started and the processor seconds spent in it, nested loops included. A pass
+through a loop that a GOTO entered or left partway isn't timed (see codegen.INSTRUMENT). Lines
+without a count had no statement, or one that optimization removed. The profile itself is text
+(see codegen.INSTRUMENT): a header line, then "statement LINE COUNT" and "loop LINE SECONDS".
+"""
+import argparse
+import sys
+from typing import Dict, List, Optional
+
+HEADER = "teeny tiny profile 1"
+
+
+class Profile:
+    """ What an instrumented program recorded, by source line. """
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}  # Times the statement on each line ran.
+        self.seconds: Dict[int, float] = {}  # Seconds spent in the WHILE loop on each line.
+
+
+def read_profile(path: str) -> Profile:
+    # Raises ValueError if the file isn't a profile.
+    profile = Profile()
+    with open(path, "r") as profile_file:
+        if profile_file.readline().rstrip("\n") != HEADER:
+            raise ValueError(f"{path} is not a Teeny Tiny profile")
+        for number, row in enumerate(profile_file, 2):
+            fields = row.split()
+            try:
+                kind, line, value = fields
+                if kind == "statement":
+                    # Statements the optimizer adds take the line of the one they came from, and
+                    # run as often as it does.
+                    profile.counts[int(line)] = max(profile.counts.get(int(line), 0), int(value))
+                elif kind == "loop":
+                    profile.seconds[int(line)] = profile.seconds.get(int(line), 0.0) + float(value)
+                else:
+                    raise ValueError(kind)
+            except ValueError:
+                raise ValueError(f"{path}:{number}: bad profile line {row.rstrip()!r}") from None
+    return profile
+
+
+def annotate(profile: Profile, source: List[str]) -> List[str]:
+    # The source lines, each with its count and loop time in front.
+    rows = [f"{'count':>12} {'loop s':>10}  line"]
+    for number, text in enumerate(source, 1):
+        rows.append(row(profile, number, text))
+    return rows
+
+
+def hottest(profile: Profile, source: List[str], top: int) -> List[str]:
+    # The `top` lines that ran the most, most first.
+    numbers = sorted(profile.counts, key=lambda number: (-profile.counts[number], number))[:top]
+    rows = [f"{'count':>12} {'loop s':>10}  line"]
+    for number in numbers:
+        rows.append(row(profile, number, source[number - 1] if number <= len(source) else ""))
+    return rows
+
+
+def row(profile: Profile, number: int, text: str) -> str:
+    count = profile.counts.get(number)
+    seconds = profile.seconds.get(number)
+    count_text = "" if count is None else str(count)
+    seconds_text = "" if seconds is None else f"{seconds:.6f}"
+    return f"{count_text:>12} {seconds_text:>10} {number:>5}: {text.rstrip()}"
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    argument_parser = argparse.ArgumentParser(description="Report a Teeny Tiny profile against the source.")
+    argument_parser.add_argument("profile", help="profile written by a program compiled with --instrument")
+    argument_parser.add_argument("source", help="the Teeny Tiny source the program was compiled from")
+    argument_parser.add_argument("--top", type=int, metavar="N", help="list only the N lines that ran the most")
+    arguments = argument_parser.parse_args(argv)
+    try:
+        profile = read_profile(arguments.profile)
+        with open(arguments.source, "r") as source_file:
+            source = source_file.read().splitlines()
+    except (OSError, ValueError) as error:
+        sys.exit(str(error))
+    if arguments.top is None:
+        rows = annotate(profile, source)
+    else:
+        rows = hottest(profile, source, arguments.top)
+    print("\n".join(rows))
+
+
+if __name__ == "__main__":
+    main()
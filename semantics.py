@@ -0,0 +1,329 @@
+""" The C semantics of Teeny Tiny arithmetic, for evaluating it without a C compiler.
+
+Variables are C `float`s, but literals keep their C types: `7` is an `int` and `7.5` a `double`,
+so `7 / 2` is integer division and `7 / 2.0` is done in double precision. Values here are
+(type, value) pairs, with the type one of INT, LONG, FLOAT or DOUBLE.
+
+The first half is for compile time: anything C leaves undefined or that we can't write back out as
+a literal (integer overflow, division by zero, infinities) gives None, meaning "leave it for the
+C compiler". The second half is the runtime behaviour the executors need: float rounding,
+printf's %.2f and scanf's %f.
+"""
+import math
+import struct
+from fractions import Fraction
+from typing import IO, Optional, Tuple, Union
+
+import nodes
+from lex import TokenType
+
+INT = "int"
+LONG = "long"
+FLOAT = "float"
+DOUBLE = "double"
+
+# Usual arithmetic conversions: the result has the higher ranked type of the two operands.
+RANK = {INT: 0, LONG: 1, FLOAT: 2, DOUBLE: 3}
+
+# Width in bits of each integer type.
+BITS = {INT: 32, LONG: 64}
+
+# Range of each integer type (inclusive), assuming the usual 32-bit int and 64-bit long.
+LIMITS = {INT: (-(2 ** 31), 2 ** 31 - 1), LONG: (-(2 ** 63), 2 ** 63 - 1)}
+
+Value = Tuple[str, Union[int, float]]
+
+
+def literal(text: str) -> Optional[Value]:
+    # The C type and value of a number as written in the source.
+    if "." in text or "e" in text:
+        return DOUBLE, float(text)
+    value = int(text)
+    # An unsuffixed decimal literal is the first of int, long that can hold it.
+    for kind in (INT, LONG):
+        if value <= LIMITS[kind][1]:
+            return kind, value
+    return None
+
+
+def integer(kind: str, value: int) -> Optional[Value]:
+    # An integer result, or None if it overflowed (undefined behaviour in C).
+    low, high = LIMITS[kind]
+    if low <= value <= high:
+        return kind, value
+    return None
+
+
+def double(value: float) -> Optional[Value]:
+    # A double result, or None if it can't be written as a literal.
+    if math.isfinite(value):
+        return DOUBLE, value
+    return None
+
+
+def negate(operand: Value) -> Optional[Value]:
+    # Unary minus.
+    kind, value = operand
+    if kind == DOUBLE:
+        return DOUBLE, -value
+    return integer(kind, -value)
+
+
+def arithmetic(operator: str, left: Value, right: Value) -> Optional[Value]:
+    # One of + - * / applied to two values, with C's conversions.
+    kind = left[0] if RANK[left[0]] >= RANK[right[0]] else right[0]
+    a, b = left[1], right[1]
+    if kind == DOUBLE:
+        a, b = float(a), float(b)
+        if operator == "/" and b == 0:
+            return None  # Infinity or NaN.
+    elif operator == "/":
+        if b == 0:
+            return None
+        # C integer division truncates toward zero.
+        quotient = abs(a) // abs(b)
+        return integer(kind, quotient if (a < 0) == (b < 0) else -quotient)
+
+    if operator == "+":
+        result = a + b
+    elif operator == "-":
+        result = a - b
+    elif operator == "*":
+        result = a * b
+    else:
+        result = a / b
+    if kind == DOUBLE:
+        return double(result)
+    return integer(kind, result)
+
+
+def compare(operator: str, left: Value, right: Value) -> Value:
+    # One of the comparison operators. Like C, the result is an int, 1 for true and 0 for false.
+    a, b = left[1], right[1]
+    if DOUBLE in (left[0], right[0]):
+        a, b = float(a), float(b)
+    if operator == "==":
+        result = a == b
+    elif operator == "!=":
+        result = a != b
+    elif operator == "<":
+        result = a < b
+    elif operator == "<=":
+        result = a <= b
+    elif operator == ">":
+        result = a > b
+    else:
+        result = a >= b
+    return INT, int(result)
+
+
+def is_negative(value: Value) -> bool:
+    # True for values that need a minus sign, including a double -0.0.
+    return math.copysign(1, value[1]) < 0
+
+
+def text(value: Value) -> str:
+    # Write a non-negative value as a C literal of the same type.
+    kind, number = value
+    if kind == DOUBLE:
+        # repr is the shortest text that reads back as the same double, and always has
+        # a "." or an exponent so C reads it as a double too.
+        return repr(number)
+    return str(number)
+
+
+def common(left: str, right: str) -> str:
+    # The type two operands are converted to before an arithmetic operator or comparison.
+    return left if RANK[left] >= RANK[right] else right
+
+
+def kind_of(node: nodes.Node) -> str:
+    # The C type of an expression.
+    if isinstance(node, nodes.Unary):
+        if node.primary.kind == TokenType.IDENT:
+            return FLOAT
+        value = literal(node.primary.text)
+        return value[0] if value is not None else DOUBLE
+    if isinstance(node, nodes.Comparison):
+        return INT if node.operators else kind_of(node.operands[0])
+    kind = kind_of(node.operands[0])
+    for operand in node.operands[1:]:
+        kind = common(kind, kind_of(operand))
+    return kind
+
+
+# Runtime #
+
+_single = struct.Struct("f")
+_single_bits = struct.Struct("I")
+
+
+def to_float(value: Union[int, float]) -> float:
+    # Round to the nearest C float (overflowing to infinity), like a cast to (float).
+    return _single.unpack(_single.pack(value))[0]
+
+
+def wrap(value: int, bits: int) -> int:
+    # Two's complement wrap around, what integer overflow does on the machines we target.
+    half = 1 << (bits - 1)
+    return ((value + half) & ((half << 1) - 1)) - half
+
+
+def truncate_divide(a: int, b: int) -> int:
+    # C integer division rounds toward zero. Raises ZeroDivisionError like Python would.
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+def divide(a: float, b: float) -> float:
+    # IEEE division, which gives infinities and NaN where Python raises.
+    try:
+        return a / b
+    except ZeroDivisionError:
+        if a != a:
+            return a
+        if a == 0:
+            # Let the hardware make its default NaN (sign included) like the C program would.
+            return math.inf - math.inf
+        return math.copysign(math.inf, a) * math.copysign(1.0, b)
+
+
+def format_float(value: float) -> str:
+    # printf("%.2f") of a float.
+    if value != value:
+        return "-nan" if math.copysign(1, value) < 0 else "nan"
+    return "%.2f" % value
+
+
+def decimal_to_float(text: str) -> float:
+    # Correctly rounded conversion of decimal text to a C float, like strtof. Going through a
+    # double first rounds twice, which is only wrong when the double lands exactly half way
+    # between two floats.
+    double = float(text)
+    single = to_float(double)
+    if single == double or math.isinf(single) or math.isinf(double):
+        return single
+    (bits,) = _single_bits.unpack(_single.pack(single))
+    # The float on the other side of the double.
+    other_bits = bits + 1 if abs(single) < abs(double) else bits - 1
+    (other,) = _single.unpack(_single_bits.pack(other_bits))
+    if double * 2 != single + other:
+        return single
+    exact = Fraction(text)
+    if exact == Fraction(double):
+        return single
+    # Round toward whichever side the exact value is on.
+    return other if (exact > Fraction(double)) == (other > single) else single
+
+
+class Scanner:
+    """ Reads numbers the way glibc's scanf("%f") and scanf("%*s") do.
+
+    scanf consumes the longest run of characters that could still start a number, even if it then
+    turns out not to be one ("1e+x" reads as 1 and loses "e+"; "in" is a failed match that still
+    eats both letters). Decimal and hexadecimal numbers, inf, infinity and nan are recognized,
+    ignoring case.
+    """
+
+    WHITESPACE = " \t\n\v\f\r"
+
+    def __init__(self, stream: IO[str]):
+        self.stream = stream
+        self.buffer = ""
+        self.position = 0
+
+    def peek(self) -> str:
+        # The next character without consuming it, "" at end of input.
+        if self.position >= len(self.buffer):
+            self.buffer = self.stream.readline()
+            self.position = 0
+            if not self.buffer:
+                return ""
+        return self.buffer[self.position]
+
+    def skip_whitespace(self) -> bool:
+        # Skip whitespace, returning False at end of input.
+        while True:
+            char = self.peek()
+            if not char:
+                return False
+            if char not in self.WHITESPACE:
+                return True
+            self.position += 1
+
+    def take(self, allowed: str) -> str:
+        # Consume the next character if it's (case insensitively) one of the allowed ones.
+        char = self.peek()
+        if char and char.lower() in allowed:
+            self.position += 1
+            return char
+        return ""
+
+    def take_digits(self, digits: str) -> str:
+        taken = []
+        while True:
+            char = self.take(digits)
+            if not char:
+                return "".join(taken)
+            taken.append(char)
+
+    def take_word(self, word: str) -> str:
+        # Consume as much of the word as matches.
+        taken = []
+        for letter in word:
+            char = self.take(letter)
+            if not char:
+                break
+            taken.append(char)
+        return "".join(taken)
+
+    def scan_float(self) -> Tuple[int, float]:
+        # scanf("%f"): returns (-1, 0) at end of input, (0, 0) when no number matches and
+        # (1, value) otherwise.
+        if not self.skip_whitespace():
+            return -1, 0.0
+        sign = self.take("+-")
+        first = self.peek().lower()
+        if first in ("i", "n"):
+            word = self.take_word("infinity" if first == "i" else "nan")
+            if word.lower() not in ("inf", "infinity", "nan"):
+                return 0, 0.0
+            value = math.inf if first == "i" else math.nan
+            return 1, -value if sign == "-" else value
+
+        digits = "0123456789"
+        prefix = ""
+        if self.take("0"):
+            prefix = "0"
+            if self.take("x"):
+                digits = "0123456789abcdef"
+                prefix = ""
+        mantissa = prefix + self.take_digits(digits)
+        if self.take("."):
+            mantissa += "." + self.take_digits(digits)
+        if mantissa.strip(".") == "" and prefix != "0":
+            return 0, 0.0
+        hexadecimal = digits != "0123456789"
+        exponent = ""
+        if self.take("p" if hexadecimal else "e"):
+            exponent_sign = self.take("+-")
+            exponent_digits = self.take_digits("0123456789")
+            if exponent_digits:
+                exponent = ("p" if hexadecimal else "e") + exponent_sign + exponent_digits
+        if hexadecimal:
+            if mantissa.strip(".") == "":
+                return 0, 0.0
+            value = to_float(float.fromhex(sign + "0x" + mantissa + (exponent or "p0")))
+        else:
+            value = decimal_to_float(sign + mantissa + exponent)
+        return 1, value
+
+    def skip_word(self) -> None:
+        # scanf("%*s"): skip whitespace and then everything up to the next whitespace.
+        if not self.skip_whitespace():
+            return
+        while True:
+            char = self.peek()
+            if not char or char in self.WHITESPACE:
+                return
+            self.position += 1
@@ -0,0 +1,180 @@
+""" A long-running compile server, so each compile doesn't pay for starting Python.
+
+Requests and responses are JSON objects, one per line, read from standard input or from clients of
+a Unix socket. A request is
+
+    {"id": 1, "source": "PRINT 1\\n", "optimize": 0, "ast": false, "int_vars": false, "buffered_io": false,
+     "instrument": false}
+
+where everything but "source" is optional. The response has the same "id" and either the C:
+
+    {"id": 1, "code": "#include <stdio.h>\\n..."}
+
+or what went wrong:
+
+    {"id": 1, "error": {"type": "ParserError", "message": "...", "line": 1, "column": 7}}
+
+The type is a CompileError's class name, BadRequest for a request that can't be compiled as given,
+or InternalError if compiling failed some other way.
+
+Requests are compiled concurrently by a pool of processes, so responses come back in the order
+they finish, not the order they were asked for. Use "id" to match them up.
+"""
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Dict, Optional
+
+import compiler
+from errors import CompileError
+
+
+def compile_request(
+    source: str,
+    optimize: int,
+    ast: bool,
+    int_vars: bool = False,
+    buffered_io: bool = False,
+    instrument: bool = False,
+) -> Dict[str, Any]:
+    # Compile one request's source in a worker process, returning the body of the response.
+    try:
+        options = compiler.Options(
+            optimize=optimize, ast=ast, int_vars=int_vars, buffered_io=buffered_io, instrument=instrument
+        )
+        result = compiler.compile_string(source, options)
+    except CompileError as error:
+        return {
+            "error": {
+                "type": type(error).__name__,
+                "message": error.message,
+                "line": error.line,
+                "column": error.column,
+            }
+        }
+    except Exception as error:  # A bug in the compiler. Still answer, rather than lose the request.
+        return internal_error(error)
+    return {"code": result.code}
+
+
+def bad_request(message: str) -> Dict[str, Any]:
+    return {"error": {"type": "BadRequest", "message": message, "line": 0, "column": 0}}
+
+
+def internal_error(error: Exception) -> Dict[str, Any]:
+    message = f"{type(error).__name__}: {error}"
+    return {"error": {"type": "InternalError", "message": message, "line": 0, "column": 0}}
+
+
+async def respond(line: bytes, executor: Executor) -> bytes:
+    # The response line for a request line.
+    request_id = None
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("a request must be a JSON object")
+        request_id = request.get("id")
+        source = request["source"]
+        optimize = request.get("optimize", 0)
+        ast = request.get("ast", False)
+        int_vars = request.get("int_vars", False)
+        buffered_io = request.get("buffered_io", False)
+        instrument = request.get("instrument", False)
+        if not isinstance(source, str):
+            raise ValueError("source must be a string")
+        if optimize not in (0, 1, 2, 3):
+            raise ValueError("optimize must be 0, 1, 2 or 3")
+    except KeyError:
+        response = bad_request("missing source")
+    except ValueError as error:  # json.JSONDecodeError is a ValueError.
+        response = bad_request(str(error))
+    else:
+        loop = asyncio.get_running_loop()
+        try:
+            response = await loop.run_in_executor(
+                executor,
+                compile_request,
+                source,
+                optimize,
+                bool(ast),
+                bool(int_vars),
+                bool(buffered_io),
+                bool(instrument),
+            )
+        except Exception as error:  # The worker died, or the response couldn't be sent back.
+            response = internal_error(error)
+    return json.dumps({"id": request_id, **response}).encode() + b"\n"
+
+
+async def serve_stream(reader, write, executor: Executor) -> None:
+    # Answer every request line from `reader` by calling `write` with its response, until EOF.
+    pending = set()
+
+    async def answer(line: bytes) -> None:
+        response = await respond(line, executor)
+        try:
+            await write(response)
+        except ConnectionError:
+            pass  # The client went away without waiting for its answer.
+
+    while True:
+        line = await reader()
+        if not line:
+            break
+        if line.strip():
+            task = asyncio.ensure_future(answer(line))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def serve_stdin(executor: Executor) -> None:
+    loop = asyncio.get_running_loop()
+    # Standard input may be a file, which asyncio can't watch, so read it from a thread.
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+
+    async def reader() -> bytes:
+        return await loop.run_in_executor(None, stdin.readline)
+
+    async def write(response: bytes) -> None:
+        stdout.write(response)
+        stdout.flush()
+
+    await serve_stream(reader, write, executor)
+
+
+async def serve_socket(path: str, executor: Executor) -> None:
+    async def client(stream_reader: asyncio.StreamReader, stream_writer: asyncio.StreamWriter) -> None:
+        async def write(response: bytes) -> None:
+            stream_writer.write(response)
+            await stream_writer.drain()
+
+        try:
+            await serve_stream(stream_reader.readline, write, executor)
+        except (ConnectionError, ValueError):
+            pass  # The client went away, or sent a line too long to read.
+        finally:
+            stream_writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)  # Left over from an earlier server.
+    # Allow requests up to 64 MB, rather than asyncio's default of 64 KB.
+    server = await asyncio.start_unix_server(client, path, limit=64 * 1024 * 1024)
+    async with server:
+        await server.serve_forever()
+
+
+def serve(socket_path: Optional[str] = None, jobs: Optional[int] = None) -> None:
+    # Serve requests from a Unix socket if given a path, otherwise from standard input until EOF.
+    with ProcessPoolExecutor(jobs) as executor:
+        try:
+            if socket_path is None:
+                asyncio.run(serve_stdin(executor))
+            else:
+                asyncio.run(serve_socket(socket_path, executor))
+        except KeyboardInterrupt:
+            pass
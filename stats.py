@@ -0,0 +1,165 @@
+""" Where compile time goes, for --stats and --profile, and hooks for programs embedding the compiler.
+
+A Recorder times each phase of one compile and counts what went through it. Lexing and parsing
+are interleaved (the parser asks for a token at a time), so the lexer is wrapped to time the
+calls to get_token, and parsing is the rest of the time until the tree is built.
+
+Anything can subscribe to the events a compile publishes:
+
+    stats.subscribe(lambda event, data: print(event, data))
+
+"phase" events ({"name", "seconds"}) are published as each phase ends, and a "compile" event with
+the whole report when the compile is done. With nobody subscribed, compiles aren't recorded at
+all, so there's nothing to pay for the hooks unless they're used.
+"""
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import nodes
+from lex import TokenType
+from optimize import expressions, walk
+
+try:
+    import resource
+except ImportError:  # Not on Windows.
+    resource = None
+
+Subscriber = Callable[[str, Dict[str, Any]], None]
+_subscribers: List[Subscriber] = []
+
+
+def subscribe(callback: Subscriber) -> None:
+    # Call callback(event, data) for every event from every compile from now on.
+    _subscribers.append(callback)
+
+
+def unsubscribe(callback: Subscriber) -> None:
+    _subscribers.remove(callback)
+
+
+def subscribed() -> bool:
+    return bool(_subscribers)
+
+
+def publish(event: str, data: Dict[str, Any]) -> None:
+    for callback in list(_subscribers):
+        callback(event, data)
+
+
+class TimedLexer:
+    """ Wraps a lexer to count the tokens it makes and the time it takes making them. """
+
+    def __init__(self, lexer, recorder: "Recorder"):
+        self.lexer = lexer
+        self.recorder = recorder
+
+    def get_token(self):
+        start = time.perf_counter()
+        token = self.lexer.get_token()
+        self.recorder.lex_seconds += time.perf_counter() - start
+        if token.kind != TokenType.EOF:  # The parser asks for the EOF more than once.
+            self.recorder.tokens += 1
+        return token
+
+
+class Recorder:
+    """ The timings and counts for one compile. """
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}  # Seconds spent in each phase, in the order they ran.
+        self.lex_seconds = 0.0
+        self.tokens = 0
+        self.statements: Dict[str, int] = {}
+        self.statement_count = 0
+        self.block_depth = 0
+        self.expression_depth = 0
+        self.bytes_emitted = 0
+
+    def lexer(self, lexer) -> TimedLexer:
+        return TimedLexer(lexer, self)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        # Time the code in the with block as a phase.
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        if name == "parse":
+            # The parse phase pulls tokens from the lexer. Report the lexing separately.
+            self.add_phase("lex", self.lex_seconds)
+            seconds -= self.lex_seconds
+        self.add_phase(name, seconds)
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        publish("phase", {"name": name, "seconds": seconds})
+
+    def program(self, program: nodes.Program) -> None:
+        # Count the statements, and measure how deeply blocks and expressions nest.
+        for node in walk(program.statements):
+            name = type(node).__name__.upper()
+            self.statements[name] = self.statements.get(name, 0) + 1
+            self.statement_count += 1
+        self.block_depth = block_depth(program.statements)
+        for node in walk(program.statements):
+            for expression in expressions(node):
+                self.expression_depth = max(self.expression_depth, expression_depth(expression))
+
+    def report(self) -> Dict[str, Any]:
+        total = sum(self.phases.values())
+        lex = self.phases.get("lex", 0.0)
+        report = {
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            "total_seconds": round(total, 6),
+            "tokens": self.tokens,
+            "tokens_per_second": round(self.tokens / lex) if lex else None,
+            "statements": self.statement_count,
+            "statements_by_kind": dict(sorted(self.statements.items())),
+            "max_block_depth": self.block_depth,
+            "max_expression_depth": self.expression_depth,
+            "bytes_emitted": self.bytes_emitted,
+            "peak_memory_bytes": peak_memory(),
+        }
+        return report
+
+    def finish(self) -> Dict[str, Any]:
+        # The report, also published to subscribers.
+        report = self.report()
+        publish("compile", report)
+        return report
+
+
+def block_depth(statements: List[nodes.Node]) -> int:
+    # How deeply IFs and WHILEs nest, without recursing.
+    deepest = 0
+    stack = [(statements, 0)]
+    while stack:
+        block, depth = stack.pop()
+        deepest = max(deepest, depth)
+        for node in block:
+            if isinstance(node, (nodes.If, nodes.While)):
+                stack.append((node.body, depth + 1))
+    return deepest
+
+
+def expression_depth(node) -> int:
+    # The depth of the expression as a tree of binary operators. Chains associate to the left, so
+    # in `a + b + c` the `a` is two operators deep.
+    if isinstance(node, nodes.Unary):
+        return 0
+    count = len(node.operators)
+    depth = count + expression_depth(node.operands[0])
+    for index, operand in enumerate(node.operands[1:]):
+        depth = max(depth, count - index + expression_depth(operand))
+    return depth
+
+
+def peak_memory() -> Optional[int]:
+    # The most memory the process has used, in bytes, where the platform says.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, everywhere else kilobytes.
+    return peak if sys.platform == "darwin" else peak * 1024
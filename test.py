@@ -1,8 +1,36 @@
+import io
+import json
+import os
+import shutil
+import tempfile
 import unittest
 import subprocess
+from unittest import mock
 from typing import List
 
-from lex import Lexer, TokenType
+import batch
+import bench
+import cache
+import compiler
+import emit
+import ir
+import nodes
+import pygen
+import report
+import stats
+import vm
+from codegen import CGenerator
+from emit import Emitter
+from errors import CompileError, LexerError, ParserError
+from incremental import IncrementalCompiler
+from lex import Lexer, ParallelLexer, RegexLexer, StreamLexer, TokenType
+from optimize import optimize
+from parse import Parser, TreeParser
+
+
+def run_main(directory: str, *arguments: str, **kwargs) -> subprocess.CompletedProcess:
+    # main.py run in `directory`, so the out.c it writes goes there and not into the checkout.
+    return subprocess.run(["python3", os.path.abspath("main.py"), *arguments], cwd=directory, **kwargs)
 
 
 class TestLexer(unittest.TestCase):
@@ -13,6 +41,8 @@ class TestLexer(unittest.TestCase):
         functionality of the compiler, these make obvious use-case for tests.
     """
 
+    lexer_class = Lexer
+
     def harness(self, input: str) -> List[TokenType]:
         """ Harness
             The lexer accepts a string of source code as input
@@ -21,7 +51,7 @@ class TestLexer(unittest.TestCase):
             follow the same pattern, set up a harness to abstract the process.
         """
         output = []
-        lexer = Lexer(input)
+        lexer = self.lexer_class(input)
         token = lexer.get_token()
         while token.kind != TokenType.EOF:
             output.append(token.kind)
@@ -133,16 +163,1093 @@ class TestLexer(unittest.TestCase):
         )
 
 
+class TestRegexLexer(TestLexer):
+    """ The regex lexer has to agree with the original one token for token,
+        so it runs all of the lexer tests above plus some comparisons.
+    """
+
+    lexer_class = RegexLexer
+
+    def tokens(self, lexer_class, input: str):
+        lexer = lexer_class(input)
+        output = []
+        try:
+            token = lexer.get_token()
+            while token.kind != TokenType.EOF:
+                output.append((token.text, token.kind))
+                token = lexer.get_token()
+        except CompileError as error:
+            output.append(("error", str(error)))
+        return output
+
+    def test_line_and_column(self):
+        for lexer_class in [Lexer, RegexLexer]:
+            tokens = list(lexer_class('LET a = "x"\n  # comment\n PRINT 1.5'))
+            self.assertEqual(
+                [(token.line, token.column) for token in tokens],
+                [(1, 1), (1, 5), (1, 7), (1, 9), (1, 12), (2, 12), (3, 2), (3, 8), (3, 11), (4, 1)],
+            )
+
+    def test_matches_lexer_on_examples(self):
+        for name in ["statements", "fibonacci", "average"]:
+            with open(f"tiny/{name}.tiny", "r") as source_file:
+                source = source_file.read()
+            self.assertEqual(
+                self.tokens(RegexLexer, source), self.tokens(Lexer, source)
+            )
+
+    def test_matches_lexer_on_errors(self):
+        for input in ['PRINT "100%"', "LET a = 1.", "IF a ! b", "LET a = $", "LET é = 1"]:
+            self.assertEqual(self.tokens(RegexLexer, input), self.tokens(Lexer, input))
+
+
+class TestStreamLexer(unittest.TestCase):
+    """ The streaming lexer reads a line at a time but must produce
+        the same tokens as lexing the whole source at once.
+    """
+
+    def test_matches_lexer(self):
+        for input in ["", "LET a = 1", "LET a = 1\n", "PRINT a\n\nPRINT b # done", "IF a !"]:
+            expected = []
+            streamed = []
+            try:
+                expected.extend((token.text, token.kind) for token in Lexer(input))
+            except CompileError as error:
+                expected.append(str(error))
+            try:
+                streamed.extend(
+                    (token.text, token.kind) for token in StreamLexer(io.StringIO(input))
+                )
+            except CompileError as error:
+                streamed.append(str(error))
+            self.assertEqual(streamed, expected)
+
+
+class TestParallelLexer(unittest.TestCase):
+    """ Lexing a file in chunks, however small, has to give the same tokens,
+        positions and errors as streaming it.
+    """
+
+    def tokens(self, lexer):
+        output = []
+        try:
+            output.extend((token.text, token.kind, token.line, token.column) for token in lexer)
+        except CompileError as error:
+            output.append((str(error), error.line, error.column))
+        return output
+
+    def lex(self, source: str, jobs: int, chunk_size: int):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "program.tiny")
+            with open(path, "w", newline="") as source_file:
+                source_file.write(source)
+            with open(path, "r") as source_file:
+                expected = self.tokens(StreamLexer(source_file))
+            with ParallelLexer(path, jobs, chunk_size) as lexer:
+                self.assertEqual(self.tokens(lexer), expected)
+
+    def test_matches_stream_lexer(self):
+        sources = []
+        for name in ["statements", "fibonacci", "average"]:
+            with open(f"tiny/{name}.tiny", "r") as source_file:
+                sources.append(source_file.read())
+        sources += ["", "\n", "LET a = 1", "PRINT a\r\nPRINT b\rPRINT c\n", "PRINT 1\nLET a = $\nPRINT 2\n"]
+        for source in sources:
+            for chunk_size in [1, 7, 1 << 20]:
+                self.lex(source, 1, chunk_size)
+        self.lex(sources[0], 2, 16)
+
+    def test_errors_wait_for_the_parser(self):
+        # The parser fails on line 2 before it gets to the lexing error in a later chunk.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "program.tiny")
+            with open(path, "w") as source_file:
+                source_file.write("PRINT 1\nPRINT\nPRINT 2\nLET a = $\n")
+            with ParallelLexer(path, 2, 8) as lexer:
+                with self.assertRaises(ParserError) as context:
+                    TreeParser(lexer).program()
+            self.assertEqual(context.exception.line, 2)
+
+
+class TestTreeParser(unittest.TestCase):
+    """ The syntax tree, and the C generated from it.
+    """
+
+    def compile(self, source: str, parser_class) -> str:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.c")
+            emitter = Emitter(path)
+            if parser_class is TreeParser:
+                CGenerator(emitter).program(TreeParser(Lexer(source)).program())
+            else:
+                parser_class(Lexer(source), emitter).program()
+            emitter.write()
+            with open(path, "r") as output_file:
+                return output_file.read()
+
+    def test_tree(self):
+        program = TreeParser(Lexer("LET a = -1 + 2 * a\nIF a > 0 THEN\nPRINT a\nENDIF")).program()
+        a = nodes.Primary(TokenType.IDENT, "a")
+        self.assertEqual(
+            program.statements,
+            [
+                nodes.Let(
+                    "a",
+                    nodes.Expression(
+                        [
+                            nodes.Term([nodes.Unary("-", nodes.Primary(TokenType.NUMBER, "1"))], []),
+                            nodes.Term(
+                                [nodes.Unary(None, nodes.Primary(TokenType.NUMBER, "2")), nodes.Unary(None, a)],
+                                ["*"],
+                            ),
+                        ],
+                        ["+"],
+                    ),
+                    1,
+                ),
+                nodes.If(
+                    nodes.Comparison(
+                        [
+                            nodes.Expression([nodes.Term([nodes.Unary(None, a)], [])], []),
+                            nodes.Expression(
+                                [nodes.Term([nodes.Unary(None, nodes.Primary(TokenType.NUMBER, "0"))], [])], []
+                            ),
+                        ],
+                        [">"],
+                    ),
+                    [nodes.Print(nodes.Expression([nodes.Term([nodes.Unary(None, a)], [])], []), 3)],
+                    2,
+                ),
+            ],
+        )
+
+    def test_matches_parser(self):
+        source = "LABEL top\nINPUT n\nIF n >= 10 THEN\nGOTO top\nENDIF\nWHILE n != 0 REPEAT\nLET n = n - 1 / 2\nENDWHILE"
+        self.assertEqual(self.compile(source, TreeParser), self.compile(source, Parser))
+        self.assertIn("goto top;\n}\nwhile", self.compile(source, TreeParser))
+
+    def test_errors(self):
+        sources = [
+            "PRINT a",
+            "GOTO nowhere",
+            "LABEL a\nLABEL a",
+            "LET = 1",
+            "IF 1 > 0 THEN\nWHILE 1 > 0 REPEAT\nPRINT 1\nENDIF\nENDWHILE",
+            "WHILE 1 > 0 REPEAT\nPRINT 1",
+            "ENDIF",
+            "LET a = 1 + * 2",
+        ]
+        for source in sources:
+            with self.assertRaises(CompileError) as tree_error:
+                self.compile(source, TreeParser)
+            with self.assertRaises(CompileError) as parser_error:
+                self.compile(source, Parser)
+            self.assertEqual(str(tree_error.exception), str(parser_error.exception))
+            self.assertEqual(tree_error.exception.line, parser_error.exception.line)
+
+    def test_deep_nesting(self):
+        # Far deeper than Python's recursion limit, through every way of compiling.
+        depth = 5000
+        opens = ["IF a > 0 THEN" if level % 2 else "WHILE a < 1 REPEAT" for level in range(depth)]
+        closes = ["ENDIF" if level % 2 else "ENDWHILE" for level in reversed(range(depth))]
+        source = "\n".join(["LET a = 0", *opens, "LET a = a + 1", *closes, "PRINT a"])
+        code = self.compile(source, Parser)
+        self.assertEqual(code.count("while (a<1) {\n"), depth // 2)
+        self.assertTrue(code.endswith("a = a+1;\n" + "}\n" * depth + 'printf("%.2f\\n", (float)(a));\nreturn 0;\n}\n'))
+        self.assertEqual(self.compile(source, TreeParser), code)
+        for level in [1, 2]:
+            self.assertEqual(compiler.compile_string(source, compiler.Options(optimize=level)).code, code)
+        # Only block writes IFs and WHILEs, so none slips past its stack uninstrumented.
+        program = TreeParser(Lexer("LET a = 0\nIF a > 0 THEN\nENDIF\nWHILE a < 0 REPEAT\nENDWHILE")).program()
+        for node in program.statements[1:]:
+            with self.assertRaises(TypeError):
+                CGenerator(Emitter(os.devnull)).statement(node)
+
+
+class TestCompiler(unittest.TestCase):
+    """ The library API compiles a string and raises exceptions rather than exiting.
+    """
+
+    def test_examples(self):
+        for name in ["statements", "fibonacci", "average"]:
+            with open(f"tiny/{name}.tiny", "r") as source_file:
+                source = source_file.read()
+            with open(f"reference/{name}.c", "r") as reference_file:
+                reference = reference_file.read()
+            self.assertEqual(compiler.compile_string(source).code, reference)
+            self.assertEqual(compiler.compile_string(source, compiler.Options(ast=True)).code, reference)
+
+    def test_errors(self):
+        with self.assertRaises(LexerError) as error:
+            compiler.compile_string('PRINT "ok"\nLET a = 1 $ 2')
+        self.assertEqual((error.exception.line, error.exception.column), (2, 11))
+        self.assertEqual(str(error.exception), "Lexing error. Unknown token: $")
+        with self.assertRaises(ParserError) as error:
+            compiler.compile_string("LET a = 1\n\nPRINT a +", compiler.Options(optimize=2))
+        self.assertEqual((error.exception.line, error.exception.column), (3, 10))
+        self.assertEqual(error.exception.message, "Unexpected token at \n")
+
+
+class TestIR(unittest.TestCase):
+    """ A parsed program written as IR reads back as the same tree, without lexing or parsing.
+    """
+
+    def test_round_trip(self):
+        sources = [bench.PROGRAMS[name](300, bench.random.Random(0)) for name in bench.PROGRAMS]
+        for name in ["statements", "fibonacci", "average"]:
+            with open(f"tiny/{name}.tiny", "r") as source_file:
+                sources.append(source_file.read())
+        sources.append("LET a = 1\nIF a > 1 == a THEN\nPRINT -a * +2.5 / a - 1 + a\nENDIF\nPRINT \"\"")
+        for source in sources:
+            program = TreeParser(RegexLexer(source)).program()
+            self.assertEqual(ir.loads(ir.dumps(program)), program)
+
+    def test_deep_nesting(self):
+        depth = 10000
+        source = "LET a = 0\n" + "WHILE a < 1 REPEAT\n" * depth + "PRINT a\n" + "ENDWHILE\n" * depth
+        node = ir.loads(ir.dumps(TreeParser(RegexLexer(source)).program())).statements[-1]
+        for _ in range(depth - 1):
+            self.assertIsInstance(node, nodes.While)
+            node = node.body[0]
+        a = nodes.Unary(None, nodes.Primary(TokenType.IDENT, "a"))
+        self.assertEqual(node.body, [nodes.Print(nodes.Expression([nodes.Term([a], [])], []), depth + 2)])
+
+    def test_compile_ir(self):
+        # --emit-ir writes the program, and compiling the file it wrote gives the same C.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "fibonacci.ir")
+            run_main(directory, "--emit-ir", path, os.path.abspath("tiny/fibonacci.tiny"), check=True)
+            self.assertTrue(ir.is_ir(path))
+            run_main(directory, "--no-cache", path, check=True)
+            with open(os.path.join(directory, "out.c"), "r") as output_file:
+                output = output_file.read()
+        with open("reference/fibonacci.c", "r") as reference_file:
+            self.assertEqual(output, reference_file.read())
+
+    def test_bad_files(self):
+        data = ir.dumps(TreeParser(RegexLexer("LET a = 1\nPRINT a + 2")).program())
+        for bad in [b"", b"TTIR", b"LET a = 1\n" * 2, data[:-4], data[:-1] + b"\xff"]:
+            with self.assertRaises(ValueError):
+                ir.loads(bad)
+        # Cut off anywhere, including inside the header or a table's own header.
+        for end in range(len(data)):
+            with self.assertRaises(ValueError):
+                ir.loads(data[:end])
+
+    def test_limits(self):
+        # A program too big for the words it's packed into is refused, not mangled.
+        program = TreeParser(RegexLexer("LET a = 1\nLET b = a\nLET c = b + a + a")).program()
+        program.statements[0].line = ir.MAX_LINES - 1
+        self.assertEqual(ir.loads(ir.dumps(program)).statements[0].line, ir.MAX_LINES - 1)
+        program.statements[0].line = ir.MAX_LINES
+        with self.assertRaisesRegex(ValueError, "at most 536870911 lines"):
+            ir.dumps(program)
+        program.statements[0].line = 1
+        small = TreeParser(RegexLexer("LET a = 1\nLET b = a")).program()
+        for limit, message in [("MAX_INDEX", "at most 2 distinct identifiers"), ("MAX_UNARIES", "at most 1 unaries")]:
+            with mock.patch.object(ir, limit, 2):
+                ir.dumps(small)
+                with self.assertRaisesRegex(ValueError, message):
+                    ir.dumps(program)
+
+
+class TestStats(unittest.TestCase):
+    """ --stats counts what went through each phase, and subscribers hear about it.
+    """
+
+    def test_report(self):
+        source = "LET a = 1\nWHILE a < 3 REPEAT\nIF a == 2 THEN\nPRINT a + 2 * 3 - a\nENDIF\nLET a = a + 1\nENDWHILE"
+        result = compiler.compile_string(source, compiler.Options(stats=True))
+        self.assertEqual(result.code, compiler.compile_string(source).code)
+        report = result.stats
+        self.assertEqual(list(report["phases"]), ["lex", "parse", "optimize", "generate", "write"])
+        self.assertEqual(report["tokens"], 37)
+        self.assertEqual(report["statements_by_kind"], {"IF": 1, "LET": 2, "PRINT": 1, "WHILE": 1})
+        self.assertEqual(report["max_block_depth"], 2)
+        self.assertEqual(report["max_expression_depth"], 3)  # ((a + (2 * 3)) - a)
+        self.assertEqual(report["bytes_emitted"], len(result.code))
+
+    def test_subscribe(self):
+        events = []
+        callback = lambda event, data: events.append((event, data.get("name")))
+        stats.subscribe(callback)
+        try:
+            compiler.compile_string("PRINT 1")
+        finally:
+            stats.unsubscribe(callback)
+        compiler.compile_string("PRINT 2")
+        self.assertEqual(
+            events,
+            [("phase", "lex"), ("phase", "parse"), ("phase", "optimize"), ("phase", "generate"),
+             ("phase", "write"), ("compile", None)],
+        )
+
+    def test_command_line(self):
+        with tempfile.TemporaryDirectory() as directory:
+            result = run_main(directory, "--stats", os.path.abspath("tiny/fibonacci.tiny"), capture_output=True, text=True)
+            with open(os.path.join(directory, "out.c"), "r") as output_file:
+                output = output_file.read()
+        self.assertEqual(json.loads(result.stdout)["statements"], 11)
+        with open("reference/fibonacci.c", "r") as reference_file:
+            self.assertEqual(output, reference_file.read())
+
+
+class TestIncremental(unittest.TestCase):
+    """ Recompiling after an edit gives the same C, or error, as compiling from scratch.
+    """
+
+    def check(self, incremental: IncrementalCompiler, source: str) -> None:
+        try:
+            expected = compiler.compile_string(source).code
+        except CompileError as error:
+            with self.assertRaises(CompileError) as incremental_error:
+                incremental.update(source)
+            self.assertEqual(str(incremental_error.exception), str(error))
+            self.assertEqual(incremental_error.exception.line, error.line)
+        else:
+            self.assertEqual(incremental.update(source).code, expected)
+
+    def test_edits(self):
+        with open("tiny/fibonacci.tiny", "r") as source_file:
+            lines = source_file.read().split("\n")
+        incremental = IncrementalCompiler()
+        self.check(incremental, "\n".join(lines))
+        edits = [
+            (3, 4, ["LET a = 1 + 2 * 3"]),  # Change a statement.
+            (5, 5, ["", "PRINT \"more\"", "LET x = a"]),  # Add some.
+            (10, 11, []),  # Break a WHILE by removing its ENDWHILE...
+            (10, 10, ["ENDWHILE"]),  # ...and mend it.
+            (1, 1, ["PRINT y"]),  # Read a variable before it's assigned.
+            (1, 2, ["LABEL y", "GOTO y"]),
+        ]
+        for start, end, replacement in edits:
+            lines[start:end] = replacement
+            self.check(incremental, "\n".join(lines))
+
+
+class TestFolding(unittest.TestCase):
+    """ Constant folding has to keep C's types: ints stay ints
+        (so 7 / 2 is 3), and only leading constants get folded.
+    """
+
+    def compile(self, source: str) -> str:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.c")
+            emitter = Emitter(path)
+            program = optimize(TreeParser(Lexer(source)).program(), 1)
+            CGenerator(emitter).program(program)
+            emitter.write()
+            with open(path, "r") as output_file:
+                return output_file.read().split("int main (void) {\n")[1]
+
+    def test_arithmetic(self):
+        self.assertIn("x = 6.5;", self.compile("LET x = 7 / 2 + 1.5 * 2 + 0.5"))
+        self.assertIn("x = -4;", self.compile("LET x = 2 - 3 * 2"))
+        self.assertIn("x = 0.30000000000000004;", self.compile("LET x = 0.1 + 0.2"))
+
+    def test_leading_constants_only(self):
+        self.assertIn("y = 6*x*2*3;", self.compile("LET x = 1\nLET y = 2 * 3 * x * 2 * 3"))
+
+    def test_identities(self):
+        output = self.compile("LET x = 1\nLET y = 1 * x * 1 / 1 - 0 + 0 - -2 * x")
+        self.assertIn("y = x+0+2*x;", output)
+
+    def test_not_folded(self):
+        # Division by zero and overflow are left for the C compiler.
+        self.assertIn("x = 1/0;", self.compile("LET x = 1 / 0"))
+        self.assertIn("x = 65536*65536;", self.compile("LET x = 65536 * 65536"))
+
+    def test_comparisons(self):
+        output = self.compile("IF 1 < 2 < 3 THEN\nENDIF\nWHILE 2 == 2.5 REPEAT\nENDWHILE")
+        self.assertIn("if (1) {", output)
+        self.assertIn("while (0) {", output)
+
+
+class TestDeadCode(unittest.TestCase):
+    """ Dead code elimination (-O2).
+    """
+
+    def compile(self, source: str) -> str:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.c")
+            emitter = Emitter(path)
+            program = optimize(TreeParser(Lexer(source)).program(), 2)
+            CGenerator(emitter).program(program)
+            emitter.write()
+            with open(path, "r") as output_file:
+                return output_file.read().split("int main (void) {\n")[1]
+
+    def test_after_goto(self):
+        source = "GOTO end\nPRINT 1\nLABEL unused\nPRINT 2\nLABEL end\nPRINT 3"
+        self.assertEqual(self.compile(source), 'goto end;\nend:\nprintf("%.2f\\n", (float)(3));\nreturn 0;\n}\n')
+
+    def test_label_inside_block_is_kept(self):
+        source = "LET a = 1\nGOTO inner\nWHILE a < 2 REPEAT\nLABEL inner\nLET a = a + 1\nENDWHILE"
+        self.assertIn("while (a<2) {\ninner:\na = a+1;\n}", self.compile(source))
+
+    def test_false_conditions(self):
+        source = "LET a = 1\nIF 1 > 2 THEN\nPRINT a\nENDIF\nWHILE 1 - 1 REPEAT\nPRINT a\nENDWHILE\nPRINT a"
+        self.assertEqual(self.compile(source), 'float a;\na = 1;\nprintf("%.2f\\n", (float)(a));\nreturn 0;\n}\n')
+
+    def test_unread_variables(self):
+        # b is only read by c, which is never read, so both go. a is still declared for INPUT.
+        source = "LET a = 1\nLET b = 2\nLET c = b\nINPUT a"
+        self.assertEqual(self.compile(source).split("if(0")[0], "float a;\n")
+
+    def test_skipped_declaration(self):
+        # The LET is unreachable but x still needs declaring for the PRINT.
+        output = self.compile("GOTO skip\nLET x = 1\nLABEL skip\nPRINT x")
+        self.assertTrue(output.startswith("float x;\ngoto skip;\nskip:\n"))
+
+
+class TestLoops(unittest.TestCase):
+    """ -O3 moves loop invariants out of WHILE loops, reduces multiplying
+        a loop counter to adding, and computes common subexpressions once.
+    """
+
+    def compile(self, source: str, level: int = 3) -> str:
+        return compiler.compile_string(source, compiler.Options(optimize=level)).code.split("int main (void) {\n")[1]
+
+    def test_hoisting(self):
+        source = "LET a = 3\nLET b = 0\nWHILE b < a * 4 REPEAT\nPRINT a / 2 * a + b\nLET b = b + a * 4\nENDWHILE"
+        self.assertIn(
+            "_t1 = a*4;\n_t2 = a/2*a;\nwhile (b<_t1) {\n"
+            'printf("%.2f\\n", (float)(_t2+b));\nb = b+_t1;\n}\n',
+            self.compile(source),
+        )
+
+    def test_not_hoisted(self):
+        # A GOTO could jump into the first loop; in the second, 7 / 0 would crash if moved out;
+        # 1.5 makes a double, which a float variable would round.
+        sources = [
+            "LET a = 3\nLET b = 0\nWHILE b < 5 REPEAT\nLABEL top\nLET b = b + a * 4\nIF b < 3 THEN\nGOTO top\nENDIF\nENDWHILE",
+            "LET a = 0\nLET b = 0\nWHILE b < a REPEAT\nLET b = b + 7 / 0 * a\nENDWHILE",
+            "LET a = 3\nLET b = 0\nWHILE b < 5 REPEAT\nLET b = b + a * 1.5\nENDWHILE",
+        ]
+        for source in sources:
+            self.assertNotIn("_t", self.compile(source))
+
+    def test_strength_reduction(self):
+        source = "LET i = 0\nWHILE i <= 10 REPEAT\nPRINT i * 3 + 1\nLET i = i + 2\nPRINT 3 * i\nENDWHILE"
+        self.assertIn(
+            'i = 0;\n_t1 = i*3;\nwhile (i<=10) {\nprintf("%.2f\\n", (float)(_t1+1));\ni = i+2;\n_t1 = _t1+6;\n'
+            'printf("%.2f\\n", (float)(_t1));\n}\n',
+            self.compile(source),
+        )
+        # Not a counter: it isn't set to a constant, or the loop can't run far enough to be exact.
+        for source in [
+            "INPUT i\nWHILE i < 10 REPEAT\nPRINT i * 3\nLET i = i + 1\nENDWHILE",
+            "LET i = 0\nWHILE i < 10000000 REPEAT\nPRINT i * 3\nLET i = i + 1\nENDWHILE",
+        ]:
+            self.assertNotIn("_t", self.compile(source))
+
+    def test_common_subexpressions(self):
+        source = "INPUT a\nINPUT b\nPRINT a * b + 1\nLET c = a * b + 1 - a\nINPUT a\nPRINT a * b + c"
+        self.assertIn('_t1 = a*b+1;\nprintf("%.2f\\n", (float)(_t1));\nc = _t1-a;\n', self.compile(source))
+        # a changed, so the last a * b isn't the same.
+        self.assertEqual(self.compile(source).count("a*b"), 2)
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_examples(self):
+        loops = "\n".join(
+            [
+                "INPUT n",
+                "LET t = 0",
+                "LET i = 0",
+                "WHILE i < 20 REPEAT",
+                "LET j = 5",
+                "WHILE j > -5 REPEAT",
+                "LET t = t + i * 7 - n * 0.5 + n / 3 * j",
+                "IF i * 7 > n / 3 * 2 THEN",
+                "PRINT n / 3 * 2 - i * 7",
+                "ENDIF",
+                "LET j = j - 3",
+                "ENDWHILE",
+                "LET i = i + 1",
+                "ENDWHILE",
+                "PRINT t",
+            ]
+        )
+        sources = []
+        for name in ["statements", "fibonacci", "average"]:
+            with open(f"tiny/{name}.tiny", "r") as source_file:
+                sources.append(source_file.read())
+        for source in sources + [loops]:
+            outputs = []
+            for level in [0, 3]:
+                with tempfile.TemporaryDirectory() as directory:
+                    path = os.path.join(directory, "out.c")
+                    with open(path, "w") as c_file:
+                        c_file.write(compiler.compile_string(source, compiler.Options(optimize=level)).code)
+                    binary = os.path.join(directory, "out")
+                    subprocess.run(["cc", "-o", binary, path], check=True)
+                    outputs.append(subprocess.run([binary], input="5 1 2 3 4 5", capture_output=True, text=True).stdout)
+            self.assertEqual(outputs[1], outputs[0])
+            program = optimize(TreeParser(Lexer(source)).program(), 3)
+            output = io.StringIO()
+            vm.run(vm.compile_program(program), io.StringIO("5 1 2 3 4 5"), output)
+            self.assertEqual(output.getvalue(), outputs[0])
+
+
+class TestIntVars(unittest.TestCase):
+    """ --int-vars declares variables that only hold integers as long,
+        and has to print the same as when they were floats.
+    """
+
+    def compile(self, source: str) -> str:
+        return compiler.compile_string(source, compiler.Options(int_vars=True)).code
+
+    def test_inference(self):
+        with open("tiny/fibonacci.tiny", "r") as source_file:
+            code = self.compile(source_file.read())
+        # The numbers grow without a bound, past where floats stop being exact.
+        self.assertIn("float nums;\nfloat a;\nfloat b;\nfloat c;\n", code)
+        source = "\n".join(
+            [
+                "LET a = 1",
+                "LET b = a / 2",  # Division.
+                "LET c = 1.5",  # A double literal.
+                "LET d = c + 1",  # A float variable.
+                "LET e = a * 3 + 4 - a",
+                "LET f = a * -2",  # Could be -0.0.
+                "LET g = a * a",
+                "LET h = 16777217",  # Too big to be exact as a float.
+                "LET i = 1\nPRINT -i",  # Negated.
+                "LET j = 0\nWHILE j < 1000 REPEAT\nLET k = j * 3 + 2\nLET l = l + j\nLET j = j + 1\nENDWHILE",
+                "LET m = 0\nWHILE m < 5000 REPEAT\nPRINT m * 5000\nLET m = m + 1\nENDWHILE",  # Out of range.
+            ]
+        )
+        declarations = [line.split() for line in self.compile(source).splitlines() if line.startswith(("long ", "float "))]
+        types = {name[:-1]: kind for kind, name in declarations}
+        self.assertEqual(
+            {name: types[name] for name in "abcdefghijklm"},
+            {name: "long" if name in "aejk" else "float" for name in "abcdefghijklm"},
+        )
+
+    def test_float_terms(self):
+        # Where integer arithmetic would differ, the longs are converted back to floats.
+        code = self.compile("LET a = 7\nLET x = a / 2 * a\nLET y = a * -1 + a * 2")
+        self.assertIn("x = (float)a/2*(float)a;", code)
+        self.assertIn("y = (float)a*-1+a*2;", code)
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_matches_floats(self):
+        source = "\n".join(
+            [
+                "LET a = 0",
+                "LET b = 5",
+                "WHILE b > -3 REPEAT",
+                "PRINT a * -1",
+                "PRINT 0 * b",
+                "PRINT b / 2",
+                "LET c = b * 2 - a",
+                "PRINT c",
+                "LET b = b - 1",
+                "ENDWHILE",
+            ]
+        )
+        code = self.compile(source)
+        self.assertIn("long a;\nlong b;\nlong c;\n", code)
+        outputs = []
+        for c_code in [compiler.compile_string(source).code, code]:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "out.c")
+                with open(path, "w") as c_file:
+                    c_file.write(c_code)
+                binary = os.path.join(directory, "out")
+                subprocess.run(["cc", "-o", binary, path], check=True)
+                outputs.append(subprocess.run([binary], capture_output=True, text=True).stdout)
+        self.assertIn("-0.00", outputs[0])
+        self.assertEqual(outputs[1], outputs[0])
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_fibonacci_matches_floats(self):
+        # Past the 36th number, floats round and longs wouldn't.
+        with open("tiny/fibonacci.tiny", "r") as source_file:
+            source = source_file.read()
+        outputs = []
+        for options in [compiler.Options(), compiler.Options(int_vars=True)]:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "out.c")
+                with open(path, "w") as c_file:
+                    c_file.write(compiler.compile_string(source, options).code)
+                binary = os.path.join(directory, "out")
+                subprocess.run(["cc", "-o", binary, path], check=True)
+                outputs.append(subprocess.run([binary], input="100", capture_output=True, text=True).stdout)
+        self.assertIn("165580128.00", outputs[0])
+        self.assertEqual(outputs[1], outputs[0])
+
+
+class TestBufferedIO(unittest.TestCase):
+    """ --buffered-io prints and reads through a runtime of its own,
+        which has to behave exactly like printf and scanf.
+    """
+
+    def test_code(self):
+        code = compiler.compile_string('INPUT a\nPRINT a\nPRINT "a"', compiler.Options(buffered_io=True)).code
+        self.assertIn('if(0 == tt_scan(&a)) {\na = 0;\ntt_skip();\n}\ntt_print((float)(a));\ntt_puts("a\\n");\n', code)
+        self.assertTrue(code.endswith("tt_flush();\nreturn 0;\n}\n"))
+        self.assertNotIn("scanf(", code.split("int main")[1])
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_matches_stdio(self):
+        source = "\n".join(
+            [
+                'PRINT "Numbers:"',
+                "LET n = 0",
+                "WHILE n < 30 REPEAT",
+                "INPUT a",
+                "PRINT a",
+                "PRINT a * 100",
+                "PRINT a / 3",
+                "PRINT 0 - a",
+                "LET n = n + 1",
+                "ENDWHILE",
+            ]
+        )
+        inputs = [
+            "2.5 oops 1e+x 1.5e 0x1p-3 0x 0x. 0x.p5 .5 . +. -0 -0.001 0.005 0.015 1.005 99999.995",
+            "inf infin infinityx nan NaNa -nan 1e40 1e-50 16777217 123456789012345678901234567 1e13 \0 1.2.3",
+        ]
+        outputs = {}
+        for buffered_io in [False, True]:
+            code = compiler.compile_string(source, compiler.Options(buffered_io=buffered_io)).code
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "out.c")
+                with open(path, "w") as c_file:
+                    c_file.write(code)
+                binary = os.path.join(directory, "out")
+                subprocess.run(["cc", "-o", binary, path], check=True)
+                outputs[buffered_io] = [
+                    subprocess.run([binary], input=input.encode(), capture_output=True).stdout for input in inputs
+                ]
+        self.assertEqual(outputs[True], outputs[False])
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_macro_names(self):
+        # The runtime's headers mustn't define anything a variable could be called.
+        source = "LET NAN = 1\nLET INFINITY = 2\nPRINT NAN + INFINITY"
+        code = compiler.compile_string(source, compiler.Options(buffered_io=True)).code
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.c")
+            with open(path, "w") as c_file:
+                c_file.write(code)
+            binary = os.path.join(directory, "out")
+            subprocess.run(["cc", "-o", binary, path], check=True)
+            self.assertEqual(subprocess.run([binary], capture_output=True, text=True).stdout, "3.00\n")
+
+
+class TestInstrument(unittest.TestCase):
+    """ --instrument counts each statement and times each loop,
+        and report.py puts the counts back against the source.
+    """
+
+    source = "LET i = 0\nWHILE i < 5 REPEAT\nIF i > 2 THEN\nGOTO skip\nENDIF\nPRINT i\nLABEL skip\nLET i = i + 1\nENDWHILE"
+
+    def test_code(self):
+        code = compiler.compile_string(self.source, compiler.Options(instrument=True)).code
+        self.assertIn("tt_counts[1]++;\ntt_start(0);\nwhile (i<5) {\ntt_counts[2]++;\nif (i>2) {\n", code)
+        self.assertIn("skip:\ntt_counts[5]++;\n", code)
+        self.assertIn("}\ntt_stop(0);\ntt_profile(tt_lines, tt_counts, 7, tt_loop_lines, tt_clocks, 1);\nreturn 0;\n}\n", code)
+        self.assertIn("static const unsigned long tt_lines[] = {\n1, 2, 3, 4, 6, 7, 8,\n};\n", code)
+
+    def run_instrumented(self, source: str):
+        # What the program prints, and the profile it writes.
+        code = compiler.compile_string(source, compiler.Options(instrument=True)).code
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.c")
+            with open(path, "w") as c_file:
+                c_file.write(code)
+            binary = os.path.join(directory, "out")
+            subprocess.run(["cc", "-o", binary, path], check=True)
+            profile_path = os.path.join(directory, "out.profile")
+            result = subprocess.run([binary], capture_output=True, text=True, env={"TT_PROFILE": profile_path})
+            return result.stdout, report.read_profile(profile_path)
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_profile(self):
+        output, profile = self.run_instrumented(self.source)
+        self.assertEqual(output, "0.00\n1.00\n2.00\n")
+        self.assertEqual(profile.counts, {1: 1, 2: 1, 3: 5, 4: 2, 6: 3, 7: 5, 8: 5})
+        self.assertEqual(list(profile.seconds), [2])
+        rows = report.annotate(profile, self.source.splitlines())
+        self.assertEqual(rows[4], "           2                4: GOTO skip")
+        self.assertEqual(rows[5], "                            5: ENDIF")
+        self.assertEqual(report.hottest(profile, self.source.splitlines(), 1)[1:], [rows[3]])
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_goto_into_loop(self):
+        # The second loop is entered by GOTO, so it was never started and has no time to add. A
+        # variable named clock mustn't get in the way of timing either.
+        source = (
+            "LET clock = 0\nLET i = 0\nWHILE i < 100000 REPEAT\nLET i = i + 1\nENDWHILE\nGOTO inside\n"
+            "WHILE clock < 1 REPEAT\nLABEL inside\nLET clock = clock + 1\nENDWHILE\nPRINT clock"
+        )
+        output, profile = self.run_instrumented(source)
+        self.assertEqual(output, "1.00\n")
+        self.assertEqual((profile.counts[7], profile.counts[9]), (0, 1))
+        self.assertEqual(profile.seconds[7], 0.0)
+
+
+class TestVM(unittest.TestCase):
+    """ The bytecode interpreter behind --run has to print exactly
+        what the compiled C program would.
+    """
+
+    def run_program(self, source: str, input: str = "") -> str:
+        output = io.StringIO()
+        vm.run(vm.compile_program(TreeParser(Lexer(source)).program()), io.StringIO(input), output)
+        return output.getvalue()
+
+    def run_c(self, source: str, input: str = "") -> str:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.c")
+            emitter = Emitter(path)
+            CGenerator(emitter).program(TreeParser(Lexer(source)).program())
+            emitter.write()
+            binary = os.path.join(directory, "out")
+            subprocess.run(["cc", "-o", binary, path], check=True)
+            return subprocess.run([binary], input=input, capture_output=True, text=True).stdout
+
+    def test_fibonacci(self):
+        with open("tiny/fibonacci.tiny", "r") as source_file:
+            output = self.run_program(source_file.read(), "6")
+        self.assertEqual(
+            output,
+            "How many fibonacci numbers do you want?\n\n0.00\n1.00\n1.00\n2.00\n3.00\n5.00\n",
+        )
+
+    def test_division_by_zero(self):
+        with self.assertRaises(ZeroDivisionError):
+            self.run_program("PRINT 7 / 0")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "zero.tiny")
+            with open(path, "w") as source_file:
+                source_file.write("PRINT 7 / 0")
+            for engine in ["vm", "python"]:
+                result = subprocess.run(
+                    ["python3", "main.py", "--run", "--engine", engine, path], capture_output=True, text=True
+                )
+                self.assertEqual((result.returncode, result.stderr), (1, "Runtime error. Integer division by zero.\n"))
+
+    def test_c_types(self):
+        # Literals are ints or doubles, variables are floats.
+        output = self.run_program("PRINT 7 / 2\nLET x = 16777217\nPRINT x\nPRINT 1 / 3.0 * 3\nLET y = 0.1\nPRINT y * 100000000")
+        self.assertEqual(output, "3.00\n16777216.00\n1.00\n10000000.00\n")
+
+    def test_input(self):
+        source = "INPUT a\nPRINT a\nINPUT a\nPRINT a\nINPUT a\nPRINT a\nINPUT a\nPRINT a"
+        self.assertEqual(self.run_program(source, "2.5 oops 1e+x"), "2.50\n0.00\n1.00\n0.00\n")
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_matches_c(self):
+        for name, input in [("fibonacci", "25"), ("average", "4 1 2.5 x 7")]:
+            with open(f"tiny/{name}.tiny", "r") as source_file:
+                source = source_file.read()
+            self.assertEqual(self.run_program(source, input), self.run_c(source, input))
+        source = "INPUT a\nLET b = a * 3 / 7 + 0.1\nIF b >= 1 THEN\nPRINT b - 1\nENDIF\nPRINT 1 / a\nPRINT 0 - a * 10.5"
+        for input in ["3", "-0", "inf", "0x1p-3", "1e40", "junk"]:
+            self.assertEqual(self.run_program(source, input), self.run_c(source, input))
+
+    def test_large_programs(self):
+        # Deeper and longer than Python allows its own code to nest.
+        source = "LET a = 0\n" + "WHILE a < 1 REPEAT\n" * 21 + "PRINT a\nLET a = 1\n" + "ENDWHILE\n" * 21
+        self.assertEqual(self.run_program(source), "0.00\n")
+        source = "LET a = 0\n" + "IF a < 1 THEN\n" * 120 + "PRINT a\n" + "ENDIF\n" * 120
+        self.assertEqual(self.run_program(source), "0.00\n")
+        source = "LET a = 1.5\nPRINT " + " + ".join(["a"] * 300) + "\nPRINT " + " - ".join(["a / 3 * 2"] * 300)
+        self.assertEqual(self.run_program(source), "450.00\n-298.00\n")
+        source = "LET i = 0\n" + "".join(
+            f"LABEL l{k}\nLET i = i + 1\nIF i < 3 THEN\nGOTO l{k}\nENDIF\nLET i = i - 3\n" for k in range(4000)
+        )
+        self.assertEqual(self.run_program(source + "PRINT i"), "0.00\n")
+
+
+class TestTieredVM(TestVM):
+    """ --run --engine tiered translates hot loops to Python, and has to
+        print the same as interpreting them. Every loop is hot here.
+    """
+
+    def run_program(self, source: str, input: str = "", hot_loop: int = 1) -> str:
+        output = io.StringIO()
+        code = vm.compile_program(TreeParser(Lexer(source)).program())
+        vm.run(code, io.StringIO(input), output, hot_loop)
+        return output.getvalue()
+
+    def test_hot_loops(self):
+        source = "LET i = 0\nWHILE i < 5 REPEAT\nLET j = 0\nWHILE j < i REPEAT\nLET j = j + 1\nENDWHILE\nLET i = i + 1\nENDWHILE\nPRINT i + j"
+        with mock.patch("pygen.compile_loop", wraps=pygen.compile_loop) as compile_loop:
+            self.assertEqual(self.run_program(source, hot_loop=3), "9.00\n")
+        # Both get hot in the outer loop's third time round, the inner one first.
+        self.assertEqual([call.args[0].line for call in compile_loop.call_args_list], [4, 2])
+
+    def test_loops_python_cannot_compile_stay_interpreted(self):
+        source = "LET i = 0\nWHILE i < 5 REPEAT\nLET i = i + 1\nENDWHILE\nPRINT i"
+        for error in [SyntaxError("too many statically nested blocks"), RecursionError(), MemoryError()]:
+            with mock.patch("pygen.compile_loop", side_effect=error) as compile_loop:
+                self.assertEqual(self.run_program(source), "5.00\n")
+            # Tried once, when it got hot, and never again.
+            self.assertEqual(compile_loop.call_count, 1)
+
+    def test_loops_with_labels_stay_interpreted(self):
+        source = "LET i = 0\nWHILE i < 5 REPEAT\nLABEL a\nLET i = i + 1\nENDWHILE\nIF i < 9 THEN\nGOTO a\nENDIF\nPRINT i"
+        with mock.patch("pygen.compile_loop") as compile_loop:
+            self.assertEqual(self.run_program(source), "9.00\n")
+        compile_loop.assert_not_called()
+
+
+class TestPythonEngine(TestVM):
+    """ --run --engine python translates the program to Python instead,
+        and has to print the same.
+    """
+
+    def run_program(self, source: str, input: str = "") -> str:
+        output = io.StringIO()
+        pygen.run(pygen.compile_program(TreeParser(Lexer(source)).program()), io.StringIO(input), output)
+        return output.getvalue()
+
+    def test_goto(self):
+        source = "LET i = 0\nLABEL top\nLET i = i + 1\nIF i < 3 THEN\nGOTO top\nENDIF\nGOTO end\nPRINT 0\nLABEL end\nPRINT i"
+        self.assertEqual(self.run_program(source), "3.00\n")
+
+    @unittest.skipUnless(shutil.which("cc"), "needs a C compiler")
+    def test_examples_match_c(self):
+        for name in ["statements", "fibonacci", "average"]:
+            with open(f"tiny/{name}.tiny", "r") as source_file:
+                source = source_file.read()
+            self.assertEqual(self.run_program(source, "5 1 2 3 4 5"), self.run_c(source, "5 1 2 3 4 5"))
+
+
+@unittest.skipIf(batch.numpy is None, "needs NumPy")
+class TestBatchExecution(unittest.TestCase):
+    """ Running a program over a batch has to print, in every lane, what
+        running it once on that lane's input does.
+    """
+
+    def run_batch(self, source: str, columns, lengths=None) -> batch.Result:
+        program = TreeParser(Lexer(source)).program()
+        return batch.run(batch.compile_program(program), columns, lengths)
+
+    def run_program(self, source: str, input: str) -> str:
+        output = io.StringIO()
+        vm.run(vm.compile_program(TreeParser(Lexer(source)).program()), io.StringIO(input), output)
+        return output.getvalue()
+
+    def test_matches_vm(self):
+        with open("tiny/average.tiny", "r") as source_file:
+            source = source_file.read()
+        columns = [[3, 2, 0, -1], [1, 5, 2, 4], [2, 6.5, 1, 0], [4, 0, 3, 1e30]]
+        lengths = [4, 3, 4, 2]
+        result = self.run_batch(source, columns, lengths)
+        for lane in range(4):
+            input = " ".join(str(columns[row][lane]) for row in range(lengths[lane]))
+            self.assertEqual(result.output(lane), self.run_program(source, input))
+
+    def test_divergent_control_flow(self):
+        source = (
+            "INPUT n\nLET i = 0\nWHILE i < n REPEAT\nIF i / 2 > 1.2 THEN\nPRINT i\nENDIF\nLET i = i + 1\nENDWHILE\n"
+            'IF n > 4 == 1 THEN\nPRINT "big"\nENDIF\nPRINT n * 3 / 2.5 + 7 / 2 - 1'
+        )
+        result = self.run_batch(source, [[0, 3, 5, 7]])
+        for lane, count in enumerate([0, 3, 5, 7]):
+            self.assertEqual(result.output(lane), self.run_program(source, str(count)))
+        self.assertEqual([round(value, 2) for value in result.printed[-1].values.tolist()], [2.0, 5.6, 8.0, 10.4])
+        self.assertEqual(result.variables["i"].tolist(), [0, 3, 5, 7])
+
+    def test_goto(self):
+        with self.assertRaises(ValueError):
+            self.run_batch("LABEL a\nGOTO a", [[1]])
+
+    def test_division_by_zero(self):
+        # An exception the caller can handle, not an exit.
+        with self.assertRaises(ZeroDivisionError):
+            self.run_batch("INPUT n\nPRINT 7 / 0", [[1, 2]])
+
+
+class TestCache(unittest.TestCase):
+    """ The compilation cache hands back the C from an earlier compile.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.source = os.path.join(self.directory, "program.tiny")
+        with open(self.source, "w") as source_file:
+            source_file.write("PRINT 1")
+
+    def store(self, compile_cache: cache.Cache, key: str, text: str) -> None:
+        output = os.path.join(self.directory, "out.c")
+        with open(output, "w") as output_file:
+            output_file.write(text)
+        compile_cache.store(key, output)
+
+    def fetch(self, compile_cache: cache.Cache, key: str):
+        output = os.path.join(self.directory, "fetched.c")
+        if not compile_cache.fetch(key, output):
+            return None
+        with open(output, "r") as output_file:
+            return output_file.read()
+
+    def test_key(self):
+        key = cache.key(self.source, ["O=0"])
+        self.assertEqual(cache.key(self.source, ["O=0"]), key)
+        self.assertNotEqual(cache.key(self.source, ["O=1"]), key)
+        with open(self.source, "w") as source_file:
+            source_file.write("PRINT 2")
+        self.assertNotEqual(cache.key(self.source, ["O=0"]), key)
+
+    def test_hit_and_miss(self):
+        compile_cache = cache.Cache(os.path.join(self.directory, "cache"))
+        self.assertIsNone(self.fetch(compile_cache, "a"))
+        self.store(compile_cache, "a", "int main;")
+        self.assertEqual(self.fetch(compile_cache, "a"), "int main;")
+
+    def test_evicts_least_recently_used(self):
+        compile_cache = cache.Cache(os.path.join(self.directory, "cache"), max_size=20)
+        self.store(compile_cache, "a", "x" * 8)
+        self.store(compile_cache, "b", "x" * 8)
+        os.utime(compile_cache.path("a"), (0, 0))
+        os.utime(compile_cache.path("b"), (1, 1))
+        self.fetch(compile_cache, "a")  # Now b is the least recently used.
+        self.store(compile_cache, "c", "x" * 8)
+        self.assertIsNotNone(self.fetch(compile_cache, "a"))
+        self.assertIsNone(self.fetch(compile_cache, "b"))
+        self.assertIsNotNone(self.fetch(compile_cache, "c"))
+
+    def test_errors_are_not_fatal(self):
+        # A full disk or unreadable cache directory loses the entry, not the compile.
+        directory = os.path.join(self.directory, "cache")
+        compile_cache = cache.Cache(directory)
+        for name, error in [
+            ("shutil.copyfileobj", OSError(28, "No space left on device")),
+            ("os.replace", OSError(5, "Input/output error")),
+        ]:
+            with mock.patch(name, side_effect=error):
+                self.store(compile_cache, "a", "int main;")
+            self.assertEqual(os.listdir(directory), [])
+        with mock.patch("os.scandir", side_effect=PermissionError(13, "Permission denied")):
+            self.store(compile_cache, "a", "int main;")
+        with mock.patch("os.unlink", side_effect=PermissionError(13, "Permission denied")):
+            cache.Cache(directory, max_size=0).evict()
+        self.assertEqual(self.fetch(compile_cache, "a"), "int main;")
+        with mock.patch("shutil.copyfileobj", side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.store(compile_cache, "b", "int main;")
+        self.assertEqual(os.listdir(directory), ["a.c"])
+
+
+class TestBatch(unittest.TestCase):
+    """ Compiling many files at once writes each to its own .c file,
+        and a bad file doesn't stop the rest.
+    """
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ["statements", "fibonacci", "average"]:
+                shutil.copy(f"tiny/{name}.tiny", directory)
+            with open(os.path.join(directory, "bad.tiny"), "w") as bad_file:
+                bad_file.write("LET = 1\n")
+            with open(os.path.join(directory, "latin1.tiny"), "wb") as bad_file:
+                bad_file.write(b'PRINT "caf\xe9"\n')
+            out_dir = os.path.join(directory, "out")
+            result = subprocess.run(
+                ["python3", "main.py", "--no-cache", "-j", "2", "--out-dir", out_dir, directory],
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(result.returncode, 1)
+            self.assertIn("bad.tiny: Error. Expected IDENT, got EQ", result.stderr)
+            self.assertIn("latin1.tiny: 'utf-8' codec can't decode byte 0xe9", result.stderr)
+            self.assertIn("Compiled 3 of 5 files", result.stderr)
+            self.assertEqual(sorted(os.listdir(out_dir)), ["average.c", "fibonacci.c", "statements.c"])
+            for name in ["statements", "fibonacci", "average"]:
+                with open(os.path.join(out_dir, f"{name}.c"), "r") as output_file:
+                    output = output_file.read()
+                with open(f"reference/{name}.c", "r") as reference_file:
+                    self.assertEqual(output, reference_file.read())
+
+
+class TestServer(unittest.TestCase):
+    """ --serve answers a JSON request per line with the C or the error.
+    """
+
+    def test_stdin(self):
+        with open("tiny/fibonacci.tiny", "r") as source_file:
+            source = source_file.read()
+        with open("reference/fibonacci.c", "r") as reference_file:
+            reference = reference_file.read()
+        requests = [
+            {"id": 1, "source": source},
+            {"id": 2, "source": "LET a = 1\nPRINT b", "optimize": 2},
+            {"id": 3},
+            {"id": 4, "source": 'PRINT "\ud800"\n'},  # Valid JSON, but C source can't hold it.
+        ]
+        result = subprocess.run(
+            ["python3", "main.py", "--serve", "-j", "1"],
+            input="".join(json.dumps(request) + "\n" for request in requests) + "not json\n",
+            capture_output=True,
+            text=True,
+        )
+        responses = {}
+        for line in result.stdout.splitlines():
+            response = json.loads(line)
+            responses[response.pop("id")] = response
+        self.assertEqual(responses[1], {"code": reference})
+        self.assertEqual(
+            responses[2],
+            {
+                "error": {
+                    "type": "ParserError",
+                    "message": "Referencing variable before assignment: b",
+                    "line": 2,
+                    "column": 7,
+                }
+            },
+        )
+        self.assertEqual(responses[3]["error"]["type"], "BadRequest")
+        self.assertEqual(responses[4]["error"]["type"], "InternalError")
+        self.assertEqual(responses[None]["error"]["type"], "BadRequest")
+
+
+class TestBench(unittest.TestCase):
+    def test_programs_compile(self):
+        # Every synthetic program is valid, and the direct and tree compilers agree on it.
+        for name, generate in bench.PROGRAMS.items():
+            with self.subTest(name):
+                source = generate(200, bench.random.Random(0))
+                code = compiler.compile_string(source).code
+                self.assertEqual(bench.compile_all(source), code)
+
+    def test_regressions(self):
+        # A slower phase than an older version's is a regression.
+        with tempfile.TemporaryDirectory() as directory:
+            results = os.path.join(directory, "results.txt")
+            arguments = ["labels", "--size", "100", "--repeat", "1", "--results", results]
+            with mock.patch("sys.stdout", io.StringIO()):
+                self.assertEqual(bench.main(arguments), 0)
+                with open(results, "r") as results_file:
+                    result = json.loads(results_file.read())
+                self.assertEqual(result["benchmark"], "labels")
+                self.assertEqual(result["tokens"], 5 + 50 * 2 * 3)  # LET a = 0, then LABEL and GOTO lines.
+                result.update(version="old", lex_seconds=1e-9)
+                with open(results, "w") as results_file:
+                    results_file.write(json.dumps(result) + "\n")
+                self.assertEqual(bench.main(arguments), 1)
+
+
 class TestEmitter(unittest.TestCase):
     """ Testing the Emitter
     """
 
-    def harness(self, name: str):
-        tiny = f"tiny/{name}.tiny"
+    def harness(self, name: str, *options: str):
+        tiny = os.path.abspath(f"tiny/{name}.tiny")
         c = f"reference/{name}.c"
-        subprocess.run(["python3", "main.py", tiny])
-        with open("out.c", "r") as resulting_file:
-            output = resulting_file.read()
+        # Compile for real every time, rather than fetch from the cache.
+        with tempfile.TemporaryDirectory() as directory:
+            run_main(directory, "--no-cache", *options, tiny)
+            with open(os.path.join(directory, "out.c"), "r") as resulting_file:
+                output = resulting_file.read()
         with open(c, "r") as reference_file:
             reference = reference_file.read()
         return output, reference
@@ -159,6 +1266,34 @@ class TestEmitter(unittest.TestCase):
         input_file, output_file = self.harness("average")
         self.assertEqual(input_file, output_file)
 
+    def test_ast(self):
+        for name in ["statements", "fibonacci", "average"]:
+            input_file, output_file = self.harness(name, "--ast")
+            self.assertEqual(input_file, output_file)
+
+    def test_optimized_examples(self):
+        # Nothing to fold in the examples.
+        for name in ["statements", "fibonacci", "average"]:
+            input_file, output_file = self.harness(name, "-O1")
+            self.assertEqual(input_file, output_file)
+
+    def test_spilled_code(self):
+        # Code bigger than the spool size goes to disk but must come out the same.
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "out.c")
+            with mock.patch.object(emit, "SPOOL_SIZE", 16):
+                emitter = Emitter(path)
+            emitter.header_line("int main (void) {")
+            for i in range(100):
+                emitter.emit_code(f"x = {i}")
+                emitter.emit_line(";")
+            emitter.emit_line("}")
+            emitter.write()
+            with open(path, "r") as output_file:
+                output = output_file.read()
+        expected = "int main (void) {\n" + "".join(f"x = {i};\n" for i in range(100)) + "}\n"
+        self.assertEqual(output, expected)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,397 @@
+""" Runs Teeny Tiny programs without a C compiler.
+
+The syntax tree is compiled to bytecode for a small stack machine: a flat array of
+(opcode, argument) pairs, with variables resolved to numbered slots. `run` then executes it in a
+single dispatch loop. Arithmetic follows the C program the compiler would have written (see
+semantics.py), so PRINT and INPUT behave the same as the compiled `out.c`.
+"""
+import sys
+from array import array
+from typing import IO, Callable, Dict, List, Optional, Tuple
+
+import nodes
+import pygen
+import semantics
+from lex import TokenType
+from optimize import walk
+from semantics import DOUBLE, FLOAT, INT, LONG
+
+# Opcodes. The argument is ignored unless the comment says otherwise.
+LOAD = 0  # Push variable slot `argument`.
+CONSTANT = 1  # Push constants[argument].
+STORE = 2  # Pop into variable slot `argument`.
+ADD_F = 3  # Float arithmetic, rounded to float.
+SUB_F = 4
+MUL_F = 5
+DIV_F = 6
+ADD_D = 7  # Double arithmetic.
+SUB_D = 8
+MUL_D = 9
+DIV_D = 10
+ADD_I = 11  # Integer arithmetic, wrapping at `argument` bits.
+SUB_I = 12
+MUL_I = 13
+DIV_I = 14
+NEGATE = 15  # Negate a float. Negative literals are folded into the constant.
+TO_FLOAT = 16  # Convert an int or double to float.
+TO_DOUBLE = 17  # Convert an int to double.
+LESS = 18  # Comparisons, pushing 1 or 0.
+LESS_EQUAL = 19
+GREATER = 20
+GREATER_EQUAL = 21
+EQUAL = 22
+NOT_EQUAL = 23
+JUMP = 24  # Go to instruction `argument`.
+JUMP_IF_FALSE = 25  # Pop, and go to instruction `argument` if it was zero.
+PRINT_STRING = 26  # Print constants[argument].
+PRINT_NUMBER = 27  # Pop a float and print it.
+INPUT = 28  # Read a float into variable slot `argument`.
+HALT = 29
+LOOP = 30  # The end of WHILE number `argument`: go back to its condition (see run).
+CALL_LOOP = 31  # Run WHILE number `argument` as Python, and go to the instruction after it.
+
+NAMES = {value: name for name, value in list(globals().items()) if isinstance(value, int) and name.isupper()}
+
+ARITHMETIC = {
+    FLOAT: {"+": ADD_F, "-": SUB_F, "*": MUL_F, "/": DIV_F},
+    DOUBLE: {"+": ADD_D, "-": SUB_D, "*": MUL_D, "/": DIV_D},
+    INT: {"+": ADD_I, "-": SUB_I, "*": MUL_I, "/": DIV_I},
+}
+ARITHMETIC[LONG] = ARITHMETIC[INT]
+
+COMPARISONS = {
+    "<": LESS,
+    "<=": LESS_EQUAL,
+    ">": GREATER,
+    ">=": GREATER_EQUAL,
+    "==": EQUAL,
+    "!=": NOT_EQUAL,
+}
+
+
+# How many times a WHILE goes round before run(hot_loop=HOT_LOOP) translates it to Python.
+HOT_LOOP = 200
+
+
+class Loop:
+    """ A WHILE in a program's instructions. """
+
+    __slots__ = ("node", "top", "end", "structured")
+
+    def __init__(self, node: nodes.While, top: int, end: int):
+        self.node = node
+        self.top = top  # The first instruction of its condition.
+        self.end = end  # The instruction after its LOOP.
+        # Nothing can jump into or out of it, so it can run as Python code on its own.
+        self.structured = not any(isinstance(child, (nodes.Label, nodes.Goto)) for child in walk(node.body))
+
+
+class Code:
+    """ A compiled program: the instructions and the tables their arguments index. """
+
+    __slots__ = ("instructions", "constants", "variables", "loops")
+
+    def __init__(self, instructions: array, constants: List, variables: List[str], loops: List[Loop]):
+        self.instructions = instructions  # Opcode and argument pairs, flattened.
+        self.constants = constants  # Numbers and strings.
+        self.variables = variables  # Variable names, by slot.
+        self.loops = loops  # The WHILEs, by number.
+
+    def disassemble(self) -> str:
+        lines = []
+        for position in range(0, len(self.instructions), 2):
+            opcode, argument = self.instructions[position], self.instructions[position + 1]
+            lines.append(f"{position // 2:5} {NAMES[opcode]:<14} {argument}")
+        return "\n".join(lines)
+
+
+class Compiler:
+    """ Compiles a syntax tree from parse.TreeParser to Code. """
+
+    def __init__(self):
+        self.instructions = array("q")
+        self.constants = []
+        self.constant_slots: Dict[Tuple, int] = {}
+        self.variables: List[str] = []
+        self.slots: Dict[str, int] = {}
+        self.labels: Dict[str, int] = {}
+        self.gotos: List[Tuple[int, str]] = []  # Where each GOTO's target needs filling in.
+        self.loops: List[Loop] = []
+
+    def program(self, program: nodes.Program) -> Code:
+        self.block(program.statements)
+        self.emit(HALT)
+        for position, label in self.gotos:
+            self.instructions[position * 2 + 1] = self.labels[label]
+        return Code(self.instructions, self.constants, self.variables, self.loops)
+
+    def emit(self, opcode: int, argument: int = 0) -> int:
+        # Append an instruction, returning its index.
+        self.instructions.append(opcode)
+        self.instructions.append(argument)
+        return len(self.instructions) // 2 - 1
+
+    def here(self) -> int:
+        # The index of the next instruction.
+        return len(self.instructions) // 2
+
+    def patch(self, position: int, target: int) -> None:
+        # Fill in a jump's target.
+        self.instructions[position * 2 + 1] = target
+
+    def constant(self, value) -> int:
+        # Add a constant, sharing equal ones (but not 0 with 0.0, or 0.0 with -0.0).
+        key = (type(value), repr(value))
+        if key not in self.constant_slots:
+            self.constant_slots[key] = len(self.constants)
+            self.constants.append(value)
+        return self.constant_slots[key]
+
+    def slot(self, name: str) -> int:
+        if name not in self.slots:
+            self.slots[name] = len(self.variables)
+            self.variables.append(name)
+        return self.slots[name]
+
+    def block(self, statements: List[nodes.Node]) -> None:
+        for statement in statements:
+            self.statement(statement)
+
+    def statement(self, node: nodes.Node) -> None:
+        if isinstance(node, nodes.Print):
+            if isinstance(node.value, str):
+                self.emit(PRINT_STRING, self.constant(node.value + "\n"))
+            else:
+                self.convert(self.expression(node.value), FLOAT)
+                self.emit(PRINT_NUMBER)
+
+        elif isinstance(node, nodes.If):
+            self.comparison(node.comparison)
+            jump = self.emit(JUMP_IF_FALSE)
+            self.block(node.body)
+            self.patch(jump, self.here())
+
+        elif isinstance(node, nodes.While):
+            top = self.here()
+            self.comparison(node.comparison)
+            jump = self.emit(JUMP_IF_FALSE)
+            number = len(self.loops)
+            loop = Loop(node, top, 0)
+            self.loops.append(loop)
+            self.block(node.body)
+            self.emit(LOOP, number)
+            loop.end = self.here()
+            self.patch(jump, loop.end)
+
+        elif isinstance(node, nodes.Label):
+            self.labels[node.name] = self.here()
+
+        elif isinstance(node, nodes.Goto):
+            self.gotos.append((self.emit(JUMP), node.name))
+
+        elif isinstance(node, nodes.Let):
+            self.convert(self.expression(node.expression), FLOAT)
+            self.emit(STORE, self.slot(node.name))
+
+        elif isinstance(node, nodes.Input):
+            self.emit(INPUT, self.slot(node.name))
+
+        else:
+            raise TypeError(f"Not a statement: {node!r}")
+
+    def convert(self, kind: str, to: str) -> None:
+        # Convert the value on top of the stack from one C type to another.
+        if to == FLOAT and kind != FLOAT:
+            self.emit(TO_FLOAT)
+        elif to == DOUBLE and kind in (INT, LONG):
+            self.emit(TO_DOUBLE)
+
+    def chain(self, node, operand, operators) -> str:
+        # Compile a left-associative chain of operands, converting each side to their common
+        # type before applying the operator. Returns the C type of the result.
+        kind = operand(node.operands[0])
+        for operator, right in zip(node.operators, node.operands[1:]):
+            right_kind = semantics.kind_of(right)
+            result = semantics.common(kind, right_kind)
+            self.convert(kind, result)
+            self.convert(operand(right), result)
+            opcode = operators(operator, result)
+            if opcode in (ADD_I, SUB_I, MUL_I, DIV_I):
+                self.emit(opcode, semantics.BITS[result])
+            else:
+                self.emit(opcode)
+            kind = INT if opcode in COMPARISONS.values() else result
+        return kind
+
+    def comparison(self, node: nodes.Comparison) -> str:
+        return self.chain(node, self.expression, lambda operator, kind: COMPARISONS[operator])
+
+    def expression(self, node: nodes.Expression) -> str:
+        return self.chain(node, self.term, lambda operator, kind: ARITHMETIC[kind][operator])
+
+    def term(self, node: nodes.Term) -> str:
+        return self.chain(node, self.unary, lambda operator, kind: ARITHMETIC[kind][operator])
+
+    def unary(self, node: nodes.Unary) -> str:
+        primary = node.primary
+        if primary.kind == TokenType.IDENT:
+            self.emit(LOAD, self.slot(primary.text))
+            if node.operator == "-":
+                self.emit(NEGATE)
+            return FLOAT
+        value = semantics.literal(primary.text)
+        if value is None:
+            # Too big for a long. C compilers make it an unsigned long long or reject it.
+            value = (DOUBLE, float(primary.text))
+        kind, number = value
+        if node.operator == "-":
+            number = -number if kind == DOUBLE else semantics.wrap(-number, semantics.BITS[kind])
+        self.emit(CONSTANT, self.constant(float(number) if kind == DOUBLE else number))
+        return kind
+
+
+def compile_program(program: nodes.Program) -> Code:
+    return Compiler().program(program)
+
+
+def run(
+    code: Code, input_file: IO[str] = None, output_file: IO[str] = None, hot_loop: Optional[int] = None
+) -> None:
+    # Execute the program, reading INPUT from input_file and writing PRINT to output_file
+    # (standard input and output by default).
+    #
+    # Given hot_loop, a WHILE that goes round that many times is translated to Python (see
+    # pygen.compile_loop), which runs it with its variables in locals, and the rest of the program
+    # stays interpreted. Only a loop without labels and GOTOs can be run on its own like that.
+    scanner = semantics.Scanner(input_file if input_file is not None else sys.stdin)
+    write = (output_file if output_file is not None else sys.stdout).write
+    instructions = code.instructions.tolist()  # Indexing a list is faster than an array.
+    loops = code.loops
+    counts = [0] * len(loops)  # How many times each WHILE has gone round.
+    translated: List[Optional[Callable]] = [None] * len(loops)
+    for loop in loops:
+        if hot_loop is None or not loop.structured:
+            # It will never be translated, so it doesn't need counting.
+            instructions[loop.end * 2 - 2 : loop.end * 2] = [JUMP, loop.top]
+    constants = code.constants
+    variables = [0.0] * len(code.variables)
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    to_float = semantics.to_float
+    divide = semantics.divide
+    format_float = semantics.format_float
+    wrap = semantics.wrap
+    pc = 0
+
+    while True:
+        opcode = instructions[pc]
+        argument = instructions[pc + 1]
+        pc += 2
+        # Roughly in order of how often they run.
+        if opcode == LOAD:
+            push(variables[argument])
+        elif opcode == CONSTANT:
+            push(constants[argument])
+        elif opcode == STORE:
+            variables[argument] = pop()
+        elif opcode == ADD_F:
+            right = pop()
+            stack[-1] = to_float(stack[-1] + right)
+        elif opcode == SUB_F:
+            right = pop()
+            stack[-1] = to_float(stack[-1] - right)
+        elif opcode == MUL_F:
+            right = pop()
+            stack[-1] = to_float(stack[-1] * right)
+        elif opcode == DIV_F:
+            right = pop()
+            stack[-1] = to_float(divide(stack[-1], right))
+        elif opcode == JUMP_IF_FALSE:
+            if not pop():
+                pc = argument * 2
+        elif opcode == JUMP:
+            pc = argument * 2
+        elif opcode == LOOP:
+            loop = loops[argument]
+            pc = loop.top * 2
+            counts[argument] += 1
+            if counts[argument] == hot_loop:
+                # From now on, entering the loop (here included) runs it as Python. The instructions
+                # are this run's own copy, so the condition's first instruction can be replaced.
+                try:
+                    translated[argument] = pygen.compile_loop(loop.node, code.variables)
+                except (SyntaxError, RecursionError, MemoryError):
+                    # Too big for Python to compile, so it stays interpreted, uncounted.
+                    instructions[loop.end * 2 - 2 : loop.end * 2] = [JUMP, loop.top]
+                else:
+                    instructions[pc : pc + 2] = [CALL_LOOP, argument]
+        elif opcode == LESS:
+            right = pop()
+            stack[-1] = 1 if stack[-1] < right else 0
+        elif opcode == GREATER:
+            right = pop()
+            stack[-1] = 1 if stack[-1] > right else 0
+        elif opcode == LESS_EQUAL:
+            right = pop()
+            stack[-1] = 1 if stack[-1] <= right else 0
+        elif opcode == GREATER_EQUAL:
+            right = pop()
+            stack[-1] = 1 if stack[-1] >= right else 0
+        elif opcode == EQUAL:
+            right = pop()
+            stack[-1] = 1 if stack[-1] == right else 0
+        elif opcode == NOT_EQUAL:
+            right = pop()
+            stack[-1] = 1 if stack[-1] != right else 0
+        elif opcode == PRINT_NUMBER:
+            write(format_float(pop()) + "\n")
+        elif opcode == PRINT_STRING:
+            write(constants[argument])
+        elif opcode == TO_FLOAT:
+            stack[-1] = to_float(stack[-1])
+        elif opcode == TO_DOUBLE:
+            stack[-1] = float(stack[-1])
+        elif opcode == NEGATE:
+            stack[-1] = -stack[-1]
+        elif opcode == ADD_D:
+            right = pop()
+            stack[-1] = stack[-1] + right
+        elif opcode == SUB_D:
+            right = pop()
+            stack[-1] = stack[-1] - right
+        elif opcode == MUL_D:
+            right = pop()
+            stack[-1] = stack[-1] * right
+        elif opcode == DIV_D:
+            right = pop()
+            stack[-1] = divide(stack[-1], right)
+        elif opcode == INPUT:
+            count, value = scanner.scan_float()
+            if count == 1:
+                variables[argument] = value
+            elif count == 0:
+                # Not a number. Set the variable to 0 and skip the bad input.
+                variables[argument] = 0.0
+                scanner.skip_word()
+        elif opcode == ADD_I:
+            right = pop()
+            stack[-1] = wrap(stack[-1] + right, argument)
+        elif opcode == SUB_I:
+            right = pop()
+            stack[-1] = wrap(stack[-1] - right, argument)
+        elif opcode == MUL_I:
+            right = pop()
+            stack[-1] = wrap(stack[-1] * right, argument)
+        elif opcode == DIV_I:
+            right = pop()
+            if right == 0:
+                raise ZeroDivisionError("Integer division by zero.")
+            stack[-1] = wrap(semantics.truncate_divide(stack[-1], right), argument)
+        elif opcode == CALL_LOOP:
+            translated[argument](variables, scanner.scan_float, scanner.skip_word, write, **pygen.RUNTIME)
+            pc = loops[argument].end * 2
+        elif opcode == HALT:
+            return
+        else:
+            raise ValueError(f"Bad opcode {opcode} at {pc // 2 - 1}")